@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Compares the stream codecs usable by remoteShark (--codec) with the zlib
+  compression used by "ssh -C" on synthetic pcap data.
+
+  Usage: bench/codecs.py [size in MiB]
+
+  For every codec the synthetic capture is compressed and decompressed by the
+  codec binary. Reported are the compression ratio, the throughput and the CPU
+  time of each direction. Codecs without a local binary are skipped.
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthpcap import SynthPcap
+
+# name, compress command, decompress command
+CODECS = [
+    ('zlib-6 (ssh -C)', ['gzip', '-6', '-c'], ['gzip', '-d', '-c']),
+    ('zstd-1', ['zstd', '-q', '-c', '-1'], ['zstd', '-q', '-d', '-c']),
+    ('zstd-3', ['zstd', '-q', '-c', '-3'], ['zstd', '-q', '-d', '-c']),
+    ('lz4-1', ['lz4', '-q', '-c', '-1'], ['lz4', '-q', '-d', '-c']),
+]
+
+def childCpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(cmd, data):
+    """ Runs cmd with data on STDIN and returns (output, wall seconds, CPU seconds) """
+    cpu = childCpu()
+    start = time.perf_counter()
+    out = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, check=True).stdout
+    return (out, time.perf_counter() - start, childCpu() - cpu)
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    data = SynthPcap().generate(size)
+    mb = len(data) / 1000000.0
+    print("Synthetic capture: %.1f MB" % mb)
+    print("%-16s %7s %12s %10s %12s %10s" % ("codec", "ratio", "comp MB/s", "comp CPU", "decomp MB/s", "decomp CPU"))
+    for name, comp, decomp in CODECS:
+        if shutil.which(comp[0]) == None:
+            print("%-16s not installed" % name)
+            continue
+        packed, cWall, cCpu = measure(comp, data)
+        unpacked, dWall, dCpu = measure(decomp, packed)
+        if unpacked != data:
+            print("%-16s round trip mismatch" % name)
+            continue
+        print("%-16s %7.2f %12.1f %9.2fs %12.1f %9.2fs" % (name, len(data) / float(len(packed)),
+            mb / cWall, cCpu, mb / dWall, dCpu))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Stand-in for ssh used by the remoteShark benchmarks (--ssh-path).
+
+  Accepts the ssh argument layout used by remoteShark and runs the remote
+  command locally with "sh -c". The directory BENCH_BIN is put in front of
+  PATH, so that the tcpdump stand-in (bench/faketcpdump.py) replaces the real
+  tcpdump while zcat, bzcat, zstd, etc. are the real ones.
+
+  With -C the stream is compressed and decompressed with zlib level 6, which
+  is what OpenSSH does, so the CPU cost of SSH compression is accounted for.
+  The CPU time of the remote command is appended to BENCH_REMOTE_CPU, so that
+  the benchmark can tell it apart from the local side.
+"""
+import os
+import resource
+import subprocess
+import sys
+import zlib
+
+# ssh options followed by an argument
+ARG_OPTIONS = set([ '-p', '-o', '-E', '-O', '-l', '-i', '-F', '-b', '-c', '-m', '-S', '-w', '-J', '-L', '-R', '-D', '-W' ])
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == '-V':
+        sys.stderr.write("OpenSSH_bench (remoteShark benchmark stand-in)\n")
+        return 0
+
+    # Shared connections: the master is always "running"
+    if '-O' in args or '-N' in args:
+        return 0
+
+    # Options may follow the destination, only the last argument is the remote command
+    compress = False
+    positional = []
+    i = 0
+    while i < len(args) - 1:
+        if args[i] in ARG_OPTIONS:
+            i = i + 2
+            continue
+        if args[i].startswith('-'):
+            compress = compress or 'C' in args[i][1:]
+        else:
+            positional.append(args[i])
+        i = i + 1
+    if len(args) > 0:
+        positional.append(args[-1])
+
+    if len(positional) < 2:
+        sys.stderr.write("fakessh: no remote command\n")
+        return 255
+
+    env = os.environ.copy()
+    if 'BENCH_BIN' in env:
+        env['PATH'] = env['BENCH_BIN'] + os.pathsep + env.get('PATH', '')
+    process = subprocess.Popen(['sh', '-c', positional[-1]], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, env=env)
+
+    out = sys.stdout.buffer
+    try:
+        if compress:
+            compressor = zlib.compressobj(6)
+            decompressor = zlib.decompressobj()
+            while True:
+                data = process.stdout.read1(65536)
+                if not data:
+                    break
+                out.write(decompressor.decompress(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)))
+                out.flush()
+        else:
+            while True:
+                data = process.stdout.read1(1024 * 1024)
+                if not data:
+                    break
+                out.write(data)
+                out.flush()
+    except BrokenPipeError:
+        process.terminate()
+    process.wait()
+
+    if 'BENCH_REMOTE_CPU' in os.environ:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with open(os.environ['BENCH_REMOTE_CPU'], 'a') as f:
+            f.write("%f\n" % (usage.ru_utime + usage.ru_stime))
+    return process.returncode
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(255)
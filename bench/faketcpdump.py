@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Stand-in for the remote tcpdump used by the remoteShark benchmarks.
+
+  A live capture (-i) replays the pcap file BENCH_CAPTURE to STDOUT, paced
+  to BENCH_RATE MB/s when it is set. Reading a file (-r FILE, or -r - for
+  STDIN) copies it to STDOUT, like tcpdump without a filter does. -c limits the number of
+  packets as usual. --version, -h and --list-interfaces answer the capability
+  probe of remoteShark.
+
+  With BENCH_PPS the live capture instead models the kernel side of tcpdump
+  for BENCH_DURATION seconds (default 5): the packets of BENCH_CAPTURE
+  arrive at BENCH_PPS packets per second and are timestamped with the time
+  of arrival. They wait in a capture buffer of -B KiB (default 2 MiB like
+  libpcap) and are dropped when it is full. Without --immediate-mode they are
+  handed over in blocks of BLOCK_SIZE or after BLOCK_TIMEOUT, and without -U
+  the output is written in BUFSIZ chunks. The counters are printed on exit
+  like tcpdump does and saved as JSON into BENCH_DROPS.
+"""
+import collections
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+USAGE = """tcpdump version 4.99.1 (remoteShark benchmark stand-in)
+Usage: tcpdump [-AbdDefhHIJKlLnNOpqStuUvxX#] [ -B size ] [ -c count ] [--count]
+\t\t[ -i interface ] [ --immediate-mode ] [ -j tstamptype ]
+\t\t[ --time-stamp-precision precision ] [ --micro ] [ --nano ]
+"""
+INTERFACES = "1.eth0 [Up, Running, Connected]\n2.any (Pseudo-device that captures on all interfaces) [Up, Running]\n3.lo [Up, Running, Loopback]\n"
+
+# Default capture buffer of libpcap
+DEFAULT_BUFFER = 2 * 1024 * 1024
+# Block size and block timeout of the TPACKET_V3 ring without --immediate-mode
+BLOCK_SIZE = 256 * 1024
+BLOCK_TIMEOUT = 1.0
+# stdio buffer of the output without -U
+BUFSIZ = 4096
+
+def packets(data, count):
+    """ Returns the length of the pcap data holding the header and the first count packets """
+    offset = 24
+    while count > 0 and offset + 16 <= len(data):
+        offset = offset + 16 + struct.unpack_from('<I', data, offset + 8)[0]
+        count = count - 1
+    return offset
+
+class CaptureModel:
+    """ Capture buffer between the arriving packets and the output of tcpdump """
+    def __init__(self, data, pps, duration, bufferSize, immediate, packetBuffered, count):
+        self.header = bytes(data[:24])
+        self.records = []
+        offset = 24
+        while offset + 16 <= len(data):
+            length = struct.unpack_from('<I', data, offset + 8)[0]
+            self.records.append(data[offset + 16:offset + 16 + length])
+            offset = offset + 16 + length
+        self.pps = pps
+        self.duration = duration
+        self.bufferSize = bufferSize
+        self.immediate = immediate
+        self.packetBuffered = packetBuffered
+        self.count = count
+        self.received = 0
+        self.dropped = 0
+        self.captured = 0
+        self.__queued = 0
+        self.__ring = collections.deque()
+        self.__block = []
+        self.__blockBytes = 0
+        self.__blockStart = None
+        self.__done = False
+        self.__cond = threading.Condition()
+
+    def __arrive(self):
+        """ Packets arrive at the configured rate, in ticks of a millisecond """
+        start = time.time()
+        index = 0
+        while not self.__done:
+            now = time.time()
+            if now - start >= self.duration:
+                break
+            due = int((now - start) * self.pps) - self.received
+            with self.__cond:
+                for x in range(due):
+                    record = self.records[index % len(self.records)]
+                    index = index + 1
+                    self.received = self.received + 1
+                    if self.__queued + len(record) + 16 > self.bufferSize:
+                        self.dropped = self.dropped + 1
+                        continue
+                    self.__queued = self.__queued + len(record) + 16
+                    self.__block.append((now, record))
+                    self.__blockBytes = self.__blockBytes + len(record) + 16
+                    if self.__blockStart == None:
+                        self.__blockStart = now
+                self.__retire(now)
+                self.__cond.notify()
+            time.sleep(0.001)
+        with self.__cond:
+            self.__retire(None)
+            self.__done = True
+            self.__cond.notify()
+
+    def __retire(self, now):
+        """ Hands the current block over to tcpdump when it is full or timed out """
+        if len(self.__block) == 0:
+            return
+        if self.immediate or now == None or self.__blockBytes >= BLOCK_SIZE or now - self.__blockStart >= BLOCK_TIMEOUT:
+            self.__ring.extend(self.__block)
+            self.__block = []
+            self.__blockBytes = 0
+            self.__blockStart = None
+
+    def run(self, out):
+        thread = threading.Thread(target=self.__arrive, daemon=True)
+        thread.start()
+        fd = out.fileno()
+        os.write(fd, self.header)
+        pending = []
+        pendingBytes = 0
+        try:
+            while self.count == None or self.captured < self.count:
+                with self.__cond:
+                    while len(self.__ring) == 0 and not self.__done:
+                        self.__cond.wait()
+                    if len(self.__ring) == 0:
+                        break
+                    stamp, record = self.__ring.popleft()
+                sec = int(stamp)
+                pending.append(struct.pack('<IIII', sec, int((stamp - sec) * 1000000), len(record), len(record)))
+                pending.append(record)
+                pendingBytes = pendingBytes + len(record) + 16
+                self.captured = self.captured + 1
+                if self.packetBuffered or pendingBytes >= BUFSIZ:
+                    os.write(fd, b''.join(pending))
+                    pending = []
+                    pendingBytes = 0
+                # The buffer space is released once tcpdump is done with the packet
+                with self.__cond:
+                    self.__queued = self.__queued - len(record) - 16
+            if len(pending) > 0:
+                os.write(fd, b''.join(pending))
+        finally:
+            self.__done = True
+        sys.stderr.write("%d packets captured\n%d packets received by filter\n%d packets dropped by kernel\n" %
+            (self.captured, self.received, self.dropped))
+        if 'BENCH_DROPS' in os.environ:
+            with open(os.environ['BENCH_DROPS'], 'w') as f:
+                json.dump({ 'received': self.received, 'dropped': self.dropped, 'captured': self.captured }, f)
+        return 0
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] in ('--version', '-h'):
+        sys.stdout.write(USAGE if args[0] == '--version' else '')
+        sys.stderr.write(USAGE if args[0] == '-h' else '')
+        return 0
+    if len(args) > 0 and args[0] in ('-D', '--list-interfaces'):
+        sys.stdout.write(INTERFACES)
+        return 0
+
+    count = None
+    live = True
+    source = None
+    bufferSize = DEFAULT_BUFFER
+    immediate = False
+    packetBuffered = False
+    i = 0
+    while i < len(args):
+        if args[i] == '-c':
+            count = int(args[i + 1])
+            i = i + 2
+            continue
+        if args[i] == '-B':
+            bufferSize = int(args[i + 1]) * 1024
+            i = i + 2
+            continue
+        if args[i] == '-r':
+            live = False
+            source = args[i + 1]
+            i = i + 2
+            continue
+        if args[i] == '--immediate-mode':
+            immediate = True
+        elif args[i] == '-U':
+            packetBuffered = True
+        i = i + 1
+
+    out = sys.stdout.buffer
+    if not live:
+        src = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        while True:
+            data = src.read1(1024 * 1024)
+            if not data:
+                break
+            out.write(data)
+        out.flush()
+        return 0
+
+    with open(os.environ['BENCH_CAPTURE'], 'rb') as f:
+        data = f.read()
+    if 'BENCH_PPS' in os.environ:
+        model = CaptureModel(memoryview(data), float(os.environ['BENCH_PPS']), float(os.environ.get('BENCH_DURATION', '5')),
+            bufferSize, immediate, packetBuffered, count)
+        return model.run(out)
+
+    if count != None:
+        data = data[:packets(data, count)]
+    rate = float(os.environ.get('BENCH_RATE', '0')) * 1000000
+    chunk = 256 * 1024
+    start = time.perf_counter()
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk):
+        if rate > 0:
+            delay = start + offset / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        out.write(view[offset:offset + chunk])
+        out.flush()
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(1)
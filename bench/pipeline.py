@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  End-to-end benchmark of the remoteShark capture pipeline without a remote host.
+
+  Usage: bench/pipeline.py [--size MiB] [--rate MB/s] [--repeat N]
+                           [--json FILE] [--compare FILE] [mode ...]
+
+  remoteShark is run with --ssh-path and --wireshark-path pointing to local
+  stand-ins: bench/fakessh.py runs the remote command locally with
+  bench/faketcpdump.py in place of tcpdump, bench/stubshark.py consumes the
+  stream like Wireshark. Every mode is run --repeat times and the median is
+  reported:
+
+    throughput   MB/s between the first packet and the end of the stream
+    first packet seconds from starting remoteShark to the first packet
+    CPU          local CPU time (remoteShark, ssh, decoders) per byte,
+                 the CPU time of the "remote" commands is excluded
+
+  --json saves the results, --compare prints the change against saved ones
+  and marks throughput or CPU regressions of more than 10%.
+"""
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REMOTESHARK = os.path.join(os.path.dirname(BENCH_DIR), 'remoteShark.py')
+sys.path.insert(0, BENCH_DIR)
+from synthpcap import SynthPcap
+
+# name, remoteShark arguments ({capture} is the path of the capture file), required binary
+MODES = [
+    ('plain', [], None),
+    ('relay', ['--relay'], None),
+    ('compression', ['-C'], None),
+    ('zstd', ['--codec', 'zstd'], 'zstd'),
+    ('lz4', ['--codec', 'lz4'], 'lz4'),
+    ('headless', ['-o', '{output}'], None),
+    ('file', ['{host}:{capture}'], None),
+    ('gz', ['{host}:{capture}.gz'], 'gzip'),
+    ('bz2', ['{host}:{capture}.bz2'], 'bzip2'),
+    ('xz', ['{host}:{capture}.xz'], 'xz'),
+    ('zst', ['{host}:{capture}.zst'], 'zstd'),
+]
+HOST = '127.0.0.1'
+REGRESSION = 0.10
+
+def childCpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def wrapper(directory, name, script):
+    """ Creates an executable running script with the current Python """
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, script))
+    os.chmod(path, 0o755)
+    return path
+
+class Bench:
+    """ Runs remoteShark against the local stand-ins """
+    def __init__(self, size, rate):
+        self.tmp = tempfile.mkdtemp(prefix='remoteShark-bench-')
+        self.bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(self.bin)
+        wrapper(self.bin, 'tcpdump', os.path.join(BENCH_DIR, 'faketcpdump.py'))
+        self.ssh = wrapper(self.tmp, 'ssh', os.path.join(BENCH_DIR, 'fakessh.py'))
+        self.wireshark = wrapper(self.tmp, 'wireshark', os.path.join(BENCH_DIR, 'stubshark.py'))
+        self.capture = os.path.join(self.tmp, 'capture.pcap')
+        self.data = SynthPcap().generate(size)
+        with open(self.capture, 'wb') as f:
+            f.write(self.data)
+        for tool, ext in (('gzip', '.gz'), ('bzip2', '.bz2'), ('xz', '.xz'), ('zstd', '.zst')):
+            if shutil.which(tool) != None:
+                with open(self.capture + ext, 'wb') as f:
+                    subprocess.run([tool, '-c', self.capture], stdout=f, check=True)
+        self.rate = rate
+
+    def execute(self, args, environment = {}):
+        """ Runs remoteShark once with the additional environment of the stand-ins and returns
+        (report of the consumer, start time, local CPU seconds) """
+        report = os.path.join(self.tmp, 'report.json')
+        remoteCpu = os.path.join(self.tmp, 'remote-cpu')
+        output = os.path.join(self.tmp, 'out')
+        for path in [ report, remoteCpu ] + [ os.path.join(self.tmp, x) for x in os.listdir(self.tmp) if x.startswith('out_') ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        env = os.environ.copy()
+        env.update({ 'BENCH_BIN': self.bin, 'BENCH_CAPTURE': self.capture, 'BENCH_RATE': str(self.rate),
+            'BENCH_REPORT': report, 'BENCH_REMOTE_CPU': remoteCpu, 'XDG_CACHE_HOME': os.path.join(self.tmp, 'cache') })
+        env.update(environment)
+        args = [ x.format(host=HOST, capture=self.capture, output=output) for x in args ]
+        if len([ x for x in args if x.startswith(HOST + ':') ]) == 0:
+            args = [ HOST ] + args
+        cmd = [ sys.executable, REMOTESHARK, '--ssh-path', self.ssh, '--wireshark-path', self.wireshark ] + args
+
+        cpu = childCpu()
+        start = time.time()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=600)
+        end = time.time()
+        cpu = childCpu() - cpu
+
+        if '-o' in args:
+            files = [ os.path.join(self.tmp, x) for x in os.listdir(self.tmp) if x.startswith('out_') ]
+            result = { 'bytes': sum([ os.path.getsize(x) for x in files ]), 'firstPacket': None, 'end': end }
+        else:
+            # Wireshark is left running by remoteShark, wait for the stand-in to see the end of the stream
+            deadline = time.time() + 60
+            while not os.path.exists(report) and time.time() < deadline:
+                time.sleep(0.05)
+            with open(report) as f:
+                result = json.load(f)
+
+        if os.path.exists(remoteCpu):
+            with open(remoteCpu) as f:
+                cpu = cpu - sum([ float(x) for x in f.read().split() ])
+        return (result, start, cpu)
+
+    def run(self, args):
+        """ Runs remoteShark once and returns (bytes, throughput MB/s, first packet s, CPU ns/B) """
+        result, start, cpu = self.execute(args)
+        first = result['firstPacket'] if result['firstPacket'] != None else start
+        duration = max(result['end'] - first, 1e-6)
+        return (result['bytes'], result['bytes'] / duration / 1000000.0,
+            None if result['firstPacket'] == None else result['firstPacket'] - start,
+            cpu * 1e9 / max(result['bytes'], 1))
+
+    def close(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def median(values):
+    values = [ x for x in values if x != None ]
+    return statistics.median(values) if len(values) > 0 else None
+
+def main():
+    size = 256
+    rate = 0
+    repeat = 3
+    jsonFile = None
+    compareFile = None
+    modes = []
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] in ('--size', '--rate', '--repeat', '--json', '--compare'):
+            value = args[i + 1]
+            if args[i] == '--size':
+                size = int(value)
+            elif args[i] == '--rate':
+                rate = float(value)
+            elif args[i] == '--repeat':
+                repeat = int(value)
+            elif args[i] == '--json':
+                jsonFile = value
+            else:
+                compareFile = value
+            i = i + 2
+            continue
+        modes.append(args[i])
+        i = i + 1
+    if len(modes) == 0:
+        modes = [ x[0] for x in MODES ]
+
+    baseline = {}
+    if compareFile != None:
+        with open(compareFile) as f:
+            baseline = json.load(f)
+
+    bench = Bench(size * 1024 * 1024, rate)
+    results = {}
+    print("Synthetic capture: %.1f MB%s, %d run(s) per mode" % (len(bench.data) / 1000000.0,
+        "" if rate <= 0 else " replayed at %.1f MB/s" % rate, repeat))
+    print("%-12s %10s %12s %12s %10s" % ("mode", "MB", "MB/s", "first pkt", "CPU ns/B"))
+    try:
+        for name, modeArgs, binary in MODES:
+            if name not in modes:
+                continue
+            if binary != None and shutil.which(binary) == None:
+                print("%-12s %s is not installed" % (name, binary))
+                continue
+            runs = [ bench.run(modeArgs) for x in range(repeat) ]
+            result = { 'bytes': median([ x[0] for x in runs ]), 'throughput': median([ x[1] for x in runs ]),
+                'firstPacket': median([ x[2] for x in runs ]), 'cpu': median([ x[3] for x in runs ]) }
+            results[name] = result
+            line = "%-12s %10.1f %12.1f %12s %10.2f" % (name, result['bytes'] / 1000000.0, result['throughput'],
+                '-' if result['firstPacket'] == None else '%.3fs' % result['firstPacket'], result['cpu'])
+            if name in baseline:
+                old = baseline[name]
+                throughput = result['throughput'] / old['throughput'] - 1
+                cpu = result['cpu'] / old['cpu'] - 1 if old['cpu'] > 0 else 0
+                line = line + "   %+6.1f%% MB/s %+6.1f%% CPU" % (throughput * 100, cpu * 100)
+                if throughput < -REGRESSION or cpu > REGRESSION:
+                    line = line + "  REGRESSION"
+            print(line)
+    finally:
+        bench.close()
+
+    if jsonFile != None:
+        with open(jsonFile, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Measures the latency and drop rate tradeoff of the remoteShark capture profiles.
+
+  Usage: bench/profiles.py [--duration s] [--repeat N] [--json FILE] [profile ...]
+
+  Uses the stand-ins of bench/pipeline.py, with bench/faketcpdump.py modelling
+  the capture buffer of the remote kernel (see BENCH_PPS there). Every profile
+  is run in two scenarios:
+
+    quiet   1000 packets/s read by a fast consumer
+    burst   20000 packets/s (about 10 MB/s) read by a consumer limited to
+            4 MB/s, like a Wireshark falling behind
+
+  and the median of --repeat runs is reported: the packets dropped by the
+  capture buffer and the delay between the arrival of a packet on the
+  "remote" host and its arrival in the consumer (50th and 99th percentile).
+"""
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from pipeline import Bench, median
+
+PROFILES = [ 'latency', 'balanced', 'throughput' ]
+# name, packets per second, consumer rate in MB/s (0 - unlimited)
+SCENARIOS = [
+    ('quiet', 1000, 0),
+    ('burst', 20000, 4),
+]
+
+def main():
+    duration = 5
+    repeat = 1
+    jsonFile = None
+    profiles = []
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] in ('--duration', '--repeat', '--json'):
+            value = args[i + 1]
+            if args[i] == '--duration':
+                duration = float(value)
+            elif args[i] == '--repeat':
+                repeat = int(value)
+            else:
+                jsonFile = value
+            i = i + 2
+            continue
+        profiles.append(args[i])
+        i = i + 1
+    if len(profiles) == 0:
+        profiles = PROFILES
+
+    # The capture is replayed in a loop, a few MiB give enough variety
+    bench = Bench(4 * 1024 * 1024, 0)
+    drops = os.path.join(bench.tmp, 'drops.json')
+    results = {}
+    print("%.0f s per run, %d run(s) per profile and scenario" % (duration, repeat))
+    print("%-12s %-8s %10s %10s %10s %10s" % ("profile", "scenario", "packets", "dropped", "p50 ms", "p99 ms"))
+    try:
+        for profile in profiles:
+            for scenario, pps, consumerRate in SCENARIOS:
+                runs = []
+                for x in range(repeat):
+                    if os.path.exists(drops):
+                        os.remove(drops)
+                    result, start, cpu = bench.execute([ '--relay', '--profile', profile ], { 'BENCH_PPS': str(pps),
+                        'BENCH_DURATION': str(duration), 'BENCH_DROPS': drops, 'BENCH_LATENCY': '1',
+                        'BENCH_CONSUMER_RATE': str(consumerRate) })
+                    with open(drops) as f:
+                        counters = json.load(f)
+                    latency = result.get('latency', { 'p50': None, 'p99': None })
+                    runs.append((result['packets'], counters['dropped'] / max(counters['received'], 1),
+                        latency['p50'], latency['p99']))
+                result = { 'packets': median([ x[0] for x in runs ]), 'dropped': median([ x[1] for x in runs ]),
+                    'p50': median([ x[2] for x in runs ]), 'p99': median([ x[3] for x in runs ]) }
+                results[profile + '/' + scenario] = result
+                print("%-12s %-8s %10d %9.1f%% %10s %10s" % (profile, scenario, result['packets'], result['dropped'] * 100,
+                    '-' if result['p50'] == None else '%.1f' % (result['p50'] * 1000),
+                    '-' if result['p99'] == None else '%.1f' % (result['p99'] * 1000)))
+    finally:
+        bench.close()
+
+    if jsonFile != None:
+        with open(jsonFile, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Measures the remote side of loading capture files (host:/path/file) with
+  the pipelines used by remoteShark before and after the format detection.
+
+  Usage: bench/remotefiles.py [--size MiB] [format ...]
+
+  A synthetic capture of --size MiB (default 2048) is written to a temporary
+  directory, compressed with every compressor installed locally, and each
+  pipeline is read through a pipe like ssh does. Reported are the throughput
+  of the resulting pcap stream, the CPU time of the pipeline and the speedup
+  against the pipeline used before for the same format:
+
+    before      cat/zcat/bzcat FILE | tcpdump -r - (tcpdump filters the stream)
+    filter      tcpdump -r FILE, or the best decompressor | tcpdump -r -
+    no filter   the file or the best decompressor alone (default filter, no -c)
+
+  The real tcpdump is used when it is installed, bench/faketcpdump.py (which
+  only copies the data) otherwise. Compressors and decompressors which are
+  not installed are skipped.
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from synthpcap import SynthPcap
+
+# format, file extension, compress command
+FORMATS = [
+    ('pcap', '', None),
+    ('gz', '.gz', 'gzip -c {src}'),
+    ('bz2', '.bz2', 'bzip2 -c {src}'),
+    ('xz', '.xz', 'xz -T0 -c {src}'),
+    ('zst', '.zst', 'zstd -q -c {src}'),
+]
+# format, name, pipeline ({file} is the file, {tcpdump} the tcpdump reading a pcap and {filter} its filter), required binary
+PIPELINES = [
+    ('pcap', 'before', 'cat {file} | {tcpdump} -n -r - -s 0 -q -w - {filter}', None),
+    ('pcap', 'filter', '{tcpdump} -n -r {file} -s 0 -q -w - {filter}', None),
+    ('pcap', 'no filter', 'cat {file}', None),
+    ('gz', 'before', 'zcat {file} | {tcpdump} -n -r - -s 0 -q -w - {filter}', 'gzip'),
+    ('gz', 'filter gzip', 'gzip -dc {file} | {tcpdump} -n -r - -s 0 -q -w - {filter}', 'gzip'),
+    ('gz', 'filter pigz', 'pigz -dc {file} | {tcpdump} -n -r - -s 0 -q -w - {filter}', 'pigz'),
+    ('gz', 'no filter gzip', 'gzip -dc {file}', 'gzip'),
+    ('gz', 'no filter pigz', 'pigz -dc {file}', 'pigz'),
+    ('bz2', 'before', 'bzcat {file} | {tcpdump} -n -r - -s 0 -q -w - {filter}', 'bzip2'),
+    ('bz2', 'no filter bzip2', 'bzip2 -dc {file}', 'bzip2'),
+    ('bz2', 'no filter lbzip2', 'lbzip2 -dc {file}', 'lbzip2'),
+    ('bz2', 'no filter pbzip2', 'pbzip2 -dc {file}', 'pbzip2'),
+    ('xz', 'no filter', 'xz -T0 -dc {file}', 'xz'),
+    ('zst', 'no filter', 'zstd -T0 -dc {file}', 'zstd'),
+]
+FILTER = '"not port 22"'
+
+def childCpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(command):
+    """ Reads the output of command through a pipe and returns (bytes, wall seconds, CPU seconds) """
+    cpu = childCpu()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    total = 0
+    while True:
+        data = process.stdout.read1(1024 * 1024)
+        if not data:
+            break
+        total = total + len(data)
+    process.wait()
+    return (total, time.perf_counter() - start, childCpu() - cpu)
+
+def main():
+    size = 2048
+    formats = []
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] == '--size':
+            size = int(args[i + 1])
+            i = i + 2
+            continue
+        formats.append(args[i])
+        i = i + 1
+    if len(formats) == 0:
+        formats = [ x[0] for x in FORMATS ]
+
+    tcpdump = shutil.which('tcpdump')
+    if tcpdump == None:
+        tcpdump = '"%s" "%s"' % (sys.executable, os.path.join(BENCH_DIR, 'faketcpdump.py'))
+    tmp = tempfile.mkdtemp(prefix='remoteShark-bench-')
+    try:
+        capture = os.path.join(tmp, 'capture.pcap')
+        generator = SynthPcap()
+        with open(capture, 'wb') as f:
+            # Generated in parts, a few GiB do not have to fit in memory
+            written = 0
+            while written < size * 1024 * 1024:
+                data = generator.generate(min(64 * 1024 * 1024, size * 1024 * 1024 - written))
+                if written > 0:
+                    data = data[24:]
+                f.write(data)
+                written = written + len(data)
+        pcapSize = os.path.getsize(capture)
+        print("Synthetic capture: %.1f MB, %s, %d CPU(s)" % (pcapSize / 1000000.0,
+            "tcpdump " + tcpdump if shutil.which('tcpdump') != None else "bench/faketcpdump.py in place of tcpdump", os.cpu_count()))
+        files = {}
+        for name, ext, compress in FORMATS:
+            if name not in formats:
+                continue
+            if compress == None:
+                files[name] = capture
+                continue
+            if shutil.which(compress.split()[0]) == None:
+                print("%-5s %s is not installed" % (name, compress.split()[0]))
+                continue
+            files[name] = capture + ext
+            subprocess.run(compress.format(src=capture) + ' > ' + files[name], shell=True, check=True)
+
+        print("%-5s %-18s %10s %10s %10s %8s" % ("file", "pipeline", "MB/s", "CPU s", "ratio", "speedup"))
+        before = {}
+        for name, pipeline, command, binary in PIPELINES:
+            if name not in files:
+                continue
+            if binary != None and shutil.which(binary) == None:
+                print("%-5s %-18s %s is not installed" % (name, pipeline, binary))
+                continue
+            total, wall, cpu = measure(command.format(file=files[name], tcpdump=tcpdump, filter=FILTER))
+            if total != pcapSize:
+                print("%-5s %-18s produced %d of %d bytes" % (name, pipeline, total, pcapSize))
+                continue
+            if pipeline == 'before':
+                before[name] = wall
+            print("%-5s %-18s %10.1f %10.2f %10.2f %8s" % (name, pipeline, total / wall / 1000000.0, cpu,
+                pcapSize / float(os.path.getsize(files[name])), '%.2fx' % (before[name] / wall) if name in before else '-'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Stand-in for Wireshark used by the remoteShark benchmarks (--wireshark-path).
+
+  Reads the capture from STDIN like "wireshark -k -i -" does and writes a JSON
+  report into BENCH_REPORT once the stream ends: bytes and packets received,
+  the times of the first packet and of the end of the stream.
+
+  With BENCH_LATENCY the delay between the timestamp of every packet and its
+  arrival is recorded and its percentiles are added to the report, which is
+  meaningful for captures timestamped in real time (faketcpdump.py with
+  BENCH_PPS). BENCH_CONSUMER_RATE limits the reading to the given MB/s, like
+  a Wireshark busy with dissecting.
+"""
+import json
+import os
+import struct
+import sys
+import time
+
+class PacketCounter:
+    """ Counts the records of a little-endian pcap stream without copying the packet data """
+    def __init__(self, latency = False):
+        self.packets = 0
+        self.firstPacket = None
+        self.latencies = [] if latency else None
+        self.__header = 24
+        self.__record = b''
+        self.__skip = 0
+
+    def feed(self, chunk):
+        offset = 0
+        length = len(chunk)
+        while offset < length:
+            if self.__header > 0 or self.__skip > 0:
+                n = min(self.__header + self.__skip, length - offset)
+                taken = min(self.__header, n)
+                self.__header = self.__header - taken
+                self.__skip = self.__skip - (n - taken)
+                offset = offset + n
+                continue
+            need = 16 - len(self.__record)
+            self.__record = self.__record + bytes(chunk[offset:offset + need])
+            offset = offset + need
+            if len(self.__record) == 16:
+                self.packets = self.packets + 1
+                if self.firstPacket == None:
+                    self.firstPacket = time.time()
+                if self.latencies != None:
+                    sec, usec = struct.unpack_from('<II', self.__record)
+                    self.latencies.append(time.time() - sec - usec / 1000000.0)
+                self.__skip = struct.unpack_from('<I', self.__record, 8)[0]
+                self.__record = b''
+
+def main():
+    if '-v' in sys.argv[1:]:
+        print("Wireshark 0.0.0 (remoteShark benchmark stand-in)")
+        return 0
+
+    counter = PacketCounter('BENCH_LATENCY' in os.environ)
+    rate = float(os.environ.get('BENCH_CONSUMER_RATE', '0')) * 1000000
+    total = 0
+    # A paced reader takes small bites, so that the pipe fills up gradually
+    buf = bytearray(1024 * 1024 if rate <= 0 else 64 * 1024)
+    view = memoryview(buf)
+    start = time.time()
+    while True:
+        n = sys.stdin.buffer.readinto1(buf)
+        if not n:
+            break
+        total = total + n
+        counter.feed(view[:n])
+        if rate > 0:
+            delay = start + total / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    report = { 'bytes': total, 'packets': counter.packets, 'firstPacket': counter.firstPacket, 'end': time.time() }
+    if counter.latencies != None and len(counter.latencies) > 0:
+        latencies = sorted(counter.latencies)
+        report['latency'] = { 'p50': latencies[len(latencies) // 2], 'p99': latencies[len(latencies) * 99 // 100],
+            'max': latencies[-1] }
+    if 'BENCH_REPORT' in os.environ:
+        tmp = os.environ['BENCH_REPORT'] + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(report, f)
+        os.replace(tmp, os.environ['BENCH_REPORT'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
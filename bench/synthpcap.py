@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+  Generator of synthetic pcap data for the remoteShark benchmarks.
+
+  The traffic is a mix of Ethernet/IPv4/TCP flows with bare ACKs, text
+  (HTTP-like) payloads and random (TLS-like) payloads, which compresses in a
+  way close to real captures.
+"""
+import random
+import struct
+import sys
+
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 262144, 1)
+
+HTTP_TEXT = (b"GET /api/v1/items?page=2 HTTP/1.1\r\nHost: app.example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\nAccept: application/json\r\n"
+    b"Cookie: session=8f14e45fceea167a5a36dedd4bea2543\r\nConnection: keep-alive\r\n\r\n"
+    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nCache-Control: no-cache\r\n\r\n"
+    b'{"id": 1234, "name": "item", "tags": ["a", "b"], "price": 12.50, "stock": 7}\n')
+
+class SynthPcap:
+    """ Produces pcap records of a synthetic traffic mix """
+    def __init__(self, seed = 1, flows = 200, snaplen = 0, start = 1700000000.0):
+        self.random = random.Random(seed)
+        self.snaplen = snaplen
+        self.time = start
+        self.flows = []
+        for i in range(flows):
+            self.flows.append([ struct.pack('!4s4sHH', bytes([10, 0, i % 256, 1]), bytes([192, 168, 1, i % 200 + 1]),
+                self.random.randrange(1024, 65535), self.random.choice([80, 443, 443, 8080])),
+                self.random.randrange(1 << 32) ])
+
+    def packet(self):
+        """ Returns the next packet as (timestamp, data) """
+        r = self.random
+        self.time = self.time + r.expovariate(20000)
+        flow = r.choice(self.flows)
+        kind = r.random()
+        if kind < 0.5:
+            payload = b''
+        elif kind < 0.8:
+            start = r.randrange(len(HTTP_TEXT) // 2)
+            payload = HTTP_TEXT[start:start + r.randrange(64, len(HTTP_TEXT))]
+        else:
+            payload = r.randbytes(r.randrange(200, 1449)) if hasattr(r, 'randbytes') else bytes(r.getrandbits(8) for x in range(r.randrange(200, 1449)))
+        flow[1] = (flow[1] + len(payload)) & 0xffffffff
+        src, dst, sport, dport = struct.unpack('!4s4sHH', flow[0])
+        tcp = struct.pack('!HHIIBBHHH', sport, dport, flow[1], r.randrange(1 << 32), 0x80, 0x18, 502, 0, 0) + \
+            struct.pack('!BBBBII', 1, 1, 8, 10, int(self.time * 1000) & 0xffffffff, 0)
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), r.randrange(65536), 0x4000, 64, 6, 0, src, dst)
+        eth = b'\x00\x16\x3e\x11\x22\x33\x00\x16\x3e\x44\x55\x66\x08\x00'
+        return (self.time, eth + ip + tcp + payload)
+
+    def record(self):
+        """ Returns the next packet as a pcap record """
+        ts, data = self.packet()
+        caplen = len(data) if self.snaplen <= 0 else min(self.snaplen, len(data))
+        sec = int(ts)
+        return struct.pack('<IIII', sec, int((ts - sec) * 1000000), caplen, len(data)) + data[:caplen]
+
+    def generate(self, size):
+        """ Returns a complete pcap stream of at least size bytes """
+        out = [ PCAP_HEADER ]
+        total = len(PCAP_HEADER)
+        while total < size:
+            rec = self.record()
+            out.append(rec)
+            total = total + len(rec)
+        return b''.join(out)
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64 * 1024 * 1024
+    sys.stdout.buffer.write(SynthPcap().generate(size))
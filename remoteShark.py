@@ -20,13 +20,48 @@ import sys
 import os
 import os.path
 import re
-from inspect import getmembers, ismethod
+from inspect import getmembers, ismethod, getsource
 from ipaddress import ip_address
 import time
 import subprocess
 import platform
 import signal
-from socket import gethostbyname
+import struct
+import errno
+import threading
+import queue
+import tempfile
+import shutil
+import hashlib
+import gzip
+import bz2
+import lzma
+import heapq
+import selectors
+import socket
+import bisect
+import json
+import fnmatch
+import zlib
+import base64
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+    termios = None
+
+try:
+    import winreg
+except ImportError:
+    # Only available on Windows
+    winreg = None
 
 # Use Devhex' Python common for printf/sprintf
 try:
@@ -44,6 +79,691 @@ MAC_WIRESHARK_PATH="/Applications/Wireshark.app/Contents/MacOS/Wireshark"
 
 SSH_DEBUG_LOG='ssh.debug'
 
+# Magic numbers of the classic pcap format (microsecond and nanosecond precision)
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+# Block types of the pcapng format
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+
+# Size of the chunks read from the SSH processes
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Output files are written in batches of this size
+RING_BATCH_SIZE = 4 * 1024 * 1024
+# Seconds of capture per time bucket of the flow index (--flow-index)
+FLOW_INDEX_BUCKET = 10
+# First bytes of a flow index file (FILE.idx)
+FLOW_INDEX_MAGIC = b'RSFLOWS1'
+# Stream codecs which can be run on the remote host, in order of preference.
+# encode is the remote command (formatted with the level), decode the local
+# command and module the optional Python module used when the command is missing.
+STREAM_CODECS = {
+    'zstd': { 'encode': 'zstd -q -c -%d', 'decode': ['zstd', '-q', '-d', '-c'], 'module': 'zstandard', 'level': 1 },
+    'lz4': { 'encode': 'lz4 -q -c -%d', 'decode': ['lz4', '-q', '-d', '-c'], 'module': 'lz4.frame', 'level': 1 },
+}
+# Size of the chunks read from a remote file while searching for a time window
+WINDOW_PROBE_SIZE = 64 * 1024
+# Number of offsets probed in one round trip of the time window search
+WINDOW_PROBES = 8
+# Remote files are cached in chunks, an interrupted transfer resumes from the last complete one
+CACHE_CHUNK_SIZE = 8 * 1024 * 1024
+# Bytes of the beginning and of the end of a remote file covered by its cache hash
+CACHE_HASH_SAMPLE = 1024 * 1024
+# Remote commands whose availability is recorded in the capability cache
+CAPABILITY_COMMANDS = [ 'timeout', 'zstd', 'lz4', 'gzip', 'pigz', 'bzip2', 'pbzip2', 'lbzip2', 'xz', 'python3', 'awk' ]
+# Formats of capture files recognised by their first bytes
+FILE_MAGICS = [
+    ('pcap', (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')),
+    ('pcapng', (b'\x0a\x0d\x0d\x0a',)),
+    ('gz', (b'\x1f\x8b',)),
+    ('bz2', (b'BZh',)),
+    ('xz', (b'\xfd7zXZ\x00',)),
+    ('zst', (b'\x28\xb5\x2f\xfd',)),
+]
+# Remote decompressors of compressed capture files, the parallel ones first. -T0 lets
+# the versions of xz and zstd which can decode in threads use all cores
+FILE_DECOMPRESSORS = {
+    'gz': [ ('pigz', 'pigz -dc'), ('gzip', 'gzip -dc') ],
+    'bz2': [ ('lbzip2', 'lbzip2 -dc'), ('pbzip2', 'pbzip2 -dc'), ('bzip2', 'bzip2 -dc') ],
+    'xz': [ ('xz', 'xz -T0 -dc') ],
+    'zst': [ ('zstd', 'zstd -T0 -dc') ],
+}
+# tcpdump options (as printed by "tcpdump -h") recorded in the capability cache
+CAPABILITY_FLAGS = [ '--immediate-mode', '-B', '--time-stamp-precision', '-j' ]
+# Capture profiles (--profile) trading latency for throughput. buffer is the kernel
+# capture buffer of tcpdump in KiB (-B, None keeps the default of libpcap), immediate
+# delivers every packet at once (--immediate-mode), packetBuffered flushes the output
+# of tcpdump after every packet (-U), ipqos is the DSCP class of the SSH connection
+# (None keeps the default of ssh), pipeSize the size of the local pipes and autoCodec
+# whether --codec auto may compress the stream (codecs hold data back in blocks)
+CAPTURE_PROFILES = {
+    'latency': { 'buffer': None, 'immediate': True, 'packetBuffered': True, 'ipqos': 'af21', 'pipeSize': 64 * 1024, 'autoCodec': False },
+    'balanced': { 'buffer': 8 * 1024, 'immediate': True, 'packetBuffered': True, 'ipqos': None, 'pipeSize': STREAM_CHUNK_SIZE, 'autoCodec': True },
+    'throughput': { 'buffer': 64 * 1024, 'immediate': False, 'packetBuffered': False, 'ipqos': 'af11', 'pipeSize': STREAM_CHUNK_SIZE, 'autoCodec': True },
+}
+# Bytes a consumer of --tee may fall behind before its policy drops or spills the stream
+TEE_QUEUE_SIZE = 64 * 1024 * 1024
+# Seconds the consumers of --tee get on exit to catch up with their queues
+TEE_DRAIN_TIMEOUT = 30
+# Upper limit of the delay in seconds between two reconnection attempts
+RECONNECT_BACKOFF_MAX = 60
+# fcntl command for resizing a pipe on Linux (not exported by the fcntl module before Python 3.10)
+F_SETPIPE_SZ = 1031
+# Seconds between the counter reports of the remote helper when --stats does not set them
+HELPER_REPORT_INTERVAL = 1
+
+# The flows of packets are keyed by the remote helper (--flow-sample), which gets the source
+# of these functions, and by the local flow index (--flow-index)
+def packetNetwork(linktype, data):
+    """ Returns the IP version and the offset of the IP header, or None """
+    offset = 0
+    if linktype == 1:
+        if len(data) < 14:
+            return None
+        proto = data[12] << 8 | data[13]
+        offset = 14
+        # VLAN tags
+        while proto in (0x8100, 0x88a8, 0x9100) and len(data) >= offset + 4:
+            proto = data[offset + 2] << 8 | data[offset + 3]
+            offset = offset + 4
+    elif linktype == 113 or linktype == 276:
+        offset = 16 if linktype == 113 else 20
+        if len(data) < offset:
+            return None
+        proto = data[14] << 8 | data[15] if linktype == 113 else data[0] << 8 | data[1]
+    elif linktype in (0, 108):
+        if len(data) < 4:
+            return None
+        # Address family in host byte order
+        family = data[0] if data[0] != 0 else data[3]
+        proto = 0x0800 if family == 2 else 0x86dd if family in (10, 24, 28, 30) else None
+        offset = 4
+    elif linktype in (12, 14, 101, 228, 229):
+        if len(data) < 1:
+            return None
+        proto = { 4: 0x0800, 6: 0x86dd }.get(data[0] >> 4)
+    else:
+        return None
+    if proto == 0x0800:
+        return 4, offset
+    if proto == 0x86dd:
+        return 6, offset
+    return None
+
+def packetFlow(data, version, offset):
+    """ Returns the key of the flow of an IP packet, the same for both directions. Fragments
+    are keyed by their addresses only, they carry no ports """
+    if version == 4:
+        if len(data) < offset + 20:
+            return None
+        proto = data[offset + 9]
+        a = bytes(data[offset + 12:offset + 16])
+        b = bytes(data[offset + 16:offset + 20])
+        start = offset + (data[offset] & 15) * 4
+        fragment = (data[offset + 6] & 0x3f) | data[offset + 7]
+    else:
+        if len(data) < offset + 40:
+            return None
+        proto = data[offset + 6]
+        a = bytes(data[offset + 8:offset + 24])
+        b = bytes(data[offset + 24:offset + 40])
+        start = offset + 40
+        fragment = 0
+        while proto in (0, 43, 44, 60) and len(data) >= start + 8:
+            following = data[start]
+            if proto == 44:
+                fragment = 1
+                start = start + 8
+            else:
+                start = start + (data[start + 1] + 1) * 8
+            proto = following
+    if proto in (6, 17, 132) and fragment == 0 and len(data) >= start + 4:
+        a = a + bytes(data[start:start + 2])
+        b = b + bytes(data[start + 2:start + 4])
+    return bytes([ proto ]) + min(a, b) + max(a, b)
+
+# Helper run by python3 on the remote host between tcpdump and SSH, shipped with the command
+# (see RemoteShark.helperCommand) so that nothing has to be installed there. It reduces the
+# pcap stream on its STDIN: --sample N keeps every Nth packet, --flow-sample N the packets of
+# one in N flows (both directions, chosen by hash so every host keeps the same flows) and
+# --rate-limit B drops the packets above B bytes/s, or delays them with --pace. The counters
+# are printed on STDERR every --report seconds and at the end. With --merge it writes the
+# files after -- (rotated or parallel captures, plain or compressed) as one pcap stream
+# ordered by timestamp, limited to --since/--until (ns); --list only checks the files. With
+# --summary S it aggregates the pcap stream on its STDIN into a JSON line of flow counters
+# every S seconds (see Summary) instead of passing the packets on.
+REMOTE_HELPER = r'''
+import bz2, collections, glob, gzip, heapq, json, os, select, shutil, signal, socket, struct, subprocess, sys, time, zlib
+try:
+    import lzma
+except ImportError:
+    # Python built without liblzma, xz files need the xz binary then
+    lzma = None
+
+''' + getsource(packetNetwork) + '\n' + getsource(packetFlow) + r'''
+class Reducer:
+    def __init__(self, options):
+        self.sample = int(options['sample'])
+        self.flowSample = int(options['flowSample'])
+        self.rate = options['rate']
+        self.pace = options['pace']
+        self.report = options['report']
+        # Window of a live capture on the packet timestamps in ns, the duration counts from the first packet
+        self.since = options['since']
+        self.until = options['until']
+        self.duration = options['duration']
+        self.live = options['live']
+        self.first = None
+        # Seconds between the clock and the packet timestamps, measured at the first packet
+        self.offset = 0
+        self.counters = { 'seen': 0, 'seenBytes': 0, 'kept': 0, 'keptBytes': 0, 'sampled': 0, 'flows': 0,
+            'limited': 0, 'limitedBytes': 0 }
+        self.index = 0
+        # Token bucket holding up to a quarter of a second
+        self.burst = max(self.rate / 4, 65536)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+
+    def keep(self, linktype, data, size):
+        """ Decides about one packet, size is the size of its record """
+        counters = self.counters
+        counters['seen'] += 1
+        counters['seenBytes'] += size
+        if self.flowSample > 1:
+            ip = packetNetwork(linktype, data)
+            key = packetFlow(data, ip[0], ip[1]) if ip != None else None
+            # Packets without a flow (ARP, STP, ...) are kept
+            if key != None and zlib.crc32(key) % self.flowSample != 0:
+                counters['flows'] += 1
+                return False
+        if self.sample > 1:
+            index = self.index
+            self.index = (index + 1) % self.sample
+            if index != 0:
+                counters['sampled'] += 1
+                return False
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens <= 0 and not self.pace:
+                counters['limited'] += 1
+                counters['limitedBytes'] += size
+                return False
+            self.tokens = self.tokens - size
+        counters['kept'] += 1
+        counters['keptBytes'] += size
+        return True
+
+    def delay(self):
+        """ Seconds to wait until the paced output is back within the rate """
+        if not self.pace or self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def window(self, timestamp):
+        """ Places a packet before (-1), within (0) or after (1) the capture window """
+        if self.first == None:
+            self.offset = time.time() - timestamp / 1e9
+        if self.since != None and timestamp < self.since:
+            return -1
+        if self.duration != None and self.first == None:
+            end = timestamp + self.duration
+            self.until = end if self.until == None else min(self.until, end)
+        self.first = self.first if self.first != None else timestamp
+        if self.until != None and timestamp > self.until:
+            return 1
+        return 0
+
+    def wait(self):
+        """ Waits for the capture, False once a live window has ended on the clock without a packet after it """
+        if not self.live or self.until == None:
+            return True
+        # A second is left for the packets still buffered
+        timeout = max(0, self.until / 1e9 + self.offset + 1 - time.time())
+        return len(select.select([ 0 ], [], [], timeout)[0]) > 0
+
+    def stopCapture(self):
+        """ Stops the tcpdump of this SSH session once the window has ended, it would otherwise run until
+        it writes its next packet into the closed pipe """
+        try:
+            subprocess.call([ 'pkill', '-x', 'tcpdump', '-s', str(os.getsid(0)) ], stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        except OSError:
+            pass
+
+    def printCounters(self, *ignored):
+        sys.stderr.write('remoteShark::reduce ' + ' '.join([ '%s=%d' % x for x in self.counters.items() ]) + '\n')
+        sys.stderr.flush()
+
+# Leading bytes of compressed files, the tools decompressing them (the parallel ones first) and the
+# module used when none of them is installed
+DECOMPRESSORS = [
+    (b'\x1f\x8b', [ 'pigz', 'gzip' ], gzip.open),
+    (b'BZh', [ 'lbzip2', 'pbzip2', 'bzip2' ], bz2.open),
+    (b'\xfd7zXZ\x00', [ 'xz' ], lzma.open if lzma != None else None),
+    (b'\x28\xb5\x2f\xfd', [ 'zstd' ], None),
+]
+# pcap magic numbers: byte order and nanoseconds per unit of the fraction of the timestamps
+PCAP_MAGICS = { b'\xd4\xc3\xb2\xa1': ('<', 1000), b'\xa1\xb2\xc3\xd4': ('>', 1000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1), b'\xa1\xb2\x3c\x4d': ('>', 1) }
+BUFFER_SIZE = 256 * 1024
+# Errors of reading a file, which make it unusable or end it early
+READ_ERRORS = (OSError, EOFError) + ((lzma.LZMAError, ) if lzma != None else ())
+
+class Source:
+    """ One file of a merge, only open while its packets are due """
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.stream = None
+        self.processes = []
+        self.first = None
+        self.error = None
+
+    def fail(self, error):
+        self.error = error
+        self.close()
+        return False
+
+    def spawn(self, command, stdin = subprocess.DEVNULL):
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            bufsize=BUFFER_SIZE)
+        self.processes.append(process)
+        return process.stdout
+
+    def open(self):
+        """ Opens the file and reads its pcap header, returns False when it is not a capture file """
+        try:
+            with open(self.path, 'rb') as f:
+                magic = f.read(6)
+            self.stream = None
+            compressed = False
+            for prefix, tools, module in DECOMPRESSORS:
+                if not magic.startswith(prefix):
+                    continue
+                installed = [ x for x in tools if shutil.which(x) != None ]
+                if len(installed) > 0:
+                    self.stream = self.spawn([ installed[0], '-dc', self.path ])
+                elif module != None:
+                    self.stream = module(self.path, 'rb')
+                else:
+                    return self.fail('%s is not installed' % tools[0])
+                compressed = True
+                break
+            if self.stream == None:
+                self.stream = open(self.path, 'rb', buffering=BUFFER_SIZE)
+            if self.stream.peek(4)[:4] == b'\x0a\x0d\x0d\x0a':
+                # pcapng is turned into pcap by tcpdump, reading the file or the pipe of the decompressor
+                if shutil.which('tcpdump') == None:
+                    return self.fail('pcapng needs tcpdump')
+                if not compressed:
+                    self.stream.close()
+                    self.stream = self.spawn([ 'tcpdump', '-n', '-r', self.path, '-w', '-' ])
+                elif len(self.processes) > 0:
+                    # Started again, the peeked bytes would be missing in the pipe
+                    self.close()
+                    decompressed = self.spawn([ installed[0], '-dc', self.path ])
+                    self.stream = self.spawn([ 'tcpdump', '-n', '-r', '-', '-w', '-' ], decompressed)
+                    decompressed.close()
+                else:
+                    return self.fail('compressed pcapng needs %s' % ' or '.join(tools))
+            header = self.stream.read(24)
+            if len(header) < 24 or header[:4] not in PCAP_MAGICS:
+                return self.fail('not a capture file')
+            endian, self.scale = PCAP_MAGICS[header[:4]]
+            self.snaplen = struct.unpack_from(endian + 'I', header, 16)[0]
+            self.linktype = struct.unpack_from(endian + 'I', header, 20)[0] & 0x0fffffff
+            self.record = struct.Struct(endian + 'IIII')
+            return True
+        except READ_ERRORS as e:
+            return self.fail(getattr(e, 'strerror', None) or str(e))
+
+    def next(self):
+        """ Returns the next record as (timestamp in ns, caplen, origlen, data), None at the end """
+        try:
+            header = self.stream.read(16)
+            if len(header) < 16:
+                return None
+            sec, fraction, caplen, origlen = self.record.unpack(header)
+            data = self.stream.read(caplen)
+        except READ_ERRORS:
+            # A truncated file (still being written or cut by a crash) ends at its last complete packet
+            return None
+        if len(data) < caplen:
+            return None
+        return (sec * 1000000000 + fraction * self.scale, caplen, origlen, data)
+
+    def close(self):
+        if self.stream != None:
+            self.stream.close()
+            self.stream = None
+        for process in self.processes:
+            if process.poll() == None:
+                process.kill()
+            process.wait()
+        self.processes = []
+
+    def peek(self):
+        """ Reads the first timestamp of the file and closes it again """
+        if self.open():
+            record = self.next()
+            if record == None:
+                self.fail('no packets')
+            else:
+                self.first = record[0]
+            self.close()
+        return self.first != None
+
+def expand(patterns):
+    """ Returns the files matching the patterns in order, each only once """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [ pattern ]
+        if len(matches) == 0:
+            sys.stderr.write('remoteShark::file\terror\tno file matches\t%s\n' % pattern)
+        paths = paths + [ x for x in matches if x not in paths ]
+    return [ Source(i, x) for i, x in enumerate(paths) ]
+
+def listFiles(sources, out):
+    """ Prints the state of every file: its first timestamp or why it cannot be merged """
+    for source in sources:
+        if source.peek():
+            line = 'remoteShark::file\tok\t%d\t%s\n' % (source.first, source.path)
+        else:
+            line = 'remoteShark::file\terror\t%s\t%s\n' % (source.error, source.path)
+        out.write(line.encode('utf-8', 'surrogateescape'))
+    out.flush()
+
+def merge(sources, options, out):
+    """ Writes the packets of all files as one pcap stream ordered by timestamp. Only the files
+        whose packets are due are open, so memory and processes do not grow with the files """
+    since = options['since']
+    until = options['until']
+    usable = []
+    for source in sources:
+        if not source.peek():
+            sys.stderr.write('remoteShark::skip %s: %s\n' % (source.path, source.error))
+        elif len(usable) > 0 and source.linktype != usable[0].linktype:
+            sys.stderr.write('remoteShark::skip %s: linktype %d differs\n' % (source.path, source.linktype))
+        else:
+            usable.append(source)
+    if len(usable) == 0:
+        sys.stderr.write('remoteShark::error no capture file\n')
+        return 1
+    usable.sort(key=lambda x: (x.first, x.index))
+    nano = any(x.scale == 1 for x in usable)
+    divisor = 1 if nano else 1000
+    out.write(struct.pack('<IHHiIII', 0xa1b23c4d if nano else 0xa1b2c3d4, 2, 4, 0, 0,
+        max(x.snaplen for x in usable), usable[0].linktype))
+    # Files starting after the window are not opened at all
+    pending = collections.deque([ x for x in usable if until == None or x.first <= until ])
+    heap = []
+    batch = []
+    batchSize = 0
+    packRecord = struct.Struct('<IIII').pack
+    while len(heap) > 0 or len(pending) > 0:
+        if len(pending) > 0 and (len(heap) == 0 or pending[0].first <= heap[0][0]):
+            source = pending.popleft()
+            record = source.next() if source.open() else None
+            if record != None:
+                heapq.heappush(heap, (record[0], source.index, record, source))
+            else:
+                source.close()
+            continue
+        timestamp, index, record, source = heapq.heappop(heap)
+        following = source.next()
+        if following != None and (until == None or following[0] <= until):
+            heapq.heappush(heap, (following[0], index, following, source))
+        else:
+            source.close()
+        if (since != None and timestamp < since) or (until != None and timestamp > until):
+            continue
+        batch.append(packRecord(timestamp // 1000000000, timestamp % 1000000000 // divisor, record[1], record[2]))
+        batch.append(record[3])
+        batchSize = batchSize + 16 + record[1]
+        if batchSize >= 1024 * 1024:
+            out.write(b''.join(batch))
+            out.flush()
+            batch = []
+            batchSize = 0
+    out.write(b''.join(batch))
+    out.flush()
+    return 0
+
+def reduce(reducer, out):
+    if reducer.report > 0:
+        signal.signal(signal.SIGALRM, reducer.printCounters)
+        signal.setitimer(signal.ITIMER_REAL, reducer.report, reducer.report)
+    pending = bytearray()
+    linktype = None
+    # A paced stream is read in small steps, so it is smooth and not sent in bursts of a read
+    chunkSize = 64 * 1024 if reducer.pace else 1024 * 1024
+    window = reducer.since != None or reducer.until != None or reducer.duration != None
+    ended = False
+    while not ended:
+        if window and not reducer.wait():
+            ended = True
+            break
+        data = os.read(0, chunkSize)
+        if not data:
+            break
+        pending += data
+        offset = 0
+        if linktype == None:
+            if len(pending) < 24:
+                continue
+            endian = '<' if bytes(pending[:4]) in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+            linktype = struct.unpack_from(endian + 'I', pending, 20)[0] & 0x0fffffff
+            scale = PCAP_MAGICS.get(bytes(pending[:4]), (endian, 1000))[1]
+            out.write(pending[:24])
+            offset = 24
+        view = memoryview(pending)
+        kept = []
+        while offset + 16 <= len(pending):
+            end = offset + 16 + struct.unpack_from(endian + 'I', pending, offset + 8)[0]
+            if end > len(pending):
+                break
+            if window:
+                sec, frac = struct.unpack_from(endian + 'II', pending, offset)
+                place = reducer.window(sec * 1000000000 + frac * scale)
+                # Only whole records are written up to the end of the window
+                if place > 0:
+                    ended = True
+                    break
+                if place < 0:
+                    offset = end
+                    continue
+            if reducer.keep(linktype, view[offset + 16:end], end - offset):
+                kept.append(view[offset:end])
+            offset = end
+        out.write(b''.join(kept))
+        out.flush()
+        del kept
+        view.release()
+        del pending[:offset]
+        delay = reducer.delay()
+        if delay > 0:
+            time.sleep(delay)
+    if ended:
+        reducer.stopCapture()
+    reducer.printCounters()
+    return 0
+
+# Names of the IP protocols in the summary, the others are shown by number
+PROTOCOLS = { 1: 'icmp', 2: 'igmp', 6: 'tcp', 17: 'udp', 47: 'gre', 50: 'esp', 58: 'icmp6', 89: 'ospf', 132: 'sctp' }
+
+def endpoints(key):
+    """ Returns the protocol and the two (address, port) of a flow key, port is None without ports """
+    proto = key[0]
+    half = (len(key) - 1) // 2
+    ported = half in (6, 18)
+    result = []
+    for end in (key[1:1 + half], key[1 + half:]):
+        address = end[:-2] if ported else end
+        text = socket.inet_ntop(socket.AF_INET if len(address) == 4 else socket.AF_INET6, address)
+        result.append((text, struct.unpack('>H', end[-2:])[0] if ported else None))
+    return proto, result
+
+class Summary:
+    """ Aggregates the packets into one JSON line per --summary seconds of packet time: totals,
+    the protocol mix and the --top flows and addresses by bytes. With --live the intervals
+    also end on the clock, so a quiet capture still reports """
+    def __init__(self, options):
+        self.interval = options['summary']
+        self.top = int(options['top'])
+        self.live = options['live']
+        self.start = None
+        self.flows = {}
+        self.packets = 0
+        self.bytes = 0
+
+    def add(self, timestamp, linktype, data, length):
+        if self.start == None or timestamp >= self.start + self.interval:
+            self.advance(timestamp)
+        ip = packetNetwork(linktype, data)
+        key = packetFlow(data, ip[0], ip[1]) if ip != None else None
+        counters = self.flows.get(key)
+        if counters == None:
+            self.flows[key] = [ 1, length ]
+        else:
+            counters[0] += 1
+            counters[1] += length
+        self.packets += 1
+        self.bytes += length
+
+    def advance(self, now):
+        """ Reports the intervals which ended before now """
+        if self.start == None:
+            self.start = now - now % self.interval
+            return
+        while now >= self.start + self.interval:
+            if self.packets > 0 or self.live:
+                self.report()
+            self.start = self.start + self.interval
+            if not self.live and now >= self.start + self.interval:
+                # A file skips the intervals without packets
+                self.start = now - now % self.interval
+
+    def wait(self):
+        """ Seconds until the current interval ends on the clock, with a second for late packets """
+        if self.start == None:
+            return self.interval
+        return max(0.1, self.start + self.interval + 1 - time.time())
+
+    def report(self):
+        protocols = {}
+        talkers = {}
+        for key, (packets, length) in self.flows.items():
+            name = PROTOCOLS.get(key[0], str(key[0])) if key != None else 'other'
+            counters = protocols.setdefault(name, [ 0, 0 ])
+            counters[0] += packets
+            counters[1] += length
+            if key != None:
+                # Ports follow the addresses of TCP, UDP and SCTP flows
+                half = (len(key) - 1) // 2
+                size = half - 2 if half in (6, 18) else half
+                for address in set((key[1:1 + size], key[1 + half:1 + half + size])):
+                    talkers[address] = talkers.get(address, 0) + length
+        top = []
+        for key, (packets, length) in heapq.nlargest(self.top, [ x for x in self.flows.items() if x[0] != None ],
+                key=lambda x: x[1][1]):
+            proto, ends = endpoints(key)
+            names = [ ('[%s]:%d' if ':' in x[0] else '%s:%d') % x if x[1] != None else x[0] for x in ends ]
+            top.append({ 'flow': ' '.join([ PROTOCOLS.get(proto, str(proto)) ] + names), 'packets': packets, 'bytes': length })
+        line = { 'start': self.start, 'interval': self.interval, 'packets': self.packets, 'bytes': self.bytes,
+            'flows': len(self.flows), 'protocols': dict([ (x, { 'packets': y[0], 'bytes': y[1] }) for x, y in protocols.items() ]),
+            'top': top, 'talkers': [ { 'address': socket.inet_ntop(socket.AF_INET if len(x) == 4 else socket.AF_INET6, x), 'bytes': y }
+                for x, y in heapq.nlargest(self.top, talkers.items(), key=lambda x: x[1]) ] }
+        sys.stdout.write(json.dumps(line, separators=(',', ':')) + '\n')
+        sys.stdout.flush()
+        self.flows = {}
+        self.packets = 0
+        self.bytes = 0
+
+def summarize(summary):
+    pending = bytearray()
+    linktype = None
+    while True:
+        if summary.live and len(select.select([ 0 ], [], [], summary.wait())[0]) == 0:
+            summary.advance(time.time() - 1)
+            continue
+        data = os.read(0, 1024 * 1024)
+        if not data:
+            break
+        pending += data
+        offset = 0
+        if linktype == None:
+            if len(pending) < 24:
+                continue
+            magic = bytes(pending[:4])
+            endian = '<' if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+            scale = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+            linktype = struct.unpack_from(endian + 'I', pending, 20)[0] & 0x0fffffff
+            record = struct.Struct(endian + 'IIII')
+            offset = 24
+        view = memoryview(pending)
+        while offset + 16 <= len(pending):
+            sec, fraction, caplen, origlen = record.unpack_from(pending, offset)
+            end = offset + 16 + caplen
+            if end > len(pending):
+                break
+            summary.add(sec + fraction * scale, linktype, view[offset + 16:end], origlen)
+            offset = end
+        view.release()
+        del pending[:offset]
+    if summary.packets > 0:
+        summary.report()
+    return 0
+
+def parse(args):
+    """ Returns the options and the files after --, --since, --until and --duration are in ns """
+    options = { 'mode': 'reduce', 'sample': 1, 'flowSample': 1, 'rate': 0, 'pace': False, 'report': 0,
+        'since': None, 'until': None, 'duration': None, 'summary': 0, 'top': 10, 'live': False, 'files': [] }
+    names = { '--sample': 'sample', '--flow-sample': 'flowSample', '--rate-limit': 'rate', '--report': 'report',
+        '--since': 'since', '--until': 'until', '--duration': 'duration', '--summary': 'summary', '--top': 'top' }
+    i = 0
+    while i < len(args):
+        if args[i] == '--':
+            options['files'] = args[i + 1:]
+            break
+        if args[i] in ('--pace', '--live'):
+            options[args[i][2:]] = True
+        elif args[i] in ('--merge', '--list'):
+            options['mode'] = args[i][2:]
+        else:
+            options[names[args[i]]] = int(args[i + 1]) if args[i] in ('--since', '--until', '--duration') else float(args[i + 1])
+            i = i + 1
+        i = i + 1
+    return options
+
+def main():
+    options = parse(sys.argv[1:])
+    out = sys.stdout.buffer
+    if options['mode'] == 'list':
+        return listFiles(expand(options['files']), out)
+    if options['mode'] == 'merge':
+        return merge(expand(options['files']), options, out)
+    if options['summary'] > 0:
+        return summarize(Summary(options))
+    return reduce(Reducer(options), out)
+
+try:
+    sys.exit(main())
+except BrokenPipeError:
+    # SSH went away, the rest of the output goes nowhere
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+except KeyboardInterrupt:
+    pass
+'''
+
+class ConfigError(ValueError):
+    """ Invalid command line arguments, status is the exit code of remoteShark """
+    def __init__(self, message, status = 1):
+        ValueError.__init__(self, message)
+        self.status = status
+
 class AppConfig:
     # Path of binaries
     wiresharkPath = None
@@ -54,11 +774,52 @@ class AppConfig:
     interface = 'any'
     sshUser = 'root'
     sshHost = None
+    extraHosts = []
+    mergeDelay = 0.25
     sshPort = '22'
     dumpFilter = 'not port 22'
     remotePcapFile = None
     compression = None
     wiresharkFilter = ''
+    relay = False
+    outputFile = None
+    rotateSize = None
+    rotateTime = None
+    maxFiles = None
+    fsyncInterval = 5
+    flowIndex = False
+    extractFile = None
+    extractFlow = None
+    codec = None
+    codecLevel = None
+    since = None
+    until = None
+    startAt = None
+    stopAt = None
+    duration = None
+    cacheDir = None
+    cacheSize = 4096 * 1024 * 1024
+    snaplen = 0
+    headersOnly = False
+    multiplex = True
+    controlPersist = 600
+    stats = None
+    statsJson = None
+    statsProm = None
+    refreshTools = False
+    capabilityTtl = 3600
+    reconnect = False
+    reconnectMax = 0
+    gapLog = None
+    profile = 'balanced'
+    tee = []
+    teeQueue = TEE_QUEUE_SIZE
+    sample = None
+    flowSample = None
+    rateLimit = None
+    summary = None
+    summaryTop = 10
+    summaryJson = None
     
     debug = 0
     fragmentedFilter = False
@@ -95,13 +856,11 @@ class AppConfig:
 
             if argv[i] == '--count' or argv[i] == '-c':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 try:
                     self.packetCount = int(argv[i + 1])
                 except:
-                    printf("%s requires an integer argument\n", argv[i])
-                    sys.exit(2)
+                    raise ConfigError(sprintf("%s requires an integer argument", argv[i]), 2)
                 i = i + 2
                 continue
             
@@ -117,20 +876,17 @@ class AppConfig:
             
             if argv[i] == '--timeout' or argv[i] == '-t':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 try:
                     self.runTimeout = int(argv[i + 1])
                 except:
-                    printf("%s requires an integer argument\n", argv[i])
-                    sys.exit(2)
+                    raise ConfigError(sprintf("%s requires an integer argument", argv[i]), 2)
                 i = i + 2
                 continue
 
             if argv[i] == '--user' or argv[i] == '-u':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 else:
                     self.sshUser = argv[i + 1]
                     i = i + 2
@@ -138,8 +894,7 @@ class AppConfig:
 
             if argv[i] == '--port' or argv[i] == '-p':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 else:
                     try:
                         if self.dumpFilter == sprintf("not port %s", self.sshPort):
@@ -148,15 +903,13 @@ class AppConfig:
                                 printf("Switching default pcap filter to %s", self.dumpFilter)
                         self.sshPort = str(int(argv[i + 1]))
                     except ValueError:
-                        printf("%s requires an integer argument\n", argv[i])
-                        sys.exit(2)
+                        raise ConfigError(sprintf("%s requires an integer argument", argv[i]), 2)
                     i = i + 2
                     continue
 
             if argv[i] == '--filter' or argv[i] == '-f':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 else:
                     self.dumpFilter = argv[i + 1]
                     self.__validateFilter()
@@ -171,8 +924,7 @@ class AppConfig:
 
             if argv[i] == '--wireshark-filter' or argv[i] == '-w':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 else:
                     self.wiresharkFilter = argv[i+1]
                 i = i + 2
@@ -180,14 +932,353 @@ class AppConfig:
 
             if argv[i] == '--interface' or argv[i] == '-i':
                 if argc <= i + 1:
-                    printf("%s requires an argument\n", argv[i])
-                    sys.exit(1)
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
                 else:
                     self.interface = argv[i + 1]
                     self.__validateIface()
                     i = i + 2
                     continue
 
+            if argv[i] == '--ssh-path' or argv[i] == '--wireshark-path':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                if argv[i] == '--ssh-path':
+                    self.plinkPath = argv[i + 1]
+                else:
+                    self.wiresharkPath = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--capability-ttl':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.capabilityTtl = int(argv[i + 1])
+                    if self.capabilityTtl < 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a non-negative integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--refresh-tools':
+                self.refreshTools = True
+                i = i + 1
+                continue
+
+            if argv[i] == '--relay':
+                self.relay = True
+                i = i + 1
+                continue
+
+            if argv[i] == '--stats':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.stats = float(argv[i + 1])
+                    if self.stats <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive number of seconds", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--stats-json' or argv[i] == '--stats-prom':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                if argv[i] == '--stats-json':
+                    self.statsJson = argv[i + 1]
+                else:
+                    self.statsProm = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--summary':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.summary = float(argv[i + 1])
+                    if self.summary <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive number of seconds", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--summary-top':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.summaryTop = int(argv[i + 1])
+                    if self.summaryTop <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--summary-json':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.summaryJson = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--tee':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.tee = self.tee + [ self.__validateTee(argv[i + 1]) ]
+                i = i + 2
+                continue
+
+            if argv[i] == '--tee-queue':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.teeQueue = int(argv[i + 1]) * 1024 * 1024
+                    if self.teeQueue <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--sample' or argv[i] == '--flow-sample':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    value = int(argv[i + 1])
+                    if value <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                if argv[i] == '--sample':
+                    self.sample = value
+                else:
+                    self.flowSample = value
+                i = i + 2
+                continue
+
+            if argv[i] == '--rate-limit':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.rateLimit = self.__parseRate(argv[i + 1])
+                if self.rateLimit == None:
+                    raise ConfigError(sprintf("%s requires a rate in bytes per second, e.g. 500k or 2M", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--reconnect':
+                self.reconnect = True
+                i = i + 1
+                continue
+
+            if argv[i] == '--reconnect-max':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.reconnectMax = int(argv[i + 1])
+                    if self.reconnectMax < 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a non-negative integer argument", argv[i]), 2)
+                self.reconnect = True
+                i = i + 2
+                continue
+
+            if argv[i] == '--gap-log':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.gapLog = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--output' or argv[i] == '-o':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.outputFile = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] in ('--rotate-size', '--rotate-time', '--max-files', '--fsync-interval'):
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    value = int(argv[i + 1])
+                    if value <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                if argv[i] == '--rotate-size':
+                    self.rotateSize = value * 1024 * 1024
+                elif argv[i] == '--rotate-time':
+                    self.rotateTime = value
+                elif argv[i] == '--max-files':
+                    self.maxFiles = value
+                else:
+                    self.fsyncInterval = value
+                i = i + 2
+                continue
+
+            if argv[i] == '--flow-index':
+                self.flowIndex = True
+                i = i + 1
+                continue
+
+            if argv[i] == '--extract':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.extractFile = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--flow':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.extractFlow = FlowIndex.flowKey(argv[i + 1])
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires \"PROTO ADDRESS:PORT ADDRESS:PORT\" (ports only for tcp, udp and sctp)", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--codec':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                if argv[i + 1] not in list(STREAM_CODECS.keys()) + ['auto', 'none']:
+                    raise ConfigError(sprintf("%s must be one of %s, auto or none", argv[i], ', '.join(STREAM_CODECS.keys())), 2)
+                self.codec = argv[i + 1] if argv[i + 1] != 'none' else None
+                i = i + 2
+                continue
+
+            if argv[i] == '--profile':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                if argv[i + 1] not in CAPTURE_PROFILES:
+                    raise ConfigError(sprintf("%s must be one of %s", argv[i], ', '.join(CAPTURE_PROFILES.keys())), 2)
+                self.profile = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--codec-level':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.codecLevel = int(argv[i + 1])
+                    if self.codecLevel <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--cache':
+                if self.cacheDir == None:
+                    self.cacheDir = ''
+                i = i + 1
+                continue
+
+            if argv[i] == '--cache-dir':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                self.cacheDir = argv[i + 1]
+                i = i + 2
+                continue
+
+            if argv[i] == '--cache-size':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.cacheSize = int(argv[i + 1]) * 1024 * 1024
+                    if self.cacheSize <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--since' or argv[i] == '--until':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                value = self.__parseTime(argv[i + 1])
+                if value == None:
+                    raise ConfigError(sprintf("%s requires a UNIX timestamp or a date and time (YYYY-MM-DD HH:MM:SS)", argv[i]), 2)
+                if argv[i] == '--since':
+                    self.since = value
+                else:
+                    self.until = value
+                i = i + 2
+                continue
+
+            if argv[i] == '--start-at' or argv[i] == '--stop-at':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                value = self.__parseTime(argv[i + 1])
+                if value == None:
+                    raise ConfigError(sprintf("%s requires a UNIX timestamp or a date and time (YYYY-MM-DD HH:MM:SS)", argv[i]), 2)
+                if argv[i] == '--start-at':
+                    self.startAt = value
+                else:
+                    self.stopAt = value
+                i = i + 2
+                continue
+
+            if argv[i] == '--duration':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.duration = float(argv[i + 1])
+                    if self.duration <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive number of seconds", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--snaplen' or argv[i] == '-s':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.snaplen = int(argv[i + 1])
+                    if self.snaplen < 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a non-negative integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--headers-only' or argv[i] == '-H':
+                self.headersOnly = True
+                i = i + 1
+                continue
+
+            if argv[i] == '--no-multiplex':
+                self.multiplex = False
+                i = i + 1
+                continue
+
+            if argv[i] == '--control-persist':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.controlPersist = int(argv[i + 1])
+                    if self.controlPersist <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ConfigError(sprintf("%s requires a positive integer argument", argv[i]), 2)
+                i = i + 2
+                continue
+
+            if argv[i] == '--merge-delay':
+                if argc <= i + 1:
+                    raise ConfigError(sprintf("%s requires an argument", argv[i]), 1)
+                try:
+                    self.mergeDelay = float(argv[i + 1])
+                except:
+                    raise ConfigError(sprintf("%s requires a numeric argument", argv[i]), 2)
+                i = i + 2
+                continue
+
             # Consume the first non-recognized argument as the host
             if self.sshHost == None and argv[i][0] != '-':
                 self.sshHost = argv[i]
@@ -195,6 +1286,12 @@ class AppConfig:
                 i = i + 1
                 continue
 
+            # Any further hosts switch to multi-host capture
+            if argv[i][0] != '-':
+                self.extraHosts = self.extraHosts + [ self.__validateExtraHost(argv[i]) ]
+                i = i + 1
+                continue
+
             printf("Unrecognized parameter %s\n", argv[i])
             i = i + 1
         self.__postCfgPostprocess()
@@ -203,8 +1300,7 @@ class AppConfig:
         """ Validates the PCAP filter in order to ensure that some special symbols are not used """
         test = re.search('[\\\\;"`-]', self.dumpFilter)
         if test != None:
-            printf("PCAP filter cannot have semicolon (;), backslash (\\), dash (-), dollar sign ($), backtick (`) or double quotes (\")\n")
-            sys.exit(1)
+            raise ConfigError("PCAP filter cannot have semicolon (;), backslash (\\), dash (-), dollar sign ($), backtick (`) or double quotes (\")", 1)
         return
 
     def __escapeFilter(self):
@@ -218,35 +1314,94 @@ class AppConfig:
         """ Validates interface name """
         test = re.search('[ \t"/$`]', self.interface)
         if test != None:
-            printf("Interface cannot have white spaces, slashes, dollar signs, backtick or double quotes\n")
-            sys.exit(1)
+            raise ConfigError("Interface cannot have white spaces, slashes, dollar signs, backtick or double quotes", 1)
         if len(self.interface) == 0:
-            printf("Interface name cannot be empty\n")
-            sys.exit(1)
+            raise ConfigError("Interface name cannot be empty", 1)
         print(self.interface)
         return
 
+    def __splitHost(self, arg):
+        """ Splits host[:/path/file] into (host, remotePcapFile), shared by the first and the additional
+        hosts. Host names are resolved later at startup """
+        host = arg
+        remotePcapFile = None
+        if re.search(':', host):
+            buf = host.split(':', 1)
+            host = buf[0]
+            remotePcapFile = buf[1]
+        if len(host) == 0 or host[0] == '-':
+            raise ConfigError(sprintf("Invalid host %s", arg), 2)
+        return (host, remotePcapFile)
+
     def __validateHost(self):
         """ Validates specified host """
-        if re.search(':', self.sshHost):
-            buf = self.sshHost.split(':', 1)
-            self.sshHost = buf[0]
-            self.remotePcapFile = buf[1]
-        try:
-            ip_address(self.sshHost)
-            if self.debug > 2:
-                printf("Detected host (%s) as an IP address\n", self.sshHost)
-            return
-        except:
-            try:
-                buf = gethostbyname(self.sshHost)
-                if self.debug > 2:
-                    printf("Resolved host (%s) to %s\n", self.sshHost, buf)
-            except:
-                printf("Cannot resolve host %s\n", self.sshHost)
-                sys.exit(1)
-            return
+        self.sshHost, self.remotePcapFile = self.__splitHost(self.sshHost)
+        return
     
+    def __validateExtraHost(self, arg):
+        """ Validates an additional host for multi-host capture and returns (host, remotePcapFile) """
+        host = self.__splitHost(arg)
+        if self.debug > 2:
+            printf("Added host (%s) to multi-host capture\n", host[0])
+        return host
+
+    def __validateTee(self, arg):
+        """ Parses [drop:|spill:]file:PREFIX or [drop:|spill:]cmd:COMMAND into (kind, target, policy) """
+        policy = None
+        kind, _, target = arg.partition(':')
+        if kind in ('drop', 'spill'):
+            policy = kind
+            kind, _, target = target.partition(':')
+        if kind not in ('file', 'cmd') or len(target) == 0:
+            raise ConfigError("--tee requires file:PREFIX or cmd:COMMAND, optionally preceded by drop: or spill:", 2)
+        if policy == None:
+            # Files are cheap to keep up with and meant to be complete, commands may be anything
+            policy = 'spill' if kind == 'file' else 'drop'
+        return (kind, target, policy)
+
+    def __parseTime(self, value):
+        """ Parses a UNIX timestamp or a local date and time into seconds since the epoch """
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+
+    def __parseRate(self, value):
+        """ Parses a rate in bytes per second with an optional k, M or G suffix (powers of 1000) """
+        match = re.match(r'^(\d+(?:\.\d+)?)([kKmMgG]?)$', value)
+        if match == None:
+            return None
+        rate = float(match.group(1)) * 1000 ** ' kmg'.index(match.group(2).lower() or ' ')
+        return rate if rate >= 1 else None
+
+    def __headerSnaplen(self):
+        """ Works out a snaplen which keeps the link, network and transport headers
+
+        The link layer budget depends on the interface ("any" uses the Linux
+        cooked header, real interfaces Ethernet with up to two VLAN tags). The
+        network layer allows for IPv4 options or IPv6 with an extension header.
+        The transport budget is the largest one among the protocols the pcap
+        filter can match.
+        """
+        linkBudget = 20 if self.interface == 'any' else 14 + 8
+        ipBudget = 60
+        transportBudget = { 'tcp': 60, 'udp': 8 + 12, 'icmp': 8 + 28, 'sctp': 12 + 16 }
+
+        # Only trust the filter when every alternative of it names a protocol
+        protocols = set()
+        for part in re.split('\\bor\\b', self.dumpFilter):
+            found = [ x for x in transportBudget if re.search('\\b' + x + '6?\\b', part) ]
+            if len(found) == 0 or re.search('(\\bnot\\b|!)[ (]*(' + '|'.join(found) + ')', part):
+                protocols = set(transportBudget)
+                break
+            protocols.update(found)
+
+        return linkBudget + ipBudget + max([ transportBudget[x] for x in protocols ])
+
     def __postCfgPostprocess(self):
         """ Runs several post-processing checks on the configuration """
         if self.remotePcapFile != None and self.runTimeout != None:
@@ -256,6 +1411,79 @@ class AppConfig:
             if self.debug > 0:
                 printf("Detected remote file instead of a live capture. Enabling --compression by default. You can disable this behavior by --no-compression\n")
             self.compression = True
+        if len(self.extraHosts) > 0 and self.listInterfaces:
+            raise ConfigError("--list-interfaces accepts a single host", 1)
+        if self.outputFile == None and len([ x for x in self.tee if x[0] == 'file' ]) == 0 and (self.rotateSize != None or self.rotateTime != None or self.maxFiles != None):
+            raise ConfigError("--rotate-size, --rotate-time and --max-files require -o|--output or --tee file:PREFIX", 1)
+        if self.outputFile != None and len(self.wiresharkFilter) > 0:
+            if self.debug > 0:
+                printf("Wireshark display filter is ignored when writing the capture to local files\n")
+        if self.headersOnly and self.snaplen > 0:
+            raise ConfigError("-s|--snaplen and -H|--headers-only cannot be combined", 1)
+        if self.headersOnly:
+            self.snaplen = self.__headerSnaplen()
+            if self.debug > 1:
+                printf("Capturing headers only, snaplen set to %d bytes\n", self.snaplen)
+        if self.remotePcapFile != None and self.snaplen > 0:
+            if self.debug > 0:
+                printf("Snaplen only applies to live captures, remote files are transferred as they are\n")
+        if self.since != None or self.until != None:
+            if self.extractFile == None and (self.remotePcapFile == None or len([ x for x in self.extraHosts if x[1] == None ]) > 0):
+                raise ConfigError("--since and --until require remote capture files (host:/path/file.pcap) or --extract", 1)
+            if self.since != None and self.until != None and self.since > self.until:
+                raise ConfigError("--since must be before --until", 1)
+        if self.startAt != None or self.stopAt != None or self.duration != None:
+            if self.extractFile != None or self.remotePcapFile != None or len([ x for x in self.extraHosts if x[1] != None ]) > 0:
+                raise ConfigError("--start-at, --stop-at and --duration apply to live captures, files use --since and --until", 1)
+            if self.startAt != None and self.stopAt != None and self.startAt >= self.stopAt:
+                raise ConfigError("--start-at must be before --stop-at", 1)
+            if self.stopAt != None and self.stopAt <= time.time():
+                raise ConfigError("--stop-at is in the past", 1)
+            if self.reconnect or self.summary != None or self.summaryJson != None:
+                raise ConfigError("--start-at, --stop-at and --duration cannot be combined with --reconnect or --summary", 1)
+        for prefix in [ self.outputFile ] + [ x[1] for x in self.tee if x[0] == 'file' ]:
+            if prefix == None or prefix == '-':
+                continue
+            # Checked before connecting, the capture would otherwise only fail at its first packet
+            directory = os.path.dirname(prefix) or '.'
+            if not os.path.isdir(directory) or not os.access(directory, os.W_OK):
+                raise ConfigError(sprintf("Cannot write the capture into %s, the directory does not exist or is not writable", directory), 1)
+        if self.extractFlow != None and self.extractFile == None:
+            raise ConfigError("--flow requires --extract", 1)
+        if self.extractFile != None and self.outputFile == None:
+            raise ConfigError("--extract requires -o|--output (- for STDOUT)", 1)
+        if self.flowIndex and self.outputFile == None and len([ x for x in self.tee if x[0] == 'file' ]) == 0:
+            raise ConfigError("--flow-index requires -o|--output or --tee file:PREFIX", 1)
+        if self.cacheDir != None and self.remotePcapFile == None:
+            if self.debug > 0:
+                printf("--cache only applies to remote capture files\n")
+        if self.reconnect and (self.remotePcapFile != None or len(self.extraHosts) > 0):
+            raise ConfigError("--reconnect applies to a live capture from a single host", 1)
+        if self.reconnect and re.search(r'[,*?\[]', self.interface) != None:
+            raise ConfigError("--reconnect applies to a live capture from a single interface", 1)
+        if self.gapLog != None and not self.reconnect:
+            raise ConfigError("--gap-log requires --reconnect", 1)
+        if self.reconnect and self.gapLog == None and self.outputFile != None:
+            self.gapLog = self.outputFile + '.gaps'
+        if self.stats == None and (self.statsJson != None or self.statsProm != None):
+            self.stats = 10
+        if self.summary == None and self.summaryJson != None:
+            self.summary = 10
+        if self.summary != None:
+            if len(self.extraHosts) > 0 or re.search(r'[,*?\[]', self.interface) != None:
+                raise ConfigError("--summary applies to a single host and interface", 1)
+            if self.outputFile != None or len(self.tee) > 0 or self.reconnect or self.stats != None:
+                raise ConfigError("--summary sends no packets, it cannot be combined with -o, --tee, --reconnect or --stats", 1)
+            if self.sample != None or self.flowSample != None or self.rateLimit != None:
+                raise ConfigError("--summary counts every packet, it cannot be combined with --sample, --flow-sample or --rate-limit", 1)
+            if self.snaplen == 0:
+                # The flows are told apart by the headers
+                self.snaplen = self.__headerSnaplen()
+        if (self.stats != None or len(self.tee) > 0) and self.outputFile == None:
+            # The stream has to pass through remoteShark to be measured or copied
+            self.relay = True
+        if self.mergeDelay < 0:
+            raise ConfigError("--merge-delay cannot be negative", 1)
         if len(self.dumpFilter) > 0 and self.fragmentedFilter:
             self.dumpFilter = sprintf('(%s) or ( ip[6:2] & 0x3fff != 0x0000 )', self.dumpFilter)
         
@@ -270,32 +1498,2084 @@ class AppConfig:
                     data = data + sprintf("%s=%s\n", x[0], x[1])
         return data
 
-class RemoteShark:
-    platform = None
-    cfg = None
+class Packet:
+    """ Packet yielded by PacketReader: timestamp in ns (None for pcapng simple packets),
+    captured and original length, index of the interface and the captured data.
 
-    __sshProcess = None
-    __plinkProcess = None
-    __wireProcess = None
+    data is a memoryview into the buffer of the reader, valid only until the next
+    packet is read. bytes(packet.data) keeps a copy.
+    """
+    __slots__ = ('timestamp', 'caplen', 'origlen', 'interface', 'data')
 
-    __starTime = None
+    def __init__(self, timestamp, caplen, origlen, interface, data):
+        self.timestamp = timestamp
+        self.caplen = caplen
+        self.origlen = origlen
+        self.interface = interface
+        self.data = data
 
-    def __init__(self):
-        global cfg
+class PacketReader:
+    """ Parses a pcap or pcapng stream into Packets without copying the packet data
 
-        self.platform = platform.system()
-        self.cfg = cfg
-        
-        if cfg.debug >= 2:
-            printf("Detected platform '%s'\n", self.platform)
+    The stream is read into one reusable buffer and every packet refers to its
+    data with a memoryview. Only the partial record at the end of the buffer is
+    moved to its front before the next read, a record larger than the buffer
+    gets a larger one. interfaces lists (linktype, snaplen) of the interfaces
+    seen so far, which packet.interface refers to. beforeRead is called before every
+    read of the stream, that is whenever the packets buffered so far were all yielded.
+
+    Its static methods parse the file headers and pcapng blocks for the other stages
+    reading captures, so that there is one parser of the capture formats. Malformed
+    input raises ValueError.
+    """
+    def __init__(self, stream, bufferSize = STREAM_CHUNK_SIZE, beforeRead = None):
+        self.stream = stream
+        self.format = None
+        # File header of a pcap stream
+        self.header = None
+        self.interfaces = []
+        self.count = 0
+        self.__read = getattr(stream, 'readinto1', None) or stream.readinto
+        self.__buf = bytearray(bufferSize)
+        self.__view = memoryview(self.__buf)
+        self.__start = 0
+        self.__end = 0
+        self.__record = 0
+        self.__beforeRead = beforeRead
+        # Timestamp units of the pcapng interfaces as (multiplier, divisor) to nanoseconds
+        self.__units = []
+
+    def __fill(self, need):
+        """ Reads until need bytes are buffered from the current position, False at the end of the stream """
+        while self.__end - self.__start < need:
+            if self.__start + need > len(self.__buf):
+                pending = self.__end - self.__start
+                if need > len(self.__buf):
+                    # Packets handed out may still refer to the old buffer, it is left to them
+                    buf = bytearray(max(need, 2 * len(self.__buf)))
+                    buf[:pending] = self.__buf[self.__start:self.__end]
+                    self.__buf = buf
+                    self.__view = memoryview(buf)
+                else:
+                    self.__buf[:pending] = self.__buf[self.__start:self.__end]
+                self.__start = 0
+                self.__end = pending
+            if self.__beforeRead != None:
+                self.__beforeRead()
+            n = self.__read(self.__view[self.__end:])
+            if not n:
+                return False
+            self.__end = self.__end + n
+        return True
+
+    def __iter__(self):
+        return self.packets()
+
+    def record(self):
+        """ Returns the whole record of the last packet, the pcap record header and data
+        or the pcapng block, valid as long as its data """
+        return self.__view[self.__record:self.__start]
+
+    @staticmethod
+    def fileFormat(buf, offset = 0):
+        """ Returns the format of the capture starting at offset of buf (at least 4 bytes):
+        ('pcapng', None, None) or ('pcap', byte order, nanoseconds per timestamp fraction) """
+        if len(buf) < offset + 4:
+            raise ValueError("Truncated capture header")
+        magic = struct.unpack_from('<I', buf, offset)[0]
+        if magic == PCAPNG_SHB:
+            return ('pcapng', None, None)
+        for endian in ('<', '>'):
+            magic = struct.unpack_from(endian + 'I', buf, offset)[0]
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                return ('pcap', endian, 1000 if magic == PCAP_MAGIC_USEC else 1)
+        raise ValueError(sprintf("Unsupported capture format (magic 0x%08x)", magic))
+
+    @staticmethod
+    def sectionEndian(buf, block):
+        """ Returns the byte order of the pcapng section header block at block of buf """
+        return '<' if buf[block + 8:block + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+
+    def packets(self):
+        """ Yields the packets of the stream until it ends """
+        if not self.__fill(4):
+            return
+        self.format, endian, scale = PacketReader.fileFormat(self.__buf, self.__start)
+        if self.format == 'pcapng':
+            yield from self.__pcapng()
+        else:
+            yield from self.__pcap(endian, scale)
+
+    def __pcap(self, endian, scale):
+        if not self.__fill(24):
+            return
+        self.header = bytes(self.__buf[self.__start:self.__start + 24])
+        self.interfaces.append(struct.unpack_from(endian + 'II', self.__buf, self.__start + 16)[::-1])
+        self.__start = self.__start + 24
+        record = struct.Struct(endian + 'IIII')
+        while True:
+            if self.__end - self.__start < 16 and not self.__fill(16):
+                return
+            sec, frac, caplen, origlen = record.unpack_from(self.__buf, self.__start)
+            if self.__end - self.__start < 16 + caplen and not self.__fill(16 + caplen):
+                return
+            self.__record = self.__start
+            data = self.__start + 16
+            self.__start = data + caplen
+            self.count = self.count + 1
+            yield Packet(sec * 1000000000 + frac * scale, caplen, origlen, 0, self.__view[data:data + caplen])
+
+    @staticmethod
+    def interface(endian, buf, block, blockLen):
+        """ Returns linktype, snaplen and the timestamp unit as (multiplier, divisor) to nanoseconds
+        of the interface description block at block in buf """
+        linktype, reserved, snaplen = struct.unpack_from(endian + 'HHI', buf, block + 8)
+        units = (1000, 1)
+        offset = block + 16
+        while offset + 4 <= block + blockLen - 4:
+            code, length = struct.unpack_from(endian + 'HH', buf, offset)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                # if_tsresol: a negative power of 10, or of 2 with the top bit set
+                resolution = buf[offset + 4]
+                if resolution & 0x80:
+                    units = (1000000000, 1 << (resolution & 0x7f))
+                elif resolution <= 9:
+                    units = (10 ** (9 - resolution), 1)
+                else:
+                    units = (1, 10 ** (resolution - 9))
+            offset = offset + 4 + (length + 3) // 4 * 4
+        return (linktype, snaplen, units)
+
+    @staticmethod
+    def packetBlock(endian, buf, block, blockLen, units):
+        """ Returns the Packet of the pcapng block at block of buf, None when it is no packet
+        block. units holds the timestamp units of the interfaces of the section """
+        blockType = struct.unpack_from(endian + 'I', buf, block)[0]
+        if blockType == PCAPNG_EPB:
+            interface, high, low, caplen, origlen = struct.unpack_from(endian + 'IIIII', buf, block + 8)
+        elif blockType == 2:
+            # Obsolete packet block
+            interface, drops, high, low, caplen, origlen = struct.unpack_from(endian + 'HHIIII', buf, block + 8)
+        elif blockType == 3:
+            # Simple packet block: no timestamp, the data is cut to the snaplen of interface 0
+            interface = 0
+            origlen = struct.unpack_from(endian + 'I', buf, block + 8)[0]
+            caplen = min(origlen, blockLen - 16)
+        else:
+            return None
+        if interface >= len(units):
+            raise ValueError(sprintf("Packet of interface %d which was not described", interface))
+        if blockType == 3:
+            return Packet(None, caplen, origlen, 0, buf[block + 12:block + 12 + caplen])
+        if 32 + caplen > blockLen:
+            raise ValueError(sprintf("Invalid pcapng packet length %d", caplen))
+        multiplier, divisor = units[interface]
+        return Packet(((high << 32) | low) * multiplier // divisor, caplen, origlen, interface,
+            buf[block + 28:block + 28 + caplen])
+
+    def __pcapng(self):
+        endian = '<'
+        while True:
+            if self.__end - self.__start < 12 and not self.__fill(12):
+                return
+            block = self.__start
+            if struct.unpack_from('<I', self.__buf, block)[0] == PCAPNG_SHB:
+                # Every section may have another byte order and has its own interfaces
+                endian = PacketReader.sectionEndian(self.__buf, block)
+                self.interfaces = []
+                self.__units = []
+            blockType, blockLen = struct.unpack_from(endian + 'II', self.__buf, block)
+            if blockLen < 12:
+                raise ValueError(sprintf("Invalid pcapng block length %d", blockLen))
+            if self.__end - block < blockLen and not self.__fill(blockLen):
+                return
+            block = self.__start
+            self.__start = block + blockLen
+            packet = PacketReader.packetBlock(endian, self.__view, block, blockLen, self.__units)
+            if packet != None:
+                self.__record = block
+                self.count = self.count + 1
+                yield packet
+            elif blockType == PCAPNG_IDB:
+                linktype, snaplen, units = PacketReader.interface(endian, self.__buf, block, blockLen)
+                self.interfaces.append((linktype, snaplen))
+                self.__units.append(units)
+
+class Pcapng:
+    """ Builders for the pcapng blocks used when merging several captures into one stream """
+
+    @staticmethod
+    def __option(code, value):
+        pad = (4 - len(value) % 4) % 4
+        return struct.pack('<HH', code, len(value)) + value + b'\x00' * pad
+
+    @staticmethod
+    def __block(blockType, body):
+        length = 12 + len(body)
+        return struct.pack('<II', blockType, length) + body + struct.pack('<I', length)
+
+    @staticmethod
+    def sectionHeader():
+        """ Section header block, little-endian, version 1.0, unknown section length """
+        body = struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)
+        return Pcapng.__block(PCAPNG_SHB, body)
+
+    @staticmethod
+    def interfaceDescription(linktype, snaplen, name, description = None):
+        """ Interface description block with nanosecond timestamp resolution """
+        options = Pcapng.__option(2, name.encode())
+        if description != None:
+            options = options + Pcapng.__option(3, description.encode())
+        options = options + Pcapng.__option(9, b'\x09') + Pcapng.__option(0, b'')
+        body = struct.pack('<HHI', linktype, 0, snaplen) + options
+        return Pcapng.__block(PCAPNG_IDB, body)
+
+    @staticmethod
+    def enhancedPacket(ifaceId, tsNs, caplen, origlen, data, comment = None):
+        """ Enhanced packet block, timestamp in nanoseconds. Without a comment the data is copied
+        once, straight into the block """
+        pad = (4 - caplen % 4) % 4
+        if comment != None:
+            body = struct.pack('<IIIII', ifaceId, tsNs >> 32, tsNs & 0xffffffff, caplen, origlen) + bytes(data) + b'\x00' * pad
+            body = body + Pcapng.__option(1, comment.encode()) + Pcapng.__option(0, b'')
+            return Pcapng.__block(PCAPNG_EPB, body)
+        length = 32 + caplen + pad
+        block = bytearray(length)
+        struct.pack_into('<IIIIIII', block, 0, PCAPNG_EPB, length, ifaceId, tsNs >> 32, tsNs & 0xffffffff, caplen, origlen)
+        block[28:28 + caplen] = data
+        struct.pack_into('<I', block, length - 4, length)
+        return block
+
+class PcapCounter:
+    """ Relay tap counting packets, captured bytes and original bytes of a pcap stream
+
+    Only the 16 byte record headers are looked at, the packet data is skipped
+    without being copied.
+    """
+    def __init__(self):
+        self.packets = 0
+        self.capturedBytes = 0
+        self.originalBytes = 0
+        self.__header = bytearray()
+        self.__fileHeader = 24
+        self.__skip = 0
+        self.__endian = None
+
+    def __call__(self, chunk):
+        offset = 0
+        length = len(chunk)
+        while offset < length:
+            if self.__fileHeader > 0:
+                n = min(self.__fileHeader, length - offset)
+                self.__header += chunk[offset:offset + n]
+                self.__fileHeader = self.__fileHeader - n
+                offset = offset + n
+                if self.__fileHeader == 0:
+                    self.__endian = '<' if struct.unpack_from('<I', self.__header, 0)[0] in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC) else '>'
+                    self.__header = bytearray()
+                continue
+            if self.__skip > 0:
+                n = min(self.__skip, length - offset)
+                self.__skip = self.__skip - n
+                offset = offset + n
+                continue
+            if len(self.__header) == 0 and offset + 16 <= length:
+                caplen, origlen = struct.unpack_from(self.__endian + 'II', chunk, offset + 8)
+                offset = offset + 16
+            else:
+                n = min(16 - len(self.__header), length - offset)
+                self.__header += chunk[offset:offset + n]
+                offset = offset + n
+                if len(self.__header) < 16:
+                    continue
+                caplen, origlen = struct.unpack_from(self.__endian + 'II', self.__header, 8)
+                self.__header = bytearray()
+            self.packets = self.packets + 1
+            self.capturedBytes = self.capturedBytes + caplen
+            self.originalBytes = self.originalBytes + origlen
+            self.__skip = caplen
+
+class PcapMerger:
+    """ Merges several live pcap or pcapng streams by timestamp into a single pcapng stream
+
+    Each source is read by its own thread with a PacketReader, so a busy host is never
+    blocked by a slow one. The thread turns the packets into enhanced packet blocks,
+    the only copy of their data, and hands them over after each read. A source which
+    has nothing buffered holds back the others for at most mergeDelay seconds, after
+    which the oldest buffered packet is written.
+    """
+    def __init__(self, sources, out, mergeDelay = 0.25, debug = 0):
+        # sources is a list of (name, file object) or (name, file object, description) tuples
+        self.sources = sources
+        self.out = out
+        self.mergeDelay = mergeDelay
+        self.debug = debug
+        self.packets = 0
+        self.bytes = 0
+        self.__queue = queue.Queue(maxsize = 256)
+        self.__threads = []
+
+    def __reader(self, idx, stream):
+        """ Reads one source and hands over batches of (timestamp, interface, block) to the merger,
+        along with the interfaces of the section the packets belong to """
+        batch = []
+        reader = None
+        def flush():
+            if len(batch) > 0:
+                self.__queue.put((idx, reader.interfaces, batch[:]))
+                del batch[:]
+        reader = PacketReader(stream, beforeRead = flush)
+        interfaces = reader.interfaces
+        timestamp = 0
+        try:
+            for packet in reader:
+                if reader.interfaces is not interfaces:
+                    # A new pcapng section brings its own interfaces
+                    flush()
+                    interfaces = reader.interfaces
+                # Simple packet blocks have no timestamp, they follow the previous packet
+                if packet.timestamp != None:
+                    timestamp = packet.timestamp
+                batch.append((timestamp, packet.interface, Pcapng.enhancedPacket(0, timestamp, packet.caplen, packet.origlen, packet.data)))
+            flush()
+        except ValueError as e:
+            printf("Source %s: %s\n", self.sources[idx][0], e)
+        except OSError:
+            pass
+        self.__queue.put((idx, None, None))
+
+    def __describe(self, idx, interface, linktype, snaplen):
+        """ Returns the interface description block of an interface of a source """
+        name = self.sources[idx][0] if interface == 0 else sprintf('%s#%d', self.sources[idx][0], interface)
+        return Pcapng.interfaceDescription(linktype, snaplen, name, self.sources[idx][2] if len(self.sources[idx]) > 2 else None)
+
+    def run(self):
+        """ Merges the sources until all of them are exhausted or the output is closed """
+        for idx in range(len(self.sources)):
+            t = threading.Thread(target=self.__reader, args=(idx, self.sources[idx][1]), daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+        pending = [ deque() for x in self.sources ]
+        # Arrival time and count of the batches in pending, oldest first
+        arrivals = [ deque() for x in self.sources ]
+        # Interfaces of the current section of each source and their ids in the output
+        sections = [ None for x in self.sources ]
+        ifaceIds = [ [] for x in self.sources ]
+        nextId = 0
+        active = len(self.sources)
+        # Sources which are still running but have nothing pending, the merge waits for them
+        idle = len(self.sources)
+        heads = []
+        out = [ Pcapng.sectionHeader() ]
+
+        try:
+            while active > 0 or len(heads) > 0:
+                timeout = None
+                if len(heads) > 0:
+                    timeout = self.mergeDelay
+                try:
+                    item = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                while item != None:
+                    idx, interfaces, packets = item
+                    if packets == None:
+                        if len(pending[idx]) == 0:
+                            idle = idle - 1
+                        active = active - 1
+                        sections[idx] = False
+                    else:
+                        if interfaces is not sections[idx]:
+                            sections[idx] = interfaces
+                            ifaceIds[idx] = []
+                        # The interfaces are described once their packets arrive
+                        for i in range(len(ifaceIds[idx]), len(interfaces)):
+                            ifaceIds[idx].append(struct.pack('<I', nextId))
+                            out.append(self.__describe(idx, i, *interfaces[i]))
+                            nextId = nextId + 1
+                        ids = ifaceIds[idx]
+                        for ts, interface, block in packets:
+                            block[8:12] = ids[interface]
+                        if len(pending[idx]) == 0:
+                            idle = idle - 1
+                            heapq.heappush(heads, (packets[0][0], idx))
+                        pending[idx].extend(packets)
+                        arrivals[idx].append([ time.monotonic(), len(packets) ])
+                    try:
+                        item = self.__queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+
+                # Emit while every live source has data buffered or the oldest
+                # packet has waited long enough for the silent sources
+                now = time.monotonic()
+                while len(heads) > 0:
+                    ts, idx = heads[0]
+                    arrival = arrivals[idx][0]
+                    if idle > 0 and now - arrival[0] < self.mergeDelay:
+                        break
+                    heapq.heappop(heads)
+                    out.append(pending[idx].popleft()[2])
+                    self.packets = self.packets + 1
+                    arrival[1] = arrival[1] - 1
+                    if arrival[1] == 0:
+                        arrivals[idx].popleft()
+                    if len(pending[idx]) > 0:
+                        heapq.heappush(heads, (pending[idx][0][0], idx))
+                    elif sections[idx] is not False:
+                        idle = idle + 1
+
+                if len(out) > 0:
+                    data = b''.join(out)
+                    self.out.write(data)
+                    self.out.flush()
+                    self.bytes = self.bytes + len(data)
+                    out = []
+        except (BrokenPipeError, OSError, ValueError):
+            if self.debug > 3:
+                printf("Merged output was closed\n")
+            return False
+        return True
+
+class CaptureFramer:
+    """ Splits a pcap or pcapng byte stream on record boundaries
+
+    The pcap file header or the leading pcapng section header is kept apart
+    from the records, so that every output file can be started with it. For
+    pcapng the interface description blocks are returned as records (they may
+    show up mid-stream) and are remembered for the headers of later files.
+    """
+    def __init__(self):
+        self.format = None
+        self.header = b''
+        # Number of bytes of records returned so far
+        self.position = 0
+        self.__buf = bytearray()
+        self.__endian = None
+        self.__interfaces = []
+
+    def headerAt(self, position):
+        """ Returns the header needed by a file starting at the given stream position """
+        if self.format == 'pcap':
+            return self.header
+        return self.header + b''.join([ block for start, block in self.__interfaces if start < position ])
+
+    def feed(self, data):
+        """ Consumes a chunk of the stream and returns (records, ends) where records holds
+        only complete records and ends lists the offset after each of them """
+        self.__buf += data
+        buf = self.__buf
+        bufLen = len(buf)
+        offset = 0
+        ends = []
+
+        if self.format == None:
+            if bufLen < 4:
+                return (b'', ends)
+            self.format, self.__endian, scale = PacketReader.fileFormat(buf)
+
+        if len(self.header) == 0:
+            if self.format == 'pcap':
+                if bufLen < 24:
+                    return (b'', ends)
+                offset = 24
+            else:
+                if bufLen < 12:
+                    return (b'', ends)
+                self.__endian = PacketReader.sectionEndian(buf, 0)
+                offset = struct.unpack_from(self.__endian + 'I', buf, 4)[0]
+                if bufLen < offset:
+                    return (b'', ends)
+            self.header = bytes(buf[:offset])
+        start = offset
+
+        if self.format == 'pcap':
+            recordFmt = self.__endian + 'I'
+            while offset + 16 <= bufLen:
+                end = offset + 16 + struct.unpack_from(recordFmt, buf, offset + 8)[0]
+                if end > bufLen:
+                    break
+                ends.append(end - start)
+                offset = end
+        else:
+            while offset + 12 <= bufLen:
+                if struct.unpack_from('<I', buf, offset)[0] == PCAPNG_SHB:
+                    # A new section may switch the byte order
+                    self.__endian = PacketReader.sectionEndian(buf, offset)
+                blockType, blockLen = struct.unpack_from(self.__endian + 'II', buf, offset)
+                end = offset + blockLen
+                if blockLen < 12 or end > bufLen:
+                    break
+                if blockType == PCAPNG_SHB:
+                    self.header = bytes(buf[offset:end])
+                    self.__interfaces = []
+                elif blockType == PCAPNG_IDB:
+                    self.__interfaces.append((self.position + offset - start, bytes(buf[offset:end])))
+                ends.append(end - start)
+                offset = end
+
+        records = bytes(buf[start:offset])
+        del buf[:offset]
+        self.position = self.position + len(records)
+        return (records, ends)
+
+class FlowIndex:
+    """ Flow index of a local capture file, written next to it as FILE.idx (--flow-index)
+
+    While the file is written every record is noted with its flow (the key of
+    packetFlow, the same for both directions), its time bucket and its position
+    in the file. Per packet only arrays grow; the flows and the (flow, bucket)
+    entries are numbered and the packets of every entry counted. When the file
+    is complete the positions are grouped by entry with a counting sort, so that
+    select() finds the packets of a flow or of a time range without reading the
+    capture file.
+    """
+    # Flow keys of the packets without an IP flow and of the pcapng blocks which are not
+    # packets (sections, interfaces, statistics). The latter are part of every extract
+    OTHER = b''
+    CONTROL = b'\xff'
+    # Header of the index file: magic, bucket seconds, length of the file header of the
+    # capture and the number of flows, entries and packets
+    FILE_HEADER = struct.Struct('<8sIIIII')
+
+    def __init__(self, header = None, bucketSeconds = FLOW_INDEX_BUCKET):
+        """ Starts the index of a capture file beginning with header, an empty one without """
+        self.bucketSeconds = bucketSeconds
+        self.headerLength = len(header) if header != None else 0
+        self.flows = []
+        # flowId, bucket, first packet and number of packets of every entry, sorted
+        self.entries = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        # Microseconds since the start of the bucket
+        self.times = array('I')
+        self.__flowIds = {}
+        self.__entryIds = {}
+        self.__entryCounts = array('I')
+        self.__packetEntries = array('I')
+        self.__last = 0
+        self.__format = None
+        if header == None:
+            return
+        self.__format, endian, self.__scale = PacketReader.fileFormat(header)
+        if self.__format == 'pcapng':
+            self.__linktypes = []
+            self.__units = []
+            offset = 0
+            while offset + 12 <= len(header):
+                blockLen = self.__block(header, offset, None)
+                offset = offset + blockLen
+        else:
+            self.__linktype = struct.unpack_from(endian + 'I', header, 20)[0] & 0x0fffffff
+            self.__record = struct.Struct(endian + 'IIII')
+
+    def __block(self, buf, offset, position):
+        """ Notes the pcapng block at offset of buf, which is at position of the file (None for
+        the blocks of the file header). Returns the length of the block """
+        if struct.unpack_from('<I', buf, offset)[0] == PCAPNG_SHB:
+            self.__endian = PacketReader.sectionEndian(buf, offset)
+            self.__linktypes = []
+            self.__units = []
+        blockType, blockLen = struct.unpack_from(self.__endian + 'II', buf, offset)
+        key = FlowIndex.CONTROL
+        if blockType == PCAPNG_IDB:
+            linktype, snaplen, units = PacketReader.interface(self.__endian, buf, offset, blockLen)
+            self.__linktypes.append(linktype)
+            self.__units.append(units)
+        elif position != None:
+            packet = PacketReader.packetBlock(self.__endian, buf, offset, blockLen, self.__units)
+            if packet != None:
+                if packet.timestamp != None:
+                    self.__last = packet.timestamp
+                key = self.__flow(self.__linktypes[packet.interface], packet.data)
+        if position != None:
+            self.__note(key, position, blockLen)
+        return blockLen
+
+    def __flow(self, linktype, data):
+        ip = packetNetwork(linktype, data)
+        key = packetFlow(data, ip[0], ip[1]) if ip != None else None
+        return key if key != None else FlowIndex.OTHER
+
+    def __note(self, key, position, length):
+        flowId = self.__flowIds.get(key)
+        if flowId == None:
+            flowId = len(self.flows)
+            self.__flowIds[key] = flowId
+            self.flows.append(key)
+        micro = self.__last // 1000
+        bucket = micro // (self.bucketSeconds * 1000000)
+        entryKey = flowId << 32 | bucket
+        entryId = self.__entryIds.get(entryKey)
+        if entryId == None:
+            entryId = len(self.__entryIds)
+            self.__entryIds[entryKey] = entryId
+            self.__entryCounts.append(0)
+        self.__entryCounts[entryId] += 1
+        self.__packetEntries.append(entryId)
+        self.offsets.append(position)
+        self.lengths.append(length)
+        self.times.append(micro - bucket * self.bucketSeconds * 1000000)
+
+    def add(self, records, ends, start, stop, position):
+        """ Notes the records of records[start:stop], which is written at position of the file.
+        ends lists the offsets after every record of records """
+        i = bisect.bisect_right(ends, start)
+        offset = start
+        if self.__format == 'pcapng':
+            while i < len(ends) and ends[i] <= stop:
+                self.__block(records, offset, position + offset - start)
+                offset = ends[i]
+                i = i + 1
+            return
+        record = self.__record
+        linktype = self.__linktype
+        while i < len(ends) and ends[i] <= stop:
+            end = ends[i]
+            sec, frac, caplen, origlen = record.unpack_from(records, offset)
+            self.__last = sec * 1000000000 + frac * self.__scale
+            self.__note(self.__flow(linktype, records[offset + 16:end]), position + offset - start, end - offset)
+            offset = end
+            i = i + 1
+
+    def save(self, path):
+        """ Groups the packets by entry and writes the index to path. The index itself is
+        not changed, so it may be saved from another thread once the file is complete """
+        keys = sorted(self.__entryIds)
+        # The first packet of every entry follows from the counts of the entries sorted before it
+        firsts = array('I', bytes(4 * len(keys)))
+        entries = array('I')
+        first = 0
+        for key in keys:
+            entryId = self.__entryIds[key]
+            count = self.__entryCounts[entryId]
+            firsts[entryId] = first
+            entries.extend((key >> 32, key & 0xffffffff, first, count))
+            first = first + count
+        count = len(self.__packetEntries)
+        offsets = array('Q', bytes(8 * count))
+        lengths = array('I', bytes(4 * count))
+        times = array('I', bytes(4 * count))
+        # Every packet goes to the next free place of its entry, which keeps the file order within the entries
+        for entryId, offset, length, micro in zip(self.__packetEntries, self.offsets, self.lengths, self.times):
+            i = firsts[entryId]
+            firsts[entryId] = i + 1
+            offsets[i] = offset
+            lengths[i] = length
+            times[i] = micro
+        arrays = [ entries, offsets, lengths, times ]
+        if sys.byteorder == 'big':
+            for x in arrays:
+                x.byteswap()
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(FlowIndex.FILE_HEADER.pack(FLOW_INDEX_MAGIC, self.bucketSeconds, self.headerLength, len(self.flows),
+                len(keys), count))
+            f.write(b''.join([ bytes([ len(x) ]) + x for x in self.flows ]))
+            for x in arrays:
+                x.tofile(f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        """ Reads the index written by save(), raises ValueError when path is no flow index """
+        index = FlowIndex()
+        with open(path, 'rb') as f:
+            header = f.read(FlowIndex.FILE_HEADER.size)
+            if len(header) < FlowIndex.FILE_HEADER.size or not header.startswith(FLOW_INDEX_MAGIC):
+                raise ValueError(sprintf("%s is not a flow index", path))
+            magic, index.bucketSeconds, index.headerLength, flowCount, entryCount, packetCount = FlowIndex.FILE_HEADER.unpack(header)
+            for i in range(flowCount):
+                length = f.read(1)[0]
+                index.flows.append(f.read(length))
+            try:
+                index.entries.fromfile(f, 4 * entryCount)
+                index.offsets.fromfile(f, packetCount)
+                index.lengths.fromfile(f, packetCount)
+                index.times.fromfile(f, packetCount)
+            except EOFError:
+                raise ValueError(sprintf("%s is truncated", path))
+        if sys.byteorder == 'big':
+            for x in (index.entries, index.offsets, index.lengths, index.times):
+                x.byteswap()
+        return index
+
+    @staticmethod
+    def flowKey(spec):
+        """ Parses PROTO ADDRESS[:PORT] ADDRESS[:PORT] (IPv6 addresses in brackets when they have
+        a port) into the key of the flow, raises ValueError when it is invalid """
+        fields = spec.split()
+        if len(fields) != 3:
+            raise ValueError(spec)
+        protos = { 'icmp': 1, 'tcp': 6, 'udp': 17, 'icmp6': 58, 'sctp': 132 }
+        proto = protos[fields[0].lower()] if fields[0].lower() in protos else int(fields[0])
+        ends = []
+        for field in fields[1:]:
+            match = re.match(r'^\[(.*)\]:(\d+)$', field) or re.match(r'^([^:]*):(\d+)$', field)
+            address = ip_address(match.group(1) if match != None else field.strip('[]'))
+            end = address.packed
+            if proto in (6, 17, 132):
+                if match == None:
+                    raise ValueError(spec)
+                end = end + struct.pack('>H', int(match.group(2)))
+            ends.append(end)
+        if len(ends[0]) != len(ends[1]) or not 0 <= proto <= 255:
+            raise ValueError(spec)
+        return bytes([ proto ]) + min(ends) + max(ends)
+
+    def select(self, flowKey = None, since = None, until = None):
+        """ Returns the (offset, length) of the records of the flow flowKey (all flows when None)
+        captured between since and until (seconds) in file order, with the pcapng blocks
+        which are not packets """
+        bucketMicros = self.bucketSeconds * 1000000
+        low = round(since * 1000000) if since != None else None
+        high = round(until * 1000000) if until != None else None
+        entryFlows = self.entries[0::4]
+        ranges = [ (0, len(entryFlows)) ]
+        if flowKey != None:
+            # The entries are sorted by flow, those of the flow and of the control blocks are looked up
+            ranges = []
+            for key in (FlowIndex.CONTROL, flowKey):
+                if key in self.flows:
+                    flowId = self.flows.index(key)
+                    ranges.append((bisect.bisect_left(entryFlows, flowId), bisect.bisect_right(entryFlows, flowId)))
+        picked = []
+        for first, last in ranges:
+            for i in range(first, last):
+                flowId, bucket, start, count = self.entries[4 * i:4 * i + 4]
+                control = self.flows[flowId] == FlowIndex.CONTROL
+                if not control and ((low != None and (bucket + 1) * bucketMicros <= low) or (high != None and bucket * bucketMicros > high)):
+                    continue
+                for p in range(start, start + count):
+                    if not control and (low != None or high != None):
+                        micro = bucket * bucketMicros + self.times[p]
+                        if (low != None and micro < low) or (high != None and micro > high):
+                            continue
+                    picked.append((self.offsets[p], self.lengths[p]))
+        picked.sort()
+        return picked
+
+    def extract(self, path, out, flowKey = None, since = None, until = None):
+        """ Writes the file header of the capture file path and the records chosen by select() to
+        out, reading only them. Returns the number of records written """
+        picked = self.select(flowKey, since, until)
+        with open(path, 'rb') as f:
+            out.write(f.read(self.headerLength))
+            i = 0
+            while i < len(picked):
+                # Adjacent records are read at once
+                offset, length = picked[i]
+                i = i + 1
+                while i < len(picked) and picked[i][0] == offset + length:
+                    length = length + picked[i][1]
+                    i = i + 1
+                f.seek(offset)
+                out.write(f.read(length))
+        return len(picked)
+
+class RingFileSink:
+    """ Writes the capture stream into local files rotated by size and/or time
+
+    Writes are collected in memory and handed to the OS in large batches. The
+    files are fsync'd every fsyncInterval seconds from a background thread and
+    the oldest ones are removed once more than maxFiles exist. With flowIndex
+    every file gets a FlowIndex, written next to it by a background thread once
+    the file is closed, so that the relay does not wait for it.
+    The first error writing the files (e.g. a full disk) is kept in error,
+    passed to onError and raised by every following write.
+    """
+    def __init__(self, prefix, rotateSize = None, rotateTime = None, maxFiles = None, fsyncInterval = 5, debug = 0,
+            flowIndex = False, onError = None):
+        for ext in ('.pcapng', '.pcap'):
+            if prefix.endswith(ext):
+                prefix = prefix[:-len(ext)]
+        self.prefix = prefix
+        self.rotateSize = rotateSize
+        self.rotateTime = rotateTime
+        self.maxFiles = maxFiles
+        self.fsyncInterval = fsyncInterval
+        self.debug = debug
+        self.flowIndex = flowIndex
+        self.onError = onError
+        self.error = None
+        self.files = []
+        self.bytes = 0
+        self.__framer = CaptureFramer()
+        self.__fd = None
+        self.__index = None
+        self.__fileSize = 0
+        self.__fileStart = None
+        self.__seq = 0
+        self.__batch = bytearray()
+        self.__lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__flusher = threading.Thread(target=self.__flushLoop, daemon=True)
+        self.__flusher.start()
+        self.__indexQueue = queue.Queue()
+        self.__indexWriter = None
+        if flowIndex:
+            self.__indexWriter = threading.Thread(target=self.__indexLoop, daemon=True)
+            self.__indexWriter.start()
+
+    def __open(self, position):
+        self.__seq = self.__seq + 1
+        ext = '.pcapng' if self.__framer.format == 'pcapng' else '.pcap'
+        name = sprintf('%s_%05d_%s%s', self.prefix, self.__seq, time.strftime('%Y%m%d%H%M%S'), ext)
+        self.__fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        self.__fileStart = time.monotonic()
+        self.__fileSize = 0
+        self.files.append(name)
+        if self.debug > 1:
+            printf("Writing capture to %s\n", name)
+        header = self.__framer.headerAt(position)
+        if self.flowIndex:
+            self.__index = FlowIndex(header)
+        self.__append(header)
+        while self.maxFiles != None and len(self.files) > self.maxFiles:
+            old = self.files.pop(0)
+            if self.debug > 1:
+                printf("Removing oldest capture file %s\n", old)
+            try:
+                os.remove(old)
+                if self.flowIndex and os.path.exists(old + '.idx'):
+                    os.remove(old + '.idx')
+            except OSError as e:
+                printf("Cannot remove %s: %s\n", old, e)
+
+    def __close(self):
+        if self.__fd == None:
+            return
+        try:
+            self.__flush(True)
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+        if self.__index != None:
+            self.__indexQueue.put((self.__index, self.files[-1]))
+            self.__index = None
+
+    def __indexLoop(self):
+        """ Writes the flow indexes of the closed files, ends with None """
+        while True:
+            item = self.__indexQueue.get()
+            if item == None:
+                return
+            index, name = item
+            path = name + '.idx'
+            try:
+                index.save(path)
+                if self.debug > 1:
+                    printf("Wrote flow index %s (%d flows, %d packets)\n", path, len(index.flows), len(index.offsets))
+                # The file may have been rotated out while its index was written
+                if not os.path.exists(name):
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                printf("Cannot write the flow index %s: %s\n", path, e)
+
+    def __appendRecords(self, records, ends, start, stop):
+        """ Appends records[start:stop] and notes them in the flow index """
+        if self.__index != None:
+            self.__index.add(records, ends, start, stop, self.__fileSize)
+        self.__append(records[start:stop])
+
+    def __append(self, data):
+        self.__batch += data
+        self.__fileSize = self.__fileSize + len(data)
+        if len(self.__batch) >= RING_BATCH_SIZE:
+            self.__flush(False)
+
+    def __flush(self, sync):
+        view = memoryview(self.__batch)
+        offset = 0
+        while offset < len(view):
+            offset = offset + os.write(self.__fd, view[offset:])
+        view.release()
+        del self.__batch[:]
+        if sync:
+            os.fsync(self.__fd)
+
+    def __flushLoop(self):
+        while not self.__closed.wait(self.fsyncInterval):
+            with self.__lock:
+                if self.__fd != None and self.error == None:
+                    try:
+                        self.__flush(True)
+                    except OSError as e:
+                        self.__fail(e)
+
+    def __fail(self, error):
+        """ Notes the first error writing the files, the capture cannot be complete after it """
+        if self.error != None:
+            return
+        self.error = error
+        if self.onError != None:
+            self.onError(self, error)
+
+    def write(self, data):
+        """ Consumes a chunk of the capture stream """
+        with self.__lock:
+            if self.error != None:
+                raise self.error
+            if self.__closed.is_set():
+                return len(data)
+            try:
+                self.__write(data)
+            except OSError as e:
+                self.__fail(e)
+                raise
+        return len(data)
+
+    def __write(self, data):
+        self.bytes = self.bytes + len(data)
+        records, ends = self.__framer.feed(data)
+        if len(records) == 0:
+            return
+        position = self.__framer.position - len(records)
+        if self.__fd == None:
+            self.__open(position)
+        elif self.rotateTime != None and time.monotonic() - self.__fileStart >= self.rotateTime:
+            self.__close()
+            self.__open(position)
+
+        view = memoryview(records)
+        start = 0
+        while self.rotateSize != None and self.__fileSize + len(records) - start > self.rotateSize:
+            # Fill the current file up to the last record that still fits,
+            # but always write at least one record into a fresh file
+            idx = bisect.bisect_right(ends, start + self.rotateSize - self.__fileSize)
+            if idx == 0 or ends[idx - 1] <= start:
+                idx = bisect.bisect_right(ends, start) + 1 if self.__fileSize == len(self.__framer.headerAt(position + start)) else 0
+            if idx > 0:
+                self.__appendRecords(view, ends, start, ends[idx - 1])
+                start = ends[idx - 1]
+            if start >= len(records):
+                break
+            self.__close()
+            self.__open(position + start)
+        if start < len(records):
+            self.__appendRecords(view, ends, start, len(records))
+
+    def flush(self):
+        """ Data is flushed on the fsync schedule, not by the producer """
+        return
+
+    def close(self):
+        """ Flushes and closes the current output file """
+        self.__closed.set()
+        with self.__lock:
+            try:
+                self.__close()
+            except OSError as e:
+                self.__fail(e)
+        if self.__indexWriter != None:
+            self.__indexQueue.put(None)
+            self.__indexWriter.join()
+
+class StreamDecoder:
+    """ Decompresses a codec stream received from the remote host
+
+    The local codec binary is preferred as it runs outside of the Python
+    process. Otherwise the optional Python module decodes the stream in a
+    thread into a pipe. In both cases stdout is the decompressed stream.
+    """
+    def __init__(self, codec, src, debug = 0):
+        self.codec = codec
+        self.process = None
+        self.stdout = None
+        self.debug = debug
+
+        if shutil.which(STREAM_CODECS[codec]['decode'][0]) != None:
+            self.process = subprocess.Popen(STREAM_CODECS[codec]['decode'], bufsize=0, stdin=src, stdout=subprocess.PIPE)
+            self.stdout = self.process.stdout
+            if debug > 2:
+                printf("Decoding %s stream with %s\n", codec, STREAM_CODECS[codec]['decode'][0])
+            return
+
+        decompressor = StreamDecoder.moduleDecompressor(codec)
+        readFd, writeFd = os.pipe()
+        self.stdout = os.fdopen(readFd, 'rb', buffering=0)
+        thread = threading.Thread(target=self.__decode, args=(src, decompressor, os.fdopen(writeFd, 'wb', buffering=0)), daemon=True)
+        thread.start()
+        if debug > 2:
+            printf("Decoding %s stream with Python module %s\n", codec, STREAM_CODECS[codec]['module'])
+
+    @staticmethod
+    def moduleDecompressor(codec):
+        """ Returns a streaming decompressor from the optional Python module or None """
+        try:
+            if codec == 'zstd':
+                import zstandard
+                return zstandard.ZstdDecompressor().decompressobj()
+            if codec == 'lz4':
+                import lz4.frame
+                return lz4.frame.LZ4FrameDecompressor()
+        except ImportError:
+            pass
+        return None
+
+    @staticmethod
+    def available(codec):
+        """ Checks whether the codec can be decoded locally """
+        if shutil.which(STREAM_CODECS[codec]['decode'][0]) != None:
+            return True
+        return StreamDecoder.moduleDecompressor(codec) != None
+
+    def __decode(self, src, decompressor, dst):
+        try:
+            while True:
+                data = src.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(decompressor.decompress(data))
+        except Exception as e:
+            if self.debug > 0 and not isinstance(e, BrokenPipeError):
+                printf("Cannot decode %s stream: %s\n", self.codec, e)
+        try:
+            dst.close()
+        except OSError:
+            pass
+
+class PcapWindow:
+    """ Passes only the packets of a pcap stream within a time window
+
+    The records before since are dropped and the stream is ended at the first
+    record after until, or after duration seconds from the first record within
+    the window, at which point onDone is called so the producer can be stopped.
+    Like StreamDecoder, stdout is the resulting stream.
+    """
+    def __init__(self, src, since = None, until = None, onDone = None, debug = 0, duration = None):
+        self.src = src
+        self.since = since
+        self.until = until
+        self.duration = duration
+        self.onDone = onDone
+        self.debug = debug
+        self.packets = 0
+        readFd, writeFd = os.pipe()
+        self.stdout = os.fdopen(readFd, 'rb', buffering=0)
+        self.__dst = os.fdopen(writeFd, 'wb', buffering=0)
+        thread = threading.Thread(target=self.__run, daemon=True)
+        thread.start()
+
+    def __run(self):
+        # The records passed are written at once before each read of src
+        records = []
+        def flush():
+            if len(records) > 0:
+                self.__dst.write(b''.join(records))
+                del records[:]
+        reader = PacketReader(self.src, beforeRead = flush)
+        headerSent = False
+        done = False
+        try:
+            for packet in reader:
+                if not headerSent:
+                    if reader.format != 'pcap':
+                        raise ValueError("Only pcap streams have a time window")
+                    records.append(reader.header)
+                    headerSent = True
+                ts = packet.timestamp / 1e9
+                if self.duration != None and (self.since == None or ts >= self.since):
+                    # The duration counts from the first record within the window
+                    limit = ts + self.duration
+                    self.until = limit if self.until == None else min(self.until, limit)
+                    self.duration = None
+                if self.until != None and ts > self.until:
+                    done = True
+                    break
+                if self.since == None or ts >= self.since:
+                    records.append(reader.record())
+                    self.packets = self.packets + 1
+            flush()
+            if not headerSent and reader.header != None:
+                self.__dst.write(reader.header)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, BrokenPipeError):
+                printf("Cannot apply the time window: %s\n", e)
+            # Nothing more can be passed on, the producer is stopped as well
+            done = True
+        if self.debug > 2:
+            printf("Time window passed %d packets\n", self.packets)
+        try:
+            self.__dst.close()
+        except OSError:
+            pass
+        if done and self.onDone != None:
+            self.onDone()
+
+class WindowLocator:
+    """ Searches an uncompressed pcap file for the byte range of a time window
+
+    The file is only read through read(offsets, length), which returns length
+    bytes at each of the offsets, e.g. in one SSH round trip for a remote file.
+    Every step reads WINDOW_PROBES chunks spread over the remaining range and
+    finds the records in them by three chained record headers.
+    """
+    def __init__(self, size, header, read):
+        """ size of the file, header holds at least its first 40 bytes """
+        self.size = size
+        self.read = read
+        try:
+            self.format, self.endian, scale = PacketReader.fileFormat(header)
+        except ValueError:
+            self.format = None
+        if self.format != 'pcap':
+            return
+        self.fracLimit = 1000000000 // scale
+        self.snaplen = max(struct.unpack_from(self.endian + 'I', header, 16)[0], 262144)
+        self.firstSec = struct.unpack_from(self.endian + 'I', header, 24)[0]
+
+    @staticmethod
+    def forFile(path):
+        """ Returns the locator of a local file """
+        def read(offsets, length):
+            with open(path, 'rb') as f:
+                chunks = []
+                for offset in offsets:
+                    f.seek(offset)
+                    chunks.append(f.read(length))
+                return chunks
+        with open(path, 'rb') as f:
+            header = f.read(40)
+        return WindowLocator(os.path.getsize(path), header, read)
+
+    @staticmethod
+    def syncRecord(chunk, endian, fracLimit, snaplen, firstSec):
+        """ Finds the first offset in chunk where three consecutive valid pcap records
+        (or the records up to the end of chunk) start, returns (offset, timestamp) """
+        recordFmt = endian + 'IIII'
+        chunkLen = len(chunk)
+        for start in range(0, chunkLen - 16):
+            offset = start
+            valid = 0
+            while valid < 3 and offset + 16 <= chunkLen:
+                sec, frac, caplen, origlen = struct.unpack_from(recordFmt, chunk, offset)
+                if frac >= fracLimit or caplen > snaplen or caplen > origlen or origlen > 0x100000 or \
+                        sec < firstSec - 86400 or sec > firstSec + 20 * 365 * 86400:
+                    valid = -1
+                    break
+                valid = valid + 1
+                offset = offset + 16 + caplen
+            if valid >= 2 or (valid == 1 and offset >= chunkLen):
+                sec, frac = struct.unpack_from(endian + 'II', chunk, start)
+                return (start, sec + frac / float(fracLimit))
+        return None
+
+    def __probe(self, offsets):
+        results = []
+        for offset, chunk in zip(offsets, self.read(offsets, WINDOW_PROBE_SIZE)):
+            found = WindowLocator.syncRecord(chunk, self.endian, self.fracLimit, self.snaplen, self.firstSec)
+            results.append(None if found == None else (offset + found[0], found[1]))
+        return results
+
+    def __scan(self, offset, hi, before):
+        """ Walks the records from a known record boundary to the first one not before the boundary,
+        which is at hi at the latest """
+        while offset < self.size:
+            # Up to the header of the record at hi
+            chunk = self.read([ offset ], min(STREAM_CHUNK_SIZE, self.size - offset, hi + 16 - offset))[0]
+            pos = 0
+            while pos + 16 <= len(chunk):
+                sec, frac, caplen = struct.unpack_from(self.endian + 'III', chunk, pos)
+                if not before(sec + frac / float(self.fracLimit)):
+                    return offset + pos
+                if pos + 16 + caplen > len(chunk):
+                    break
+                pos = pos + 16 + caplen
+            if pos == 0:
+                return offset
+            offset = offset + pos
+        return self.size
+
+    def __search(self, before):
+        """ Returns the offset of the first record which is not before the boundary """
+        # Narrows [lo, hi] down, lo is always a record boundary
+        lo = 24
+        hi = self.size
+        while hi - lo > WINDOW_PROBE_SIZE:
+            step = (hi - lo) // (WINDOW_PROBES + 1)
+            offsets = [ min(lo + step * (x + 1), self.size - WINDOW_PROBE_SIZE) for x in range(WINDOW_PROBES) ]
+            progress = False
+            for result in self.__probe(offsets):
+                if result == None:
+                    continue
+                if before(result[1]):
+                    if result[0] > lo:
+                        lo = result[0]
+                        progress = True
+                else:
+                    if result[0] < hi:
+                        hi = result[0]
+                        progress = True
+                    break
+            if not progress:
+                break
+        return self.__scan(lo, hi, before)
+
+    def locate(self, since, until):
+        """ Returns (start, end) offsets of the records within since and until (seconds, None for
+        no limit), end is None for the end of file. None when the file is no pcap file """
+        if self.format != 'pcap':
+            return None
+        start = 24
+        end = None
+        if since != None:
+            start = self.__search(lambda ts: ts < since)
+        if until != None:
+            end = self.__search(lambda ts: ts <= until)
+            if end >= self.size:
+                end = None
+        return (start, end)
+
+class CaptureCache:
+    """ Local content-addressed cache of remote capture files
+
+    Files are stored under the hash of host, path, size, mtime and a hash of
+    the remote file computed on the remote host. A transfer in progress is
+    kept as <key>.part and resumed from its last complete chunk. Access times
+    are tracked by the file mtime and the least recently used files are
+    removed to stay below the size limit.
+    """
+    def __init__(self, directory, sizeLimit, debug = 0):
+        self.directory = directory
+        self.sizeLimit = sizeLimit
+        self.debug = debug
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(login, port, path, size, mtime, remoteHash):
+        """ Returns the cache key of a remote file """
+        data = sprintf('%s:%s|%s|%d|%d|%s', login, port, path, size, mtime, remoteHash)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def path(self, key, remotePath):
+        """ Returns the local path of a complete entry, keeping the extension of the remote file """
+        ext = ''
+        for x in ('.pcapng', '.pcap', '.gz', '.bz2', '.xz', '.zst'):
+            if remotePath.endswith(x):
+                ext = x
+                break
+        return os.path.join(self.directory, key + ext)
+
+    def lookup(self, key, remotePath):
+        """ Returns the local path of a cached file (and marks it as used) or None """
+        path = self.path(key, remotePath)
+        if not os.path.exists(path):
+            return None
+        os.utime(path, None)
+        return path
+
+    def resumeOffset(self, key, remotePath):
+        """ Truncates a partial transfer to its last complete chunk and returns its size """
+        part = self.path(key, remotePath) + '.part'
+        if not os.path.exists(part):
+            return 0
+        offset = os.path.getsize(part) // CACHE_CHUNK_SIZE * CACHE_CHUNK_SIZE
+        with open(part, 'r+b') as f:
+            f.truncate(offset)
+        return offset
+
+    def reserve(self, size, keep = None):
+        """ Removes the least recently used entries until size more bytes fit in the cache """
+        if size > self.sizeLimit:
+            return False
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            total = total + st.st_size
+            if keep == None or not name.startswith(keep):
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        while total + size > self.sizeLimit and len(entries) > 0:
+            mtime, entrySize, path = entries.pop(0)
+            if self.debug > 1:
+                printf("Removing %s from the cache\n", path)
+            try:
+                os.remove(path)
+                total = total - entrySize
+            except OSError:
+                pass
+        return total + size <= self.sizeLimit
+
+    def store(self, key, remotePath, stream, offset, size):
+        """ Appends the stream to the partial entry, syncing every chunk. Returns the
+        local path once the entry is complete, None if the stream ended early """
+        part = self.path(key, remotePath) + '.part'
+        done = offset
+        with open(part, 'ab') as f:
+            while True:
+                data = stream.read(CACHE_CHUNK_SIZE - done % CACHE_CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                done = done + len(data)
+                if done % CACHE_CHUNK_SIZE == 0:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    if self.debug > 0:
+                        printf("Cached %d of %d bytes\r", done, size)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.debug > 0:
+            printf("Cached %d of %d bytes\n", done, size)
+        if done != size:
+            return None
+        path = self.path(key, remotePath)
+        os.replace(part, path)
+        return path
+
+class StreamRelay:
+    """ Forwards the capture stream from the SSH process to its consumer inside remoteShark
+
+    On Linux the data is moved with splice(2) from pipe to pipe without ever
+    being copied into Python. When taps are registered (statistics, tee, etc.)
+    or splice is not available, the stream is read into a single reusable buffer
+    and written out from memoryview slices of it.
+    """
+    def __init__(self, src, dst, bufferSize = STREAM_CHUNK_SIZE, debug = 0):
+        # src and dst are unbuffered file objects (subprocess pipes opened with bufsize=0)
+        self.src = src
+        self.dst = dst
+        self.bufferSize = bufferSize
+        self.debug = debug
+        self.bytes = 0
+        self.firstByteTime = None
+        self.zeroCopy = False
+        self.error = None
+        self.__taps = []
+        self.__thread = None
+
+    def addTap(self, tap):
+        """ Registers a callable receiving a memoryview of every forwarded chunk.
+        The memoryview is only valid during the call. """
+        self.__taps.append(tap)
+
+    @staticmethod
+    def resizePipe(f, size = STREAM_CHUNK_SIZE):
+        """ Resizes a pipe on Linux, a large pipe reduces the number of context switches
+        while a small one keeps less data queued in front of a slow reader """
+        if fcntl == None or platform.system() != 'Linux':
+            return False
+        try:
+            fcntl.fcntl(f.fileno(), F_SETPIPE_SZ, size)
+        except OSError:
+            return False
+        return True
+
+    def __splice(self):
+        srcFd = self.src.fileno()
+        dstFd = self.dst.fileno()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_MORE
+        while True:
+            n = os.splice(srcFd, dstFd, self.bufferSize, flags=flags)
+            if n == 0:
+                return
+            if self.firstByteTime == None:
+                self.firstByteTime = time.time()
+            self.bytes = self.bytes + n
+
+    def __copy(self):
+        buf = bytearray(self.bufferSize)
+        view = memoryview(buf)
+        while True:
+            n = self.src.readinto(view)
+            if not n:
+                return
+            if self.firstByteTime == None:
+                self.firstByteTime = time.time()
+            self.bytes = self.bytes + n
+            chunk = view[:n]
+            for tap in self.__taps:
+                tap(chunk)
+            offset = 0
+            while offset < n:
+                offset = offset + self.dst.write(chunk[offset:])
+
+    def run(self):
+        """ Forwards the stream until the source reaches EOF or the consumer goes away """
+        self.zeroCopy = len(self.__taps) == 0 and hasattr(os, 'splice') and hasattr(self.dst, 'fileno')
+        if self.debug > 2:
+            printf("Relaying the capture stream using %s\n", "splice" if self.zeroCopy else "a reusable buffer")
+        try:
+            if self.zeroCopy:
+                try:
+                    self.__splice()
+                except OSError as e:
+                    # splice refuses some descriptors (e.g. sockets on older kernels)
+                    if self.bytes > 0:
+                        raise
+                    if self.debug > 2:
+                        printf("splice is not usable (%s), falling back to buffered relay\n", e)
+                    self.zeroCopy = False
+                    self.__copy()
+            else:
+                self.__copy()
+        except (BrokenPipeError, ValueError):
+            if self.debug > 3:
+                printf("Relay consumer closed the stream\n")
+        except OSError as e:
+            if e.errno in (errno.EPIPE, errno.EINVAL):
+                # A closed pipe on Windows
+                if self.debug > 3:
+                    printf("Relay consumer closed the stream\n")
+            else:
+                self.error = e
+                # The errors of the output files are reported through their onError
+                if getattr(self.dst, 'error', None) is not e:
+                    printf("Cannot relay the capture stream: %s\n", e)
+        try:
+            self.dst.close()
+        except OSError:
+            pass
+
+    def start(self):
+        """ Runs the relay in a background thread """
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def join(self, timeout = None):
+        """ Waits for the relay to drain the remaining data """
+        if self.__thread != None:
+            self.__thread.join(timeout)
+
+class TeeQueue:
+    """ Bounded queue feeding one consumer of a StreamTee from its own thread
+
+    When the consumer falls more than limit bytes behind, the drop policy
+    discards whole chunks of records (keeping the pcapng blocks which later
+    packets refer to) and the spill policy appends the stream to a temporary
+    file, which is read back in order once the consumer has caught up.
+    """
+    def __init__(self, name, out, policy = 'drop', limit = TEE_QUEUE_SIZE, debug = 0):
+        self.name = name
+        self.out = out
+        self.policy = policy
+        self.limit = limit
+        self.debug = debug
+        self.bytes = 0
+        self.droppedPackets = 0
+        self.droppedBytes = 0
+        self.spilledBytes = 0
+        self.closed = False
+        self.__queue = deque()
+        self.__queued = 0
+        self.__spill = None
+        self.__spillRead = 0
+        self.__spillWrite = 0
+        self.__ended = False
+        self.__cond = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def put(self, data, packets = 0, essential = None):
+        """ Queues a chunk of complete records holding packets packets. A chunk without
+        packets is never dropped, essential returns the part of a dropped chunk to keep """
+        with self.__cond:
+            if self.closed or self.__ended:
+                return
+            if self.__spillWrite > self.__spillRead:
+                # Keep the order, everything goes behind the spilled data
+                self.__spillAppend(data)
+                return
+            # A chunk larger than the limit still goes into an empty queue
+            if packets > 0 and self.__queued > 0 and self.__queued + len(data) > self.limit:
+                if self.policy == 'spill':
+                    self.__spillAppend(data)
+                    self.__cond.notify()
+                    return
+                kept = essential() if essential != None else b''
+                self.droppedPackets = self.droppedPackets + packets
+                self.droppedBytes = self.droppedBytes + len(data) - len(kept)
+                data = kept
+                if len(data) == 0:
+                    return
+            self.__queue.append(data)
+            self.__queued = self.__queued + len(data)
+            self.__cond.notify()
+
+    def __spillAppend(self, data):
+        if self.__spill == None:
+            self.__spill = tempfile.TemporaryFile(prefix='remoteShark-spill-')
+            if self.debug > 1:
+                printf("Consumer %s fell behind, spilling its stream to disk\n", self.name)
+        self.__spill.seek(self.__spillWrite)
+        self.__spill.write(data)
+        self.__spillWrite = self.__spillWrite + len(data)
+        self.spilledBytes = self.spilledBytes + len(data)
+
+    def __next(self):
+        """ Returns the next chunk for the consumer or None at the end of the stream """
+        with self.__cond:
+            while True:
+                if len(self.__queue) > 0:
+                    data = self.__queue.popleft()
+                    self.__queued = self.__queued - len(data)
+                    return data
+                if self.__spillWrite > self.__spillRead:
+                    self.__spill.seek(self.__spillRead)
+                    data = self.__spill.read(min(STREAM_CHUNK_SIZE, self.__spillWrite - self.__spillRead))
+                    self.__spillRead = self.__spillRead + len(data)
+                    if self.__spillRead == self.__spillWrite:
+                        # Caught up, the file is reused by the next spill
+                        self.__spill.truncate(0)
+                        self.__spillRead = 0
+                        self.__spillWrite = 0
+                    return data
+                if self.__ended:
+                    return None
+                self.__cond.wait()
+
+    def __run(self):
+        while True:
+            data = self.__next()
+            if data == None:
+                break
+            try:
+                view = memoryview(data)
+                offset = 0
+                while offset < len(view):
+                    offset = offset + self.out.write(view[offset:])
+                self.bytes = self.bytes + len(data)
+            except (OSError, ValueError):
+                if self.debug > 0:
+                    printf("Consumer %s closed the stream\n", self.name)
+                with self.__cond:
+                    self.closed = True
+                    self.__queue.clear()
+                    self.__queued = 0
+                break
+        try:
+            self.out.close()
+        except OSError:
+            pass
+        with self.__cond:
+            if self.__spill != None:
+                self.__spill.close()
+                self.__spill = None
+                self.__spillWrite = self.__spillRead = 0
+
+    def end(self):
+        """ Lets the consumer finish its queue and closes it """
+        with self.__cond:
+            self.__ended = True
+            self.__cond.notify()
+
+    def join(self, timeout = None):
+        """ Waits for the consumer to finish, returns False if it did not in time """
+        self.__thread.join(timeout)
+        return not self.__thread.is_alive()
+
+class StreamTee:
+    """ Copies the capture stream to several local consumers (Wireshark, files, commands)
+
+    Every consumer is fed by its own TeeQueue, so a slow one only loses or
+    spills its own data and holds back neither the others nor the remote
+    tcpdump. The stream is split on record boundaries, so that dropping never
+    leaves a partial record behind. It is written to like a file.
+    """
+    def __init__(self, debug = 0):
+        self.debug = debug
+        self.consumers = []
+        self.bytes = 0
+        self.__framer = CaptureFramer()
+        self.__headerSent = False
+
+    def add(self, name, out, policy = 'drop', limit = TEE_QUEUE_SIZE):
+        """ Adds a consumer writing to the file object out """
+        consumer = TeeQueue(name, out, policy, limit, self.debug)
+        self.consumers.append(consumer)
+        return consumer
+
+    @staticmethod
+    def __pcapngBlocks(records, ends):
+        """ Returns (packet count, callable returning the blocks which are not packets) of pcapng records """
+        start = 0
+        packets = 0
+        others = []
+        for end in ends:
+            blockType = struct.unpack_from('<I', records, start)[0]
+            # Enhanced, simple and obsolete packet blocks, written little-endian by PcapMerger
+            if blockType in (PCAPNG_EPB, 3, 2):
+                packets = packets + 1
+            else:
+                others.append((start, end))
+            start = end
+        return (packets, lambda: b''.join([ records[x:y] for x, y in others ]))
+
+    def write(self, data):
+        """ Consumes a chunk of the capture stream """
+        self.bytes = self.bytes + len(data)
+        records, ends = self.__framer.feed(data)
+        if not self.__headerSent and len(self.__framer.header) > 0:
+            for consumer in self.consumers:
+                consumer.put(self.__framer.header)
+            self.__headerSent = True
+        if len(records) == 0:
+            return len(data)
+        if self.__framer.format == 'pcapng':
+            packets, essential = StreamTee.__pcapngBlocks(records, ends)
+        else:
+            packets, essential = len(ends), None
+        for consumer in self.consumers:
+            consumer.put(records, packets, essential)
+        return len(data)
+
+    def flush(self):
+        """ Every consumer is flushed by its own queue """
+        return
+
+    def close(self):
+        """ Ends the stream, the consumers are closed once they have caught up """
+        for consumer in self.consumers:
+            consumer.end()
+
+    def join(self, timeout = None):
+        """ Waits for the consumers to catch up, returns False if some did not in time """
+        deadline = None if timeout == None else time.time() + timeout
+        done = [ x.join(None if deadline == None else max(0, deadline - time.time())) for x in self.consumers ]
+        return False not in done
+
+class SessionJoiner:
+    """ Joins the pcap streams of consecutive capture sessions into one continuous stream
+
+    Only complete records are forwarded, so a session cut in the middle of a
+    packet leaves no partial record behind. The file header of the first
+    session is passed on, the headers of the following sessions are checked
+    against it and dropped.
+    """
+    def __init__(self, out, debug = 0):
+        self.out = out
+        self.debug = debug
+        self.header = None
+        self.packets = 0
+        self.bytes = 0
+        # Timestamp of the last forwarded packet in seconds
+        self.lastTimestamp = None
+        self.__endian = None
+        self.__scale = None
+
+    def __write(self, data):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            offset = offset + self.out.write(view[offset:])
+        self.out.flush()
+        self.bytes = self.bytes + len(data)
+
+    def __timestamp(self, records, offset):
+        sec, frac = struct.unpack_from(self.__endian + 'II', records, offset)
+        return (sec * 1000000000 + frac * self.__scale) / 1e9
+
+    def relay(self, stream, onStart = None):
+        """ Forwards one session until its stream ends. onStart is called once the
+        session delivered its file header. Returns the number of forwarded packets """
+        framer = CaptureFramer()
+        started = False
+        packets = 0
+        while True:
+            data = stream.read1(STREAM_CHUNK_SIZE) if hasattr(stream, 'read1') else stream.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            records, ends = framer.feed(data)
+            if not started and len(framer.header) > 0:
+                if framer.format != 'pcap':
+                    raise ValueError("Only pcap streams can be joined")
+                if self.header == None:
+                    self.header = framer.header
+                    captureFormat, self.__endian, self.__scale = PacketReader.fileFormat(self.header)
+                    self.__write(self.header)
+                elif framer.header[:4] != self.header[:4] or framer.header[16:24] != self.header[16:24]:
+                    raise ValueError("The capture format changed between sessions")
+                started = True
+                if onStart != None:
+                    onStart()
+            if len(ends) > 0:
+                self.lastTimestamp = self.__timestamp(records, ends[-2] if len(ends) > 1 else 0)
+                self.packets = self.packets + len(ends)
+                packets = packets + len(ends)
+                self.__write(records)
+        return packets
+
+class TcpdumpStats:
+    """ Follows the stderr of a remote tcpdump and keeps its latest packet counters
+
+    tcpdump prints its counters when it receives SIGUSR1, which a loop of the
+    remote command sends every interval, and when it exits. The remote
+    helper reducing the capture reports its own counters, kept in reduction.
+    Any other line is kept as the last error message.
+    """
+    COUNTERS = re.compile(r'(\d+) packets? (captured|received by filter|dropped by kernel|dropped by interface)')
+
+    def __init__(self, stream, debug = 0):
+        self.debug = debug
+        self.captured = None
+        self.received = None
+        self.dropped = None
+        self.ifdropped = None
+        self.reduction = None
+        self.lastLine = ''
+        self.__thread = threading.Thread(target=self.__run, args=(stream,), daemon=True)
+        self.__thread.start()
+
+    def __run(self, stream):
+        try:
+            for line in stream:
+                line = line.decode(errors='replace').strip()
+                if line.startswith('remoteShark::reduce '):
+                    self.reduction = dict([ (x.split('=')[0], int(x.split('=')[1])) for x in line.split()[1:] ])
+                    continue
+                counters = TcpdumpStats.COUNTERS.findall(line)
+                if len(counters) == 0:
+                    if len(line) > 0:
+                        self.lastLine = line
+                        if self.debug > 2:
+                            printf("Remote: %s\n", line)
+                    continue
+                for value, name in counters:
+                    if name == 'captured':
+                        self.captured = int(value)
+                    elif name == 'received by filter':
+                        self.received = int(value)
+                    elif name == 'dropped by kernel':
+                        self.dropped = int(value)
+                    else:
+                        self.ifdropped = int(value)
+        except (OSError, ValueError):
+            pass
+
+    def join(self, timeout = None):
+        """ Waits until the whole stderr has been read """
+        self.__thread.join(timeout)
+
+class CaptureTelemetry:
+    """ Periodically reports throughput, packet rate, remote drops and local pipe backlog
+
+    Every sample is printed as one line and optionally appended to a JSON lines
+    file and/or written to a Prometheus text file (replaced atomically, as
+    expected by the node_exporter textfile collector).
+    """
+    def __init__(self, interval, jsonFile = None, promFile = None, debug = 0):
+        self.interval = interval
+        self.jsonFile = jsonFile
+        self.promFile = promFile
+        self.debug = debug
+        # Callables returning the number of packets and bytes delivered so far
+        self.packets = None
+        self.streamBytes = None
+        self.linkBytes = None
+        self.__pipes = []
+        self.__remote = {}
+        self.__last = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def addPipe(self, name, getter):
+        """ Reports the backlog of the pipe returned by getter """
+        self.__pipes.append((name, getter))
+
+    def setRemote(self, host, stats):
+        """ Reports the counters of the remote tcpdump of host (a TcpdumpStats) """
+        self.__remote[host] = stats
+
+    @staticmethod
+    def backlog(f):
+        """ Returns the number of bytes waiting in a pipe or None """
+        if f == None or termios == None:
+            return None
+        try:
+            buf = fcntl.ioctl(f.fileno(), termios.FIONREAD, b'\x00\x00\x00\x00')
+        except (OSError, ValueError):
+            return None
+        return struct.unpack('i', buf)[0]
+
+    @staticmethod
+    def __count(getter):
+        return getter() if getter != None else None
+
+    def sample(self):
+        """ Takes one sample and reports it """
+        now = time.time()
+        data = { 'time': now, 'packets': self.__count(self.packets), 'streamBytes': self.__count(self.streamBytes),
+            'linkBytes': self.__count(self.linkBytes) }
+        if data['linkBytes'] == None:
+            data['linkBytes'] = data['streamBytes']
+        for name in ('packets', 'streamBytes', 'linkBytes'):
+            rate = None
+            if self.__last != None and data[name] != None and now > self.__last['time']:
+                rate = (data[name] - self.__last[name]) / (now - self.__last['time'])
+            data[name + 'PerSecond'] = rate
+        data['remote'] = {}
+        for host, stats in self.__remote.items():
+            data['remote'][host] = { 'captured': stats.captured, 'received': stats.received,
+                'dropped': stats.dropped, 'ifdropped': stats.ifdropped, 'reduction': stats.reduction }
+        data['backlog'] = {}
+        for name, getter in self.__pipes:
+            data['backlog'][name] = CaptureTelemetry.backlog(getter())
+        self.__last = data
+
+        self.__print(data)
+        if self.jsonFile != None:
+            try:
+                with open(self.jsonFile, 'a') as f:
+                    f.write(json.dumps(data) + '\n')
+            except OSError as e:
+                printf("Cannot write the statistics to %s: %s\n", self.jsonFile, e)
+        if self.promFile != None:
+            self.__writeProm(data)
+        return data
+
+    @staticmethod
+    def formatSize(value):
+        """ Formats a number of bytes with a binary unit, - for None """
+        if value == None:
+            return '-'
+        for unit in ('B', 'KiB', 'MiB'):
+            if abs(value) < 1024:
+                return sprintf('%.1f %s', value, unit)
+            value = value / 1024.0
+        return sprintf('%.1f GiB', value)
+
+    def __print(self, data):
+        line = sprintf('%s/s %s pkt/s link %s/s', self.formatSize(data['streamBytesPerSecond']),
+            '-' if data['packetsPerSecond'] == None else sprintf('%.0f', data['packetsPerSecond']),
+            self.formatSize(data['linkBytesPerSecond']))
+        for host, remote in data['remote'].items():
+            line = sprintf('%s | %s dropped %s kernel %s interface', line, host,
+                '-' if remote['dropped'] == None else remote['dropped'],
+                '-' if remote['ifdropped'] == None else remote['ifdropped'])
+            if remote['reduction'] != None:
+                line = sprintf('%s kept %d/%d', line, remote['reduction']['kept'], remote['reduction']['seen'])
+        for name, value in data['backlog'].items():
+            line = sprintf('%s | %s backlog %s', line, name, self.formatSize(value))
+        printf("[stats] %s\n", line)
+
+    def __writeProm(self, data):
+        lines = []
+        def metric(name, kind, helpText, samples):
+            samples = [ x for x in samples if x[1] != None ]
+            if len(samples) == 0:
+                return
+            lines.append(sprintf('# HELP remoteshark_%s %s', name, helpText))
+            lines.append(sprintf('# TYPE remoteshark_%s %s', name, kind))
+            for labels, value in samples:
+                lines.append(sprintf('remoteshark_%s%s %s', name, labels, value))
+        metric('packets_total', 'counter', 'Packets delivered to the consumer', [ ('', data['packets']) ])
+        metric('stream_bytes_total', 'counter', 'Bytes of the capture stream delivered to the consumer', [ ('', data['streamBytes']) ])
+        metric('link_bytes_total', 'counter', 'Bytes received from SSH', [ ('', data['linkBytes']) ])
+        for name, key, helpText in (('remote_packets_captured', 'captured', 'Packets captured by the remote tcpdump'),
+                ('remote_packets_received', 'received', 'Packets received by the filter of the remote tcpdump'),
+                ('remote_packets_dropped_kernel', 'dropped', 'Packets dropped by the remote kernel'),
+                ('remote_packets_dropped_interface', 'ifdropped', 'Packets dropped by the remote interface')):
+            metric(name, 'gauge', helpText, [ (sprintf('{host="%s"}', host), x[key]) for host, x in data['remote'].items() ])
+        reduced = [ (host, x['reduction']) for host, x in data['remote'].items() if x['reduction'] != None ]
+        metric('remote_packets_seen', 'gauge', 'Packets seen by the remote helper before the reduction',
+            [ (sprintf('{host="%s"}', host), x['seen']) for host, x in reduced ])
+        metric('remote_packets_reduced', 'gauge', 'Packets removed by the remote helper',
+            [ (sprintf('{host="%s",reason="%s"}', host, reason), x[key]) for host, x in reduced
+                for reason, key in (('sample', 'sampled'), ('flow_sample', 'flows'), ('rate_limit', 'limited')) ])
+        metric('pipe_backlog_bytes', 'gauge', 'Bytes waiting in a local pipe',
+            [ (sprintf('{pipe="%s"}', name), value) for name, value in data['backlog'].items() ])
+        try:
+            tmp = self.promFile + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp, self.promFile)
+        except OSError as e:
+            printf("Cannot write the statistics to %s: %s\n", self.promFile, e)
+
+    def __run(self):
+        while True:
+            if self.__stop.wait(self.interval):
+                break
+            self.sample()
+
+    def start(self):
+        """ Starts sampling in a background thread """
+        self.__last = { 'time': time.time(), 'packets': 0, 'streamBytes': 0, 'linkBytes': 0 }
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """ Stops sampling and reports the final sample """
+        self.__stop.set()
+        self.sample()
+
+class ProcessSupervisor:
+    """ Waits for child processes and worker threads to finish without polling
+
+    On Linux every child is watched through a pidfd in a selector, so its exit
+    wakes up the waiting thread immediately. Where pidfds are not available
+    (other systems, Python < 3.9) a helper thread waits for the child and
+    wakes up the selector through a socket pair. Signal handlers interrupt
+    the wait as usual.
+    """
+    def __init__(self, debug = 0):
+        self.debug = debug
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeRead, self.__wakeWrite = socket.socketpair()
+        self.__wakeRead.setblocking(False)
+        self.__wakeWrite.setblocking(False)
+        self.__selector.register(self.__wakeRead, selectors.EVENT_READ, None)
+        self.__exited = deque()
+        self.__lock = threading.Lock()
+
+    def watch(self, process, name):
+        """ Reports name from wait() once the process has exited """
+        if hasattr(os, 'pidfd_open') and process.poll() == None:
+            try:
+                fd = os.pidfd_open(process.pid)
+                self.__selector.register(fd, selectors.EVENT_READ, (name, process))
+                return
+            except OSError:
+                pass
+        self.__watchWith(process.wait, name)
+
+    def watchThread(self, thread, name):
+        """ Reports name from wait() once the thread has finished """
+        self.__watchWith(thread.join, name)
+
+    def __watchWith(self, wait, name):
+        def waiter():
+            wait()
+            with self.__lock:
+                self.__exited.append(name)
+            try:
+                self.__wakeWrite.send(b'\x00')
+            except OSError:
+                pass
+        threading.Thread(target=waiter, daemon=True).start()
+
+    def wait(self, timeout = None):
+        """ Returns the name of the next finished process or thread, None on timeout """
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                if len(self.__exited) > 0:
+                    return self.__exited.popleft()
+            remaining = None
+            if deadline != None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            for key, mask in self.__selector.select(remaining):
+                if key.data == None:
+                    try:
+                        self.__wakeRead.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                name, process = key.data
+                self.__selector.unregister(key.fd)
+                os.close(key.fd)
+                # Reap the child right away, it is known to have exited
+                process.poll()
+                with self.__lock:
+                    self.__exited.append(name)
+
+    @staticmethod
+    def stop(processes, grace = 2.0, debug = 0):
+        """ Terminates the processes, killing the ones still running after grace seconds """
+        running = [ p for p in processes if p != None and p.poll() == None ]
+        for p in running:
+            if debug > 3:
+                printf("Stopping process %d\n", p.pid)
+            try:
+                p.terminate()
+            except OSError:
+                pass
+        deadline = time.monotonic() + grace
+        for p in running:
+            try:
+                p.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                if debug > 3:
+                    printf("Killing process %d\n", p.pid)
+                p.kill()
+                p.wait()
+
+class RemoteShark:
+    platform = None
+    cfg = None
+
+    __sshProcess = None
+    __plinkProcess = None
+    __wireProcess = None
+    __hostProcesses = []
+    __relay = None
+    __sink = None
+    __sinkError = None
+    __counter = None
+    __sessions = {}
+    __decoderProcesses = []
+    __stopping = None
+    __openGap = None
+    __telemetry = None
+    __remoteStats = {}
+    __linkRelays = []
+    __codecs = {}
+    __fileFormats = {}
+    __capabilities = {}
+    __knownHosts = None
+    __capabilityLock = threading.Lock()
+    __tee = None
+    __teeProcesses = []
+
+    __starTime = None
+
+    def __init__(self, config = None):
+        """ config is an AppConfig, by default the one of the command line """
+        self.platform = platform.system()
+        self.cfg = config if config != None else cfg
+        self.__hostProcesses = []
+        self.__sessions = {}
+        self.__decoderProcesses = []
+        self.__stopping = threading.Event()
+        self.__remoteStats = {}
+        self.__linkRelays = []
+        self.__codecs = {}
+        self.__fileFormats = {}
+        self.__capabilities = {}
+        self.__knownHosts = None
+        self.__teeProcesses = []
+        
+        if self.cfg.debug >= 2:
+            printf("Detected platform '%s'\n", self.platform)
     
     def printHelp(self):
         """ Print usage information for the utility """
-        helpData = """Usage: remoteShark.py [OPTIONS] host
+        helpData = """Usage: remoteShark.py [OPTIONS] host [host ...]
+     --cache             Keeps remote capture files in a local cache, so that
+                         opening them again does not transfer them again
+     --cache-dir         Directory of the cache (implies --cache)
+     --cache-size        Size limit of the cache in MiB (default 4096), the least
+                         recently used files are removed first
  -c  --count             Stop capture after receiving count packets
  -C  --compression       Enables compression
+     --codec             Compresses the capture on the remote host with zstd or
+                         lz4 instead of SSH compression. "auto" picks the best
+                         codec available on both ends and falls back to SSH
+                         compression. Codecs buffer data, which adds latency
+                         on quiet links
+     --codec-level       Compression level of the codec (default 1)
+     --capability-ttl    Seconds the probed capabilities and interfaces of a remote
+                         host are cached (default 3600)
+     --control-persist   Seconds an idle shared SSH connection is kept open
+                         after remoteShark exits (default 600)
      --no-compression    Disables compression
  -d  --debug             Enables debug mode
+     --duration          Ends a live capture the given seconds after its first
+                         packet, measured on the packet timestamps
  -f  --filter            Filters which packets will be captured. For filter
                          syntax see pcap-filter(7) man page on a Linux system.
                          Default filter is "not port 22".
@@ -303,90 +3583,287 @@ class RemoteShark:
                          "(__FILTER__) or ( ip[6:2] & 0x3fff != 0x0000 )" in
                          order to enforce capturing of fragmented UDP packets
  -h  --help              Prints the current help message
+     --merge-delay       Seconds a multi-host capture waits for a silent host
+                         before writing packets of the others (default 0.25)
      --list-interfaces   Connects to the remote host and lists interfaces
                          available for capturing traffic
- -i  --interface         Remote interface to listen on (default any)
+ -H  --headers-only      Captures only the link, IP and transport headers. The
+                         original packet lengths are preserved
+ -i  --interface         Remote interface to listen on (default any). Several
+                         interfaces (eth0,eth1) or a glob (eth*) are captured in
+                         parallel by one tcpdump each and merged into one pcapng
+                         stream with an interface per NIC
+     --no-multiplex      Opens a new SSH connection for every remote command
+                         instead of sharing one connection per host
+ -o  --output            Writes the capture to local files starting with the given
+                         prefix instead of launching Wireshark (headless mode)
+     --rotate-size       Starts a new output file after the given size in MiB
+     --rotate-time       Starts a new output file after the given seconds
+     --max-files         Deletes the oldest output files above this count
+     --fsync-interval    Seconds between flushing output files to disk (default 5)
+     --flow-index        Writes a flow index next to every output file (FILE.idx),
+                         which --extract uses to find packets without a scan
+     --extract           Writes the packets of a local capture file selected by
+                         --flow, --since and --until into -o (- for STDOUT),
+                         found by its flow index. No host is needed
+     --flow              Flow to extract: "PROTO ADDRESS:PORT ADDRESS:PORT", both
+                         directions, e.g. "tcp 10.0.0.1:443 10.0.0.2:50000" or
+                         "udp [2001:db8::1]:53 [2001:db8::2]:40000"
  -p  --port              SSH port to connect to
- -t  --timeout           Stop capture after timeout has expired
+     --profile           Tunes the capture for latency, throughput or balanced
+                         (default): the tcpdump buffer and flushing, the SSH QoS
+                         class and the local pipe sizes. latency delivers every
+                         packet at once, throughput uses a 64 MiB capture buffer
+                         and batched delivery to drop less under load
+     --rate-limit        Caps the capture of every remote tcpdump at the given
+                         bytes/s (k, M, G suffixes) on the remote host. Live
+                         packets above it are dropped, files are sent slower
+     --refresh-tools     Detects ssh, Wireshark and the capabilities of the remote
+                         hosts again instead of using the cached results
+     --relay             Forwards the capture from SSH to Wireshark through
+                         remoteShark (zero-copy on Linux) instead of a direct pipe
+     --reconnect         Reconnects with backoff when the SSH session of a live
+                         capture is lost and continues the same capture
+     --reconnect-max     Gives up after the given number of failed reconnection
+                         attempts (implies --reconnect, default 0 - never)
+     --gap-log           File recording the outages of --reconnect as JSON lines
+                         (default <output>.gaps or remoteShark-<host>-<time>.gaps)
+     --sample            Keeps only every Nth packet, selected on the remote host
+     --flow-sample       Keeps only the packets of one in N flows (5-tuple, both
+                         directions), selected on the remote host. Reducing the
+                         capture needs python3 there, the kept share is reported
+     --since             Loads only packets of a remote file (or of --extract)
+                         captured at or after the given time (UNIX timestamp or
+                         YYYY-MM-DD HH:MM:SS)
+ -s  --snaplen           Bytes captured from each packet (default 0 - whole packet)
+     --ssh-path          Path of the ssh (plink on Windows) binary to use
+     --start-at          Passes on only the packets of a live capture stamped at or
+                         after the given time (UNIX timestamp or YYYY-MM-DD HH:MM:SS)
+     --stats             Prints the throughput, packet rate, drops of the remote
+                         kernel and the local pipe backlog every given seconds.
+                         The stream passes through remoteShark (see --relay)
+     --stats-json        Appends the statistics as JSON lines to the given file
+                         (implies --stats 10)
+     --stats-prom        Writes the statistics into the given Prometheus text
+                         file, e.g. for the node_exporter textfile collector
+     --stop-at           Ends a live capture at the first packet stamped after the
+                         given time. The window is cut on the remote host, which
+                         stops tcpdump at its end (needs python3 there, otherwise
+                         it is cut locally)
+     --summary           Aggregates the capture on the remote host into reports of
+                         the given seconds (protocol mix, top flows and talkers by
+                         bytes), shown as a live table. Only the reports are sent,
+                         which needs python3 there
+     --summary-json      Appends the reports as JSON lines to the given file, - for
+                         STDOUT (implies --summary 10)
+     --summary-top       Number of flows and talkers in a report (default 10)
+ -t  --timeout           Stop capture after timeout has expired (approximately,
+                         --duration is exact)
+     --tee               Also feeds the capture to file:PREFIX (output files, rotated
+                         like -o) or cmd:COMMAND (STDIN of a shell command), may be
+                         repeated. Every consumer has its own queue: when it falls
+                         behind, drop: discards packets (default for Wireshark and
+                         commands) and spill: buffers them in a temporary file
+                         (default for files), e.g. --tee spill:cmd:"tshark -r -"
+     --tee-queue         Size of the queue of every consumer in MiB (default 64)
  -u  --user              SSH user to connect as (default root)
+     --until             Loads only packets of a remote file captured at or before
+                         the given time. Uncompressed files are searched on the
+                         remote host, so only the requested part is transferred
  -w  --wireshark-filter  Configures Wireshark's display filter
+     --wireshark-path    Path of the Wireshark binary to use
+
+ When several hosts are given, they are captured in parallel and merged by
+ timestamp into a single pcapng stream with one interface per host.
+
+ host:/path/file loads a remote capture file. Several files (host:/a.pcap,/b.pcap)
+ or a glob (host:'/var/tmp/capture_*.pcap.gz'), e.g. rotated captures, are merged
+ by timestamp on the remote host, which needs python3 for it.
 
     """
         printf("%s\n", helpData)
         return
 
-    def detectRequirement(self):
-        """ Detect plink/ssh and wireshark availability and capabilities """
+    def hostKeyCached(self, host):
+        """ Checks whether PuTTY knows the host key of host, so that connecting to it cannot prompt """
+        if winreg == None:
+            return False
+        suffix = sprintf('@%s:%s', self.cfg.sshPort, host)
+        try:
+            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\SimonTatham\PuTTY\SshHostKeys') as key:
+                i = 0
+                while True:
+                    if winreg.EnumValue(key, i)[0].endswith(suffix):
+                        return True
+                    i = i + 1
+        except OSError:
+            # The key does not exist or has no more values
+            return False
+
+    def __prepareHost(self, host, test = False):
+        """ Connection test (with plink), capability probe and shared SSH connection of one host """
+        if test:
+            self.testConnection(host)
+        # The probe is the first command on the host, a failure means ssh could not resolve or reach it
+        if self.hostCapabilities(host) == None:
+            raise OSError(sprintf("Cannot connect to %s", host))
+        self.openSession(host, self.sshCompression(self.selectCodec(host)))
+
+    def startup(self, wireshark = True):
+        """ Detects the tools, then prepares all hosts concurrently: the connection test with
+        plink, the capability probe, the shared SSH connection and the codec probe. ssh resolves
+        the host names itself. Only the plink hosts whose key is not cached yet are tested one
+        by one on the main thread, as they may prompt for it. Returns False when the tools are
+        missing and raises OSError when a host cannot be reached or lacks a required tool """
+        hosts = [ self.cfg.sshHost ] + [ x[0] for x in self.cfg.extraHosts ]
+        start = time.time()
+        if not self.detectRequirement(wireshark):
+            return False
+        with ThreadPoolExecutor(max_workers = len(hosts)) as pool:
+            # The host key prompt needs the console and Ctrl+C, so it stays on the main thread
+            prompting = []
+            if self.platform == 'Windows':
+                prompting = [ x for x in hosts if not self.hostKeyCached(x) ]
+            connecting = [ pool.submit(self.__prepareHost, x, self.platform == 'Windows') for x in hosts if x not in prompting ]
+            for host in prompting:
+                self.testConnection(host)
+                connecting.append(pool.submit(self.__prepareHost, host))
+            for x in connecting:
+                x.result()
+        if self.describeReduction() != None or self.cfg.summary != None:
+            for host in hosts:
+                capabilities = self.hostCapabilities(host)
+                if capabilities != None and 'python3' not in capabilities['commands']:
+                    raise OSError(sprintf("--sample, --flow-sample, --rate-limit and --summary require python3 on %s", host))
+        if self.cfg.debug > 1:
+            printf("Startup took %.3f seconds\n", time.time() - start)
+        return True
+
+    def detectRequirement(self, wireshark = True):
+        """ Detect plink/ssh and wireshark availability and capabilities. Wireshark is
+        not needed when wireshark is False, for headless captures and for listing interfaces """
         global WIN_WIRESHARK_PATH
         global WIN_PLINK_PATH
-        global cfg
 
         WIRESHARK_FOUND = False
         PLINK_FOUND = False
+
+        # Paths given by --ssh-path and --wireshark-path are used as they are
+        sshPath = self.cfg.plinkPath
+        wiresharkPath = self.cfg.wiresharkPath
         
         if self.platform == 'Windows':
             if os.path.exists(os.environ["ProgramFiles"] + WIN_WIRESHARK_PATH):
-                cfg.wiresharkPath = os.environ["ProgramFiles"] + WIN_WIRESHARK_PATH
+                self.cfg.wiresharkPath = os.environ["ProgramFiles"] + WIN_WIRESHARK_PATH
                 WIRESHARK_FOUND = True
     
             if os.path.exists(os.environ["ProgramFiles(x86)"] + WIN_WIRESHARK_PATH):
-                cfg.wiresharkPath = os.environ["ProgramFiles(x86)"] + WIN_WIRESHARK_PATH
+                self.cfg.wiresharkPath = os.environ["ProgramFiles(x86)"] + WIN_WIRESHARK_PATH
                 WIRESHARK_FOUND = True
     
             if os.path.exists(os.environ["ProgramFiles"] + WIN_PLINK_PATH):
-                cfg.plinkPath = os.environ["ProgramFiles"] + WIN_PLINK_PATH
+                self.cfg.plinkPath = os.environ["ProgramFiles"] + WIN_PLINK_PATH
                 PLINK_FOUND = True
     
             if os.path.exists(os.environ["ProgramFiles(x86)"] + WIN_PLINK_PATH):
-                cfg.plinkPath = os.environ["ProgramFiles(x86)"] + WIN_PLINK_PATH
+                self.cfg.plinkPath = os.environ["ProgramFiles(x86)"] + WIN_PLINK_PATH
                 PLINK_FOUND = True
 
+            if sshPath != None:
+                self.cfg.plinkPath = sshPath
+                PLINK_FOUND = shutil.which(sshPath) != None
+
+            if wiresharkPath != None:
+                self.cfg.wiresharkPath = wiresharkPath
+                WIRESHARK_FOUND = shutil.which(wiresharkPath) != None
+
+            if not wireshark or self.cfg.outputFile != None or self.cfg.listInterfaces or self.cfg.summary != None:
+                return PLINK_FOUND
+
         if self.platform == 'Linux' or self.platform == 'Darwin':
             # Check for SSH support
-            try:
-                process = subprocess.Popen([ "ssh", "-V" ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = process.communicate()
-            except:
+            version = self.probeTool(sshPath or 'ssh', '-V')
+            if version == None:
                 if self.cfg.debug > 1:
                     printf("Unable to detect ssh\n")
                 return False
-
-            if process.returncode != 0:
-                if self.cfg.debug > 1:
-                    printf("Unable to detect ssh\n")
-                PLINK_FOUND = False
-            else:
-                if self.cfg.debug > 2:
-                    printf("Detected SSH version %s%s\n", out.decode(), err.decode())
-                cfg.plinkPath = 'ssh'
-                PLINK_FOUND = True
+            if self.cfg.debug > 2:
+                printf("Detected SSH version %s\n", version)
+            self.cfg.plinkPath = sshPath or 'ssh'
+            PLINK_FOUND = True
             
+            # Headless captures and listing interfaces do not need Wireshark at all
+            if not wireshark or self.cfg.outputFile != None or self.cfg.listInterfaces or self.cfg.summary != None:
+                return PLINK_FOUND
+
             # Check for Wireshark support
-            if self.platform == 'Linux':
+            if wiresharkPath != None:
+                pass
+            elif self.platform == 'Linux':
                 wiresharkPath = 'wireshark'
             else: # IF self.platform == 'Darwin':
                 wiresharkPath = MAC_WIRESHARK_PATH
             
-            try:
-                process = subprocess.Popen([ wiresharkPath, "-v" ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = process.communicate()
-            except:
+            version = self.probeTool(wiresharkPath, '-v')
+            if version == None:
                 if self.cfg.debug > 1:
                     printf("Unable to detect wireshark\n")
                 return False
-
-            if process.returncode != 0:
-                if self.cfg.debug > 1:
-                    printf("Unable to detect wireshark\n")
-                WIRESHARK_FOUND = False
-            else:
-                if self.cfg.debug > 2:
-                    printf("Detected Wireshark version %s%s\n", out.decode().split("\n")[0], err.decode().split("\n")[0])
-                cfg.wiresharkPath = wiresharkPath
-                WIRESHARK_FOUND = True
+            if self.cfg.debug > 2:
+                printf("Detected Wireshark version %s\n", version.split("\n")[0])
+            self.cfg.wiresharkPath = wiresharkPath
+            WIRESHARK_FOUND = True
             
         return WIRESHARK_FOUND and PLINK_FOUND
     
+    def probeTool(self, tool, versionArg):
+        """ Checks a binary by running it with versionArg and returns its version output,
+        None if it does not work. Results are cached per path, mtime and size of the binary """
+        path = shutil.which(tool)
+        if path == None:
+            return None
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        cacheFile = os.path.join(self.stateDirectory(), 'tools.json')
+        tools = {}
+        try:
+            with open(cacheFile) as f:
+                tools = json.load(f)
+        except (OSError, ValueError):
+            pass
+        entry = tools.get(path)
+        if not self.cfg.refreshTools and entry != None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            if self.cfg.debug > 3:
+                printf("Using cached detection of %s\n", path)
+            return entry['version']
+
+        try:
+            process = subprocess.Popen([ tool, versionArg ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+        except OSError:
+            return None
+        version = None
+        if process.returncode == 0:
+            version = (out.decode(errors='replace') + err.decode(errors='replace')).strip()
+
+        # Failures are not cached, they may be temporary
+        if version == None:
+            return None
+        tools[path] = { 'mtime': st.st_mtime_ns, 'size': st.st_size, 'version': version }
+        try:
+            tmp = sprintf('%s.%d', cacheFile, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(tools, f)
+            os.replace(tmp, cacheFile)
+        except OSError as e:
+            if self.cfg.debug > 1:
+                printf("Cannot save %s: %s\n", cacheFile, e)
+        return version
+
     def __setupSSHdebug(self, cmd):
         """ TBA """
 
@@ -398,7 +3875,7 @@ class RemoteShark:
 
         if self.platform == 'Windows':
             cmd.append('-sshlog')
-            plinkCmd.append(SSH_DEBUG_LOG)
+            cmd.append(SSH_DEBUG_LOG)
 
         if self.platform == 'Linux':
             cmd.append('-vvv')
@@ -410,49 +3887,105 @@ class RemoteShark:
         
         return
 
-    def listInterfaces(self):
-        """ Connect to remote host and list available interfaces on the remote system """
-        global cfg
-        login = sprintf('%s@%s', cfg.sshUser, cfg.sshHost)
-        command = """
-printf "%10s | %24s\\n" "Interface" "Status";
-printf -- "-----------+--------------------------\\n";
-tcpdump --list-interfaces | sed 's/^[0-9]\+\.//' | sort |
-sed 's/(.*)//g;s/\[//g;s/\\]//g;s/ [ ]\+/ /g' | sed "s/^\([^ ]\+\) \(.*\)$/'\\1' '\\2'/" |
-xargs printf "%10s | %24s\\n"
-"""
-        if self.platform == 'Windows':
-            self.testConnection()
-            plinkCmd = [cfg.plinkPath, '-batch', '-ssh', login, '-P', cfg.sshPort, ]
-            self.__setupSSHdebug(plinkCmd)
-            plinkCmd.append(command)
-        else: # Linux or Mac (Darwin)
-            plinkCmd = [cfg.plinkPath, login, '-p', cfg.sshPort]
-            self.__setupSSHdebug(plinkCmd)
-            plinkCmd.append(command)
+    def remoteInterfaces(self, host):
+        """ Returns the (name, status) of the interfaces of host (from the capability cache), None if unknown """
+        capabilities = self.hostCapabilities(host)
+        if capabilities == None:
+            return None
+
+        interfaces = []
+        for line in capabilities['interfaces']:
+            # 1.eth0 [Up, Running, Connected]  or  2.any (Pseudo-device that captures on all interfaces) [Up, Running]
+            line = re.sub(r'^[0-9]+\.', '', line)
+            line = re.sub(r'\(.*\)', '', line).replace('[', '').replace(']', '')
+            fields = line.split(None, 1)
+            if len(fields) > 0:
+                interfaces.append((fields[0], fields[1].strip() if len(fields) > 1 else ''))
+        return interfaces
+
+    def perInterface(self):
+        """ Checks whether -i|--interface asks for several interfaces captured side by side """
+        return re.search(r'[,*?\[]', self.cfg.interface) != None
 
-        process = subprocess.Popen(plinkCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def captureInterfaces(self, host):
+        """ Expands -i|--interface, a comma separated list which may hold globs such as eth*,
+        into the interfaces of host. Globs never match the "any" pseudo-interface """
+        names = []
+        for pattern in self.cfg.interface.split(','):
+            if len(pattern) == 0:
+                continue
+            if re.search(r'[*?\[]', pattern) == None:
+                matches = [ pattern ]
+            else:
+                interfaces = self.remoteInterfaces(host)
+                if interfaces == None:
+                    printf("Cannot list interfaces of %s to expand %s\n", host, pattern)
+                    interfaces = []
+                matches = [ x[0] for x in interfaces if x[0] != 'any' and fnmatch.fnmatchcase(x[0], pattern) ]
+                if len(matches) == 0 and self.cfg.debug > 0:
+                    printf("No interface of %s matches %s\n", host, pattern)
+            names = names + [ x for x in matches if x not in names ]
+        if self.cfg.debug > 1:
+            printf("Capturing on %s: %s\n", host, ', '.join(names))
+        return names
+
+    def extract(self):
+        """ Writes the packets of a flow (--flow) and/or a time range of a local capture file into
+        -o|--output, reading only them with the help of the flow index written along with the file """
+        start = time.time()
+        indexFile = self.cfg.extractFile + '.idx'
+        try:
+            index = FlowIndex.load(indexFile)
+        except (OSError, ValueError) as e:
+            printf("Cannot read the flow index %s: %s\n", indexFile, e)
+            return 1
+        toStdout = self.cfg.outputFile == '-'
+        try:
+            out = sys.stdout.buffer if toStdout else open(self.cfg.outputFile, 'wb')
+            try:
+                count = index.extract(self.cfg.extractFile, out, self.cfg.extractFlow, self.cfg.since, self.cfg.until)
+            finally:
+                if toStdout:
+                    out.flush()
+                else:
+                    out.close()
+        except OSError as e:
+            printf("Cannot extract from %s: %s\n", self.cfg.extractFile, e)
+            return 1
+        # The packets may be going to STDOUT
+        if self.cfg.debug > 0 and not toStdout:
+            printf("Extracted %d records of %s into %s in %.1f ms\n", count, self.cfg.extractFile, self.cfg.outputFile,
+                (time.time() - start) * 1000)
+        return 0
+
+    def listInterfaces(self):
+        """ List the interfaces available on the remote system (from the capability cache) """
+        interfaces = self.remoteInterfaces(self.cfg.sshHost)
+        if interfaces == None:
+            printf("Cannot list interfaces of %s\n", self.cfg.sshHost)
+            return
 
-        out, err = process.communicate()
-        print(out.decode())
+        printf("%10s | %24s\n", "Interface", "Status")
+        printf("-----------+--------------------------\n")
+        for name, status in sorted(interfaces):
+            printf("%10s | %24s\n", name, re.sub(' +', ' ', status))
 
-    def testConnection(self):
+    def testConnection(self, host = None):
         """ Tests connection to the remote host (for Windows) and adds the remote host SSH key if needed """
         # :: Try to login and generate output of "All good" to check for connection issues
         # %PLINK_PATH% -batch -ssh root@%REMOTE_HOST% "echo All good" 2>NUL | findstr "All good" >NUL
-        global cfg
-        login = sprintf('%s@%s', cfg.sshUser, cfg.sshHost)
-        plinkCmd = [cfg.plinkPath, '-batch', '-ssh', login, '-P', cfg.sshPort]
-        self.__setupSSHdebug(plinkCmd)
-        plinkCmd.append("echo \"remoteShark::connectionTest::good\"")
+        if host == None:
+            host = self.cfg.sshHost
+        plinkCmd = self.buildSshCommand(host, "echo \"remoteShark::connectionTest::good\"", False)
 
         if self.cfg.debug >= 3:
             printf('Running connection process "%s"\n', plinkCmd)
 
-        self.__plinkProcess = subprocess.Popen(plinkCmd,
+        # Hosts with a cached key are tested concurrently, each with its own process
+        process = subprocess.Popen(plinkCmd, stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        out, err = self.__plinkProcess.communicate()
+        out, err = process.communicate()
 
         if (re.search("remoteShark::connectionTest::good", out.decode())):
             if self.cfg.debug >= 2:
@@ -469,29 +4002,22 @@ xargs printf "%10s | %24s\\n"
                 printf("ABORTED\n")
                 sys.exit(0)
 
-            if (self.addHostKeyCache()):
+            if (self.addHostKeyCache(host)):
                 return
             else:
-                printf("Error occurred while attempting to add the host key\n")
-                printf("%s\n", out.decode())
-                printf("%s\n", err.decode())
-                sys.exit(1)
+                raise OSError(sprintf("Error occurred while attempting to add the host key\n%s\n%s",
+                    out.decode(), err.decode()))
         else:
-            printf("Error while testing connection to %s\n", cfg.sshHost)
-            printf("%s\n", out.decode())
-            printf("%s\n", err.decode())
-            sys.exit(1)
+            raise OSError(sprintf("Error while testing connection to %s\n%s\n%s", host, out.decode(), err.decode()))
 
         return
 
-    def addHostKeyCache(self):
+    def addHostKeyCache(self, host = None):
         """ Automatically adds the remote host RSA keys to the local cache """
-        global cfg
-        login = sprintf('%s@%s', cfg.sshUser, cfg.sshHost)
+        if host == None:
+            host = self.cfg.sshHost
 
-        plinkCmd = [cfg.plinkPath, '-ssh', login, '-P', cfg.sshPort]
-        self.__setupSSHdebug(plinkCmd)
-        plinkCmd.append("echo \"remoteShark::connectionTest::good\"")
+        plinkCmd = self.buildSshCommand(host, "echo \"remoteShark::connectionTest::good\"", False, False)
         
         self.__plinkProcess = subprocess.Popen(plinkCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
 
@@ -510,131 +4036,1413 @@ xargs printf "%10s | %24s\\n"
         else:
             return False
     
-    def validateRemotePcapFile(self):
+    def validateRemotePcapFile(self, host = None, remotePcapFile = None):
         """ Connects to the remote host and validates the if the remote file exists and if it correct type """
+        if host == None:
+            host = self.cfg.sshHost
+        if remotePcapFile == None:
+            remotePcapFile = self.cfg.remotePcapFile
         if self.cfg.debug >= 2:
-            printf("Validating if '%s' exist and is supported\n", cfg.remotePcapFile)
-        # TODO - actual implementation
+            printf("Validating if '%s' exist and is supported on %s\n", remotePcapFile, host)
+        if self.fileSet(remotePcapFile) != None:
+            return self.validateFileSet(host, remotePcapFile)
+        compression, content = self.remoteFileFormat(host, remotePcapFile)
+        if compression == None and content == None:
+            printf("%s on %s cannot be read or is not a pcap, pcapng or compressed capture file\n", remotePcapFile, host)
+            return False
+        if compression != None and self.decompressCommand(host, compression) == None:
+            printf("%s on %s is compressed with %s, which cannot be decompressed there\n", remotePcapFile, host, compression)
+            return False
+        if content == None:
+            printf("%s on %s does not hold a pcap or pcapng file\n", remotePcapFile, host)
+            return False
+        return True
+
+    @staticmethod
+    def fileSet(remotePcapFile):
+        """ Returns the patterns of a set of remote files to merge, a comma separated list which
+        may hold globs such as /var/tmp/capture_*.pcap.gz, or None for a single file """
+        if remotePcapFile == None or re.search(r'[,*?\[]', remotePcapFile) == None:
+            return None
+        return [ x for x in remotePcapFile.split(',') if len(x) > 0 ]
+
+    def mergeFilesArgs(self, remotePcapFile):
+        """ Returns the arguments of the remote helper merging a set of files, the patterns are
+        quoted so that the helper and not the remote shell expands them """
+        args = []
+        # The time window is applied while merging, in nanoseconds
+        if self.cfg.since != None:
+            args = args + [ '--since', sprintf('%d', round(self.cfg.since * 1000000) * 1000) ]
+        if self.cfg.until != None:
+            args = args + [ '--until', sprintf('%d', round(self.cfg.until * 1000000) * 1000) ]
+        return args + [ '--' ] + [ "'" + x.replace("'", "'\\''") + "'" for x in self.fileSet(remotePcapFile) ]
+
+    def validateFileSet(self, host, remotePcapFile):
+        """ Checks all files of a set with the remote helper in a single round trip. Files which
+        cannot be merged are reported and skipped, at least one has to be usable """
+        capabilities = self.hostCapabilities(host)
+        if capabilities != None and 'python3' not in capabilities['commands']:
+            printf("Merging several remote files requires python3 on %s\n", host)
+            return False
+        command = self.helperCommand([ '--list' ] + self.mergeFilesArgs(remotePcapFile))
+        process = subprocess.Popen(self.buildSshCommand(host, command, False),
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out, err = process.communicate()
+        usable = 0
+        for line in out.decode(errors='replace').splitlines():
+            fields = line.split('\t')
+            if len(fields) != 4 or fields[0] != 'remoteShark::file':
+                continue
+            if fields[1] == 'ok':
+                usable = usable + 1
+                if self.cfg.debug > 1:
+                    printf("Merging %s on %s, first packet at %s\n", fields[3], host,
+                        datetime.fromtimestamp(int(fields[2]) / 1e9).isoformat(' '))
+            else:
+                printf("Skipping %s on %s: %s\n", fields[3], host, fields[2])
+        if usable == 0:
+            printf("No capture file on %s matches %s\n", host, remotePcapFile)
+            return False
         return True
+
+    @staticmethod
+    def detectFormat(data):
+        """ Returns the format of a capture file from its first bytes (see FILE_MAGICS) or None """
+        for name, magics in FILE_MAGICS:
+            for magic in magics:
+                if data.startswith(magic):
+                    return name
+        return None
+
+    def remoteFileFormat(self, host, remotePcapFile):
+        """ Detects the format of a remote capture file from its magic bytes. Returns (compression,
+        content): compression is gz, bz2, xz, zst or None, content pcap, pcapng or None when the
+        file cannot be read or holds something else. Without a host the name is used instead """
+        if host == None:
+            for name in ('gz', 'bz2', 'xz', 'zst'):
+                if remotePcapFile.endswith('.' + name):
+                    return (name, 'pcap')
+            return (None, 'pcapng' if remotePcapFile.endswith('.pcapng') else 'pcap')
+        key = (host, remotePcapFile)
+        if key in self.__fileFormats:
+            return self.__fileFormats[key]
+
+        def peek(command):
+            process = subprocess.Popen(self.buildSshCommand(host, command + ' 2>/dev/null | head -c 8 | od -An -tx1', False),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            out, err = process.communicate()
+            try:
+                return RemoteShark.detectFormat(bytes.fromhex(out.decode(errors='replace')))
+            except ValueError:
+                return None
+
+        # One round trip for an uncompressed file, a second one looks into a compressed file
+        fileFormat = peek(sprintf('head -c 8 %s', remotePcapFile))
+        result = (None, fileFormat)
+        if fileFormat in FILE_DECOMPRESSORS:
+            decompress = self.decompressCommand(host, fileFormat)
+            content = peek(sprintf('%s %s', decompress, remotePcapFile)) if decompress != None else None
+            result = (fileFormat, content if content in ('pcap', 'pcapng') else None)
+        elif fileFormat not in ('pcap', 'pcapng'):
+            result = (None, None)
+        if self.cfg.debug > 1:
+            content = result[1] if result[1] != None else 'no capture'
+            printf("%s on %s: %s\n", remotePcapFile, host, content if result[0] == None else sprintf('%s compressed with %s', content, result[0]))
+        self.__fileFormats[key] = result
+        return result
+
+    def decompressCommand(self, host, compression):
+        """ Returns the remote command decompressing files of compression to STDOUT, preferring
+        the parallel decompressors installed on host, or None when there is none """
+        capabilities = self.hostCapabilities(host) if host != None else None
+        for tool, command in FILE_DECOMPRESSORS[compression]:
+            if capabilities == None or tool in capabilities['commands']:
+                return command
+        return None
+
+    def filtersFile(self):
+        """ Checks whether the remote tcpdump has anything to do for a file: a pcap filter other than
+        the default one or -c|--count. Otherwise the file is sent as it is """
+        if self.cfg.packetCount != None and self.cfg.packetCount > 0:
+            return True
+        # The default filter makes no difference for a capture file
+        return self.cfg.dumpFilter not in ('', sprintf('not port %s', self.cfg.sshPort))
     
-    def runWireshark(self):
-        """ Connect to the remote host and start local Wireshark for live capturing of traffic """
-        global cfg
-        login = sprintf('%s@%s', cfg.sshUser, cfg.sshHost)
+    def buildCaptureCommand(self, remotePcapFile = None, codec = None, byteRange = None, packetCount = None, stats = False, host = None,
+            interface = None):
+        """ Builds the remote tcpdump command for a live capture or for reading remotePcapFile.
+        byteRange limits an uncompressed file to the records between (start, end) offsets,
+        packetCount overrides -c|--count. With stats a live capture reports its counters on stderr.
+        The options are picked from the capabilities of host when it is given, interface
+        overrides -i|--interface """
+        if interface == None:
+            interface = self.cfg.interface
 
-        self.__startTime = time.time()
+        if packetCount == None:
+            packetCount = self.cfg.packetCount
+        capabilities = self.hostCapabilities(host) if host != None else None
 
         tcpdumpCMD = ''
-        if cfg.runTimeout != None and cfg.runTimeout > 0:
+        # Without timeout on the remote host the capture is stopped from this side
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0 and (capabilities == None or 'timeout' in capabilities['commands']):
             # It usually takes about a second to establish the connection
             # Thus - increase the timeout by 1
-            tcpdumpCMD = sprintf("%s timeout %d ", tcpdumpCMD, cfg.runTimeout + 1)
+            tcpdumpCMD = sprintf("%s timeout %d ", tcpdumpCMD, self.cfg.runTimeout + 1)
 
         tcpdumpCMD = tcpdumpCMD + 'tcpdump'
 
-        if cfg.packetCount != None and cfg.packetCount > 0:
-            tcpdumpCMD = sprintf("%s -c %d", tcpdumpCMD, cfg.packetCount)
+        if packetCount != None and packetCount > 0:
+            tcpdumpCMD = sprintf("%s -c %d", tcpdumpCMD, packetCount)
+        profile = CAPTURE_PROFILES[self.cfg.profile]
+        if profile['packetBuffered']:
+            # Every packet is written out at once instead of when the stdio buffer is full
+            tcpdumpCMD = tcpdumpCMD + ' -U'
         # It is important to suppress STDERR, otherwise the data from tcpdump STDERR will break Wireshark
-        if cfg.remotePcapFile == None:
-            tcpdumpCMD = sprintf('%s -U -ni "%s" -s 0 -q -w - "%s" 2>/dev/null', tcpdumpCMD, cfg.interface, cfg.dumpFilter)
+        # (unless remoteShark reads it for the packet counters)
+        if remotePcapFile == None:
+            if profile['immediate'] and capabilities != None and '--immediate-mode' in capabilities['flags']:
+                # Packets are delivered as they arrive instead of when the kernel buffer times out
+                tcpdumpCMD = tcpdumpCMD + ' --immediate-mode'
+            if profile['buffer'] != None and capabilities != None and '-B' in capabilities['flags']:
+                tcpdumpCMD = sprintf('%s -B %d', tcpdumpCMD, profile['buffer'])
+            tcpdumpCMD = sprintf('%s -ni "%s" -s %d -q -w - "%s"%s', tcpdumpCMD, interface, self.cfg.snaplen, self.cfg.dumpFilter,
+                '' if stats else ' 2>/dev/null')
+            if stats:
+                # SIGUSR1 makes tcpdump print its counters. A loop in the same session sends it every interval,
+                # so no further connection is opened for it, and ends with tcpdump
+                tcpdumpCMD = sprintf('(while sleep %g; do pkill -USR1 -x tcpdump -s 0 || exit; done) >/dev/null 2>&1 & %s',
+                    self.cfg.stats, tcpdumpCMD)
+        elif self.fileSet(remotePcapFile) != None:
+            # The helper merges the files by timestamp and applies the time window on the remote host
+            merge = self.helperCommand([ '--merge' ] + self.mergeFilesArgs(remotePcapFile)) + ' 2>/dev/null'
+            if self.filtersFile():
+                tcpdumpCMD = sprintf('%s | %s -n -r - -s 0 -q -w - "%s" 2>/dev/null', merge, tcpdumpCMD, self.cfg.dumpFilter)
+            else:
+                tcpdumpCMD = merge
         else:
-            if not self.validateRemotePcapFile():
-                printf("Invalid file or file format of remote pcap file\n")
-                self.__exit(1)
-            if (cfg.remotePcapFile.endswith('.gz')):
-                tcpdumpCMD = sprintf('zcat %s | %s -U -n -r - -s 0 -q -w - "%s" 2>/dev/null', cfg.remotePcapFile, tcpdumpCMD, cfg.dumpFilter)
-            elif (cfg.remotePcapFile.endswith('.bz2')):
-                tcpdumpCMD = sprintf('bzcat %s | %s -U -n -r - -s 0 -q -w - "%s" 2>/dev/null', cfg.remotePcapFile, tcpdumpCMD, cfg.dumpFilter)
+            compression, content = self.remoteFileFormat(host, remotePcapFile)
+            source = None
+            if compression != None:
+                source = sprintf('%s %s', self.decompressCommand(host, compression), remotePcapFile)
+            elif byteRange != None:
+                # Keep the file header and skip straight to the records of the time window
+                source = sprintf('{ head -c 24 %s; tail -c +%d %s', remotePcapFile, byteRange[0] + 1, remotePcapFile)
+                if byteRange[1] != None:
+                    source = sprintf('%s | head -c %d', source, byteRange[1] - byteRange[0])
+                source = source + '; }'
+            if self.filtersFile() or content != 'pcap':
+                # tcpdump reads an uncompressed file itself and turns pcapng into pcap
+                tcpdumpCMD = sprintf('%s -n -r %s -s 0 -q -w - "%s" 2>/dev/null', tcpdumpCMD, '-' if source != None else remotePcapFile,
+                    self.cfg.dumpFilter)
+                if source != None:
+                    tcpdumpCMD = sprintf('%s 2>/dev/null | %s', source, tcpdumpCMD)
             else:
-                tcpdumpCMD = sprintf('cat %s | %s -U -n -r - -s 0 -q -w - "%s" 2>/dev/null', cfg.remotePcapFile, tcpdumpCMD, cfg.dumpFilter)
-	
+                # Nothing to filter, the pcap data is sent as it is
+                tcpdumpCMD = sprintf('%s 2>/dev/null', source if source != None else sprintf('cat %s', remotePcapFile))
+
+        reduction = self.reductionArgs(remotePcapFile) + self.windowArgs(host, remotePcapFile)
+        if self.cfg.summary != None:
+            # Only the flow reports are sent
+            tcpdumpCMD = tcpdumpCMD + ' | ' + self.helperCommand(self.summaryArgs(remotePcapFile))
+        elif len(reduction) > 0:
+            # The stream is reduced and cut to the window before it is compressed and sent
+            tcpdumpCMD = tcpdumpCMD + ' | ' + self.helperCommand(reduction)
+
+        if codec != None:
+            level = self.cfg.codecLevel if self.cfg.codecLevel != None else STREAM_CODECS[codec]['level']
+            tcpdumpCMD = tcpdumpCMD + ' | ' + sprintf(STREAM_CODECS[codec]['encode'], level)
+
+        return tcpdumpCMD
+
+    def reductionArgs(self, remotePcapFile = None):
+        """ Returns the arguments of the remote helper reducing the capture (--sample, --flow-sample
+        and --rate-limit), an empty list when the capture is passed on in full """
+        args = []
+        if self.cfg.sample != None and self.cfg.sample > 1:
+            args = args + [ '--sample', str(self.cfg.sample) ]
+        if self.cfg.flowSample != None and self.cfg.flowSample > 1:
+            args = args + [ '--flow-sample', str(self.cfg.flowSample) ]
+        if self.cfg.rateLimit != None:
+            args = args + [ '--rate-limit', sprintf('%d', self.cfg.rateLimit) ]
+            if remotePcapFile != None:
+                # Nothing is lost by sending a file slower
+                args.append('--pace')
+        if len(args) > 0:
+            args = args + [ '--report', sprintf('%g', self.cfg.stats if self.cfg.stats != None else HELPER_REPORT_INTERVAL) ]
+        return args
+
+    def captureWindow(self):
+        """ Tells if a live capture is limited by --start-at, --stop-at or --duration """
+        return self.cfg.startAt != None or self.cfg.stopAt != None or self.cfg.duration != None
+
+    def windowArgs(self, host = None, remotePcapFile = None):
+        """ Returns the arguments of the remote helper cutting a live capture to its window on the packet
+        timestamps and stopping tcpdump at its end, empty when the host has no python3 to run it """
+        if remotePcapFile != None or not self.captureWindow():
+            return []
+        capabilities = self.hostCapabilities(host) if host != None else None
+        if capabilities != None and 'python3' not in capabilities['commands']:
+            return []
+        args = [ '--live' ]
+        if self.cfg.startAt != None:
+            args = args + [ '--since', sprintf('%d', round(self.cfg.startAt * 1000000) * 1000) ]
+        if self.cfg.stopAt != None:
+            args = args + [ '--until', sprintf('%d', round(self.cfg.stopAt * 1000000) * 1000) ]
+        if self.cfg.duration != None:
+            args = args + [ '--duration', sprintf('%d', round(self.cfg.duration * 1000000) * 1000) ]
+        return args
+
+    def summaryArgs(self, remotePcapFile = None):
+        """ Returns the arguments of the remote helper aggregating the capture into --summary reports """
+        args = [ '--summary', sprintf('%g', self.cfg.summary), '--top', str(self.cfg.summaryTop) ]
+        if remotePcapFile == None:
+            # A live capture also reports the intervals without packets
+            args.append('--live')
+        return args
+
+    def describeReduction(self):
+        """ Describes the reduction of the capture for the user, None without one """
+        parts = []
+        if self.cfg.sample != None and self.cfg.sample > 1:
+            parts.append(sprintf('1 in %d packets', self.cfg.sample))
+        if self.cfg.flowSample != None and self.cfg.flowSample > 1:
+            parts.append(sprintf('1 in %d flows', self.cfg.flowSample))
+        if self.cfg.rateLimit != None:
+            rate = self.cfg.rateLimit
+            unit = 'B/s'
+            for x in ('kB/s', 'MB/s', 'GB/s'):
+                if rate < 1000:
+                    break
+                rate = rate / 1000.0
+                unit = x
+            parts.append(sprintf('at most %g %s', round(rate, 1), unit))
+        return ', '.join(parts) if len(parts) > 0 else None
+
+    @staticmethod
+    def helperCommand(args):
+        """ Returns the remote command running REMOTE_HELPER with args """
+        code = base64.b64encode(zlib.compress(REMOTE_HELPER.encode(), 9)).decode()
+        return sprintf('python3 -c "import base64,zlib;exec(zlib.decompress(base64.b64decode(\'%s\')))" %s', code, ' '.join(args))
+
+    def reportReduction(self):
+        """ Prints how much of the capture every host kept, as last reported by its helper """
+        for label, (host, stats) in list(self.__remoteStats.items()):
+            counters = stats.reduction
+            if counters == None:
+                continue
+            printf("%s kept %d of %d packets (%.1f%%, %d of %d bytes): %d removed by --sample, %d by --flow-sample, %d by --rate-limit\n",
+                label, counters['kept'], counters['seen'], 100.0 * counters['kept'] / max(counters['seen'], 1),
+                counters['keptBytes'], counters['seenBytes'], counters['sampled'], counters['flows'], counters['limited'])
+
+    def remoteCodecs(self, host):
+        """ Returns the stream codecs installed on the remote host """
+        capabilities = self.hostCapabilities(host)
+        if capabilities == None:
+            return []
+        return [ x for x in STREAM_CODECS if x in capabilities['commands'] ]
+
+    def hostCapabilities(self, host):
+        """ Returns what is known about the remote host: tcpdump version and options, interfaces
+        and available commands, None when it cannot be probed. One batched probe fills a per-host
+        cache valid for --capability-ttl, the result is kept for the run, failures included """
+        if host in self.__capabilities:
+            return self.__capabilities[host]
+        self.__capabilities[host] = self.__hostCapabilities(host)
+        return self.__capabilities[host]
+
+    def __hostCapabilities(self, host):
+        key = sprintf('%s@%s:%s', self.cfg.sshUser, host, self.cfg.sshPort)
+        cacheFile = os.path.join(self.stateDirectory(), 'hosts.json')
+        with RemoteShark.__capabilityLock:
+            if self.__knownHosts == None:
+                self.__knownHosts = {}
+                try:
+                    with open(cacheFile) as f:
+                        self.__knownHosts = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            entry = self.__knownHosts.get(key)
+            # An entry probed for fewer commands than known now is probed again
+            if (not self.cfg.refreshTools and entry != None and time.time() - entry['time'] < self.cfg.capabilityTtl and
+                    entry['capabilities'].get('probed') == CAPABILITY_COMMANDS):
+                if self.cfg.debug > 3:
+                    printf("Using cached capabilities of %s\n", key)
+                return entry['capabilities']
+
+        command = ' '.join([ 'tcpdump --version 2>&1 | sed "s/^/version /";',
+            'echo "usage $(tcpdump -h 2>&1 | tr -s \' \\n\' \' \')";',
+            'tcpdump --list-interfaces 2>/dev/null | sed "s/^/interface /";',
+            sprintf('for x in %s; do command -v $x >/dev/null 2>&1 && echo "command $x"; done', ' '.join(CAPABILITY_COMMANDS)) ])
+        if self.cfg.debug > 2:
+            printf("Probing the capabilities of %s\n", host)
+        compression = self.sshCompression(None) if self.cfg.codec == None else False
+        process = subprocess.Popen(self.buildSshCommand(host, command, compression), stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            out, err = process.communicate(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            return None
+        capabilities = RemoteShark.parseCapabilities(out.decode(errors='replace'))
+        if capabilities == None:
+            if self.cfg.debug > 0:
+                printf("Cannot probe the capabilities of %s: %s\n", host, err.decode(errors='replace').strip())
+            return None
+        if self.cfg.debug > 2:
+            printf("Capabilities of %s: %s\n", host, capabilities)
+
+        with RemoteShark.__capabilityLock:
+            self.__knownHosts[key] = { 'time': time.time(), 'capabilities': capabilities }
+            try:
+                tmp = sprintf('%s.%d', cacheFile, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(self.__knownHosts, f)
+                os.replace(tmp, cacheFile)
+            except OSError as e:
+                if self.cfg.debug > 1:
+                    printf("Cannot save %s: %s\n", cacheFile, e)
+        return capabilities
+
+    @staticmethod
+    def parseCapabilities(out):
+        """ Returns the capabilities in the output of the probe of hostCapabilities, None when
+        the probe did not run """
+        capabilities = { 'tcpdump': None, 'flags': [], 'interfaces': [], 'commands': [], 'probed': CAPABILITY_COMMANDS }
+        probed = False
+        for line in out.split('\n'):
+            kind, _, value = line.partition(' ')
+            if kind == 'version' and capabilities['tcpdump'] == None and value.startswith('tcpdump'):
+                capabilities['tcpdump'] = value.strip()
+            elif kind == 'usage':
+                capabilities['flags'] = [ x for x in CAPABILITY_FLAGS if re.search(re.escape(x) + r'\b', value) ]
+                probed = True
+            elif kind == 'interface':
+                capabilities['interfaces'].append(value.strip())
+            elif kind == 'command':
+                capabilities['commands'].append(value.strip())
+        # The usage line is always printed once the command ran at all
+        return capabilities if probed else None
+
+    def selectCodec(self, host):
+        """ Selects the stream codec for host, None means SSH compression or none at all """
+        if self.cfg.codec == None:
+            return None
+        if host in self.__codecs:
+            return self.__codecs[host]
+        self.__codecs[host] = self.__selectCodec(host)
+        return self.__codecs[host]
+
+    def __selectCodec(self, host):
+        if self.cfg.codec == 'auto' and not CAPTURE_PROFILES[self.cfg.profile]['autoCodec']:
+            if self.cfg.debug > 1:
+                printf("Not compressing the capture on %s with a codec for the %s profile\n", host, self.cfg.profile)
+            return None
+        wanted = list(STREAM_CODECS.keys()) if self.cfg.codec == 'auto' else [ self.cfg.codec ]
+        wanted = [ x for x in wanted if StreamDecoder.available(x) ]
+        if len(wanted) > 0:
+            remote = self.remoteCodecs(host)
+            for codec in wanted:
+                if codec in remote:
+                    if self.cfg.debug > 1:
+                        printf("Compressing the capture on %s with %s\n", host, codec)
+                    return codec
+
+        if self.cfg.debug > 0:
+            printf("Codec %s is not available for %s, falling back to %s\n", self.cfg.codec, host,
+                "no compression" if self.cfg.compression == False else "SSH compression")
+        return None
+
+    def sshCompression(self, codec):
+        """ SSH compression is used only when no codec compresses the stream """
+        if codec != None:
+            return False
+        if self.cfg.codec != None:
+            return self.cfg.compression != False
+        return self.cfg.compression == True
+
+    def __remoteRead(self, host, remotePcapFile, offsets, length):
+        """ Reads length bytes at each of the offsets of a remote file in one round trip """
+        command = ''.join([ sprintf('tail -c +%d %s 2>/dev/null | head -c %d;', x + 1, remotePcapFile, length) for x in offsets ])
+        process = subprocess.Popen(self.buildSshCommand(host, command, False), stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        out, err = process.communicate()
+        return [ out[i * length:(i + 1) * length] for i in range(len(offsets)) ]
+
+    def locateWindow(self, host, remotePcapFile):
+        """ Searches an uncompressed remote pcap file for the byte range of the time window.
+        Returns (start, end) offsets of the records, end is None for the end of file """
+
+        command = sprintf('wc -c < %s; head -c 40 %s', remotePcapFile, remotePcapFile)
+        process = subprocess.Popen(self.buildSshCommand(host, command, False), stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        out, err = process.communicate()
+        if out.find(b'\n') < 0:
+            return None
+        size, header = out.split(b'\n', 1)
+        try:
+            size = int(size.strip())
+        except ValueError:
+            return None
+        if len(header) < 40:
+            return None
+
+        locator = WindowLocator(size, header, lambda offsets, length: self.__remoteRead(host, remotePcapFile, offsets, length))
+        window = locator.locate(self.cfg.since, self.cfg.until)
+        if window == None:
+            if self.cfg.debug > 0:
+                printf("%s is not a pcap file, the time window is applied while streaming\n", remotePcapFile)
+            return None
+        if self.cfg.debug > 1:
+            printf("Time window of %s is at bytes %d-%s of %d\n", remotePcapFile, window[0],
+                "end" if window[1] == None else str(window[1]), size)
+        return window
+
+    def __windowRange(self, host, remotePcapFile):
+        """ Returns the byte range of the time window for uncompressed remote files """
+        if remotePcapFile == None or (self.cfg.since == None and self.cfg.until == None):
+            return None
+        if self.fileSet(remotePcapFile) != None:
+            # Merged files are limited to the window by the remote helper
+            return None
+        if self.remoteFileFormat(host, remotePcapFile) != (None, 'pcap'):
+            return None
+        return self.locateWindow(host, remotePcapFile)
+
+    def __applyWindow(self, stream, process, host = None):
+        """ Returns the stream limited to the time window, the SSH process is stopped after it. The
+        window of a live capture is only applied here when the host cannot run the remote helper """
+        since, until, duration = self.cfg.since, self.cfg.until, None
+        live = host != None and self.captureWindow() and len(self.windowArgs(host)) == 0
+        if live:
+            since, until, duration = self.cfg.startAt, self.cfg.stopAt, self.cfg.duration
+            if self.cfg.debug > 0:
+                printf("python3 is missing on %s, the capture window is applied locally\n", host)
+        if since == None and until == None and duration == None:
+            return stream
+        def stop():
+            if process.poll() == None:
+                if self.cfg.debug > 2:
+                    printf("Time window has passed, stopping the transfer\n")
+                process.terminate()
+        if live and until != None:
+            # A quiet link sends no packet after the window to end it, the window of a file is not on the clock
+            timer = threading.Timer(max(0, until + 1 - time.time()), stop)
+            timer.daemon = True
+            timer.start()
+        return PcapWindow(stream, since, until, stop, self.cfg.debug, duration).stdout
+
+    def __decode(self, stream, codec):
+        """ Returns the decompressed stream of an SSH process """
+        if codec == None:
+            return stream
+        if self.cfg.stats != None:
+            # Count the compressed bytes on their way to the decoder
+            readFd, writeFd = os.pipe()
+            relay = StreamRelay(stream, os.fdopen(writeFd, 'wb', buffering=0), debug=self.cfg.debug)
+            relay.start()
+            self.__linkRelays.append(relay)
+            stream = os.fdopen(readFd, 'rb', buffering=0)
+        decoder = StreamDecoder(codec, stream, self.cfg.debug)
+        if decoder.process != None:
+            self.__decoderProcesses.append(decoder.process)
+        return decoder.stdout
+
+    @staticmethod
+    def stateDirectory():
+        """ Returns (and creates) the per-user directory for remoteShark's sockets and caches """
+        if platform.system() == 'Windows':
+            base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+        else:
+            base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        path = os.path.join(base, 'remoteShark')
+        if not os.path.isdir(path):
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def openSession(self, host, compression = None):
+        """ Makes sure a shared (ControlMaster) SSH connection to host is running and
+        returns the ssh options for running commands over it """
+        if compression == None:
+            compression = self.cfg.compression == True
+
+        if not self.cfg.multiplex:
+            return []
+
+        # PuTTY shares the connection while the first plink is alive, it cannot persist it
+        if self.platform == 'Windows':
+            return ['-share']
+
+        # Compressed and uncompressed sessions are separate masters, -C has no effect on a client.
+        # The same goes for the QoS class of a profile, the master owns the socket
+        ipqos = CAPTURE_PROFILES[self.cfg.profile]['ipqos']
+        controlPath = os.path.join(self.stateDirectory(), sprintf('%s%s-%%C', 'cmz' if compression else 'cm',
+            '' if ipqos == None else '-' + ipqos))
+        key = (host, controlPath)
+        if key in self.__sessions:
+            return self.__sessions[key]
+
+        login = sprintf('%s@%s', self.cfg.sshUser, host)
+        base = [self.cfg.plinkPath, login, '-p', self.cfg.sshPort, '-o', 'ControlPath=' + controlPath]
+        options = ['-o', 'ControlMaster=no', '-o', 'ControlPath=' + controlPath]
+
+        check = subprocess.run(base + ['-O', 'check'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if check.returncode == 0:
+            if self.cfg.debug > 2:
+                printf("Reusing shared SSH connection to %s\n", host)
+            self.__sessions[key] = options
+            return options
+
+        masterCmd = base + ['-o', 'ControlMaster=yes', '-o', sprintf('ControlPersist=%d', self.cfg.controlPersist), '-N', '-f']
+        if compression:
+            masterCmd.append('-C')
+        if ipqos != None:
+            masterCmd = masterCmd + ['-o', 'IPQoS=' + ipqos]
+        self.__setupSSHdebug(masterCmd)
         if self.cfg.debug >= 3:
-            printf('Running command remote "%s"\n', tcpdumpCMD)
+            printf('Opening shared SSH connection "%s"\n', masterCmd)
+
+        # The backgrounded master keeps its stderr open, so it must not be a pipe we wait on
+        with tempfile.TemporaryFile() as err:
+            master = subprocess.run(masterCmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err)
+            if master.returncode != 0:
+                err.seek(0)
+                if self.cfg.debug > 0:
+                    printf("Cannot open shared SSH connection to %s, using separate connections\n%s\n", host, err.read().decode(errors='replace'))
+                options = []
 
+        self.__sessions[key] = options
+        return options
+
+    def buildSshCommand(self, host, command, compression = None, batch = True):
+        """ Builds the plink/ssh command line which runs command on the remote host """
+        login = sprintf('%s@%s', self.cfg.sshUser, host)
+        if compression == None:
+            compression = self.cfg.compression == True
+
+        if self.platform == 'Windows':
+            sshCmd = [self.cfg.plinkPath]
+            if batch:
+                sshCmd.append('-batch')
+            sshCmd = sshCmd + ['-ssh', login, '-P', self.cfg.sshPort] + self.openSession(host, compression)
+            self.__setupSSHdebug(sshCmd)
+            if compression:
+                sshCmd.append('-C')
+        else: # Linux or Mac (Darwin)
+            sshCmd = [self.cfg.plinkPath, login, '-p', self.cfg.sshPort] + self.openSession(host, compression)
+            if compression:
+                sshCmd.append('-C')
+            if CAPTURE_PROFILES[self.cfg.profile]['ipqos'] != None:
+                # Used when the command opens its own connection, a shared one was set up with it
+                sshCmd = sshCmd + ['-o', 'IPQoS=' + CAPTURE_PROFILES[self.cfg.profile]['ipqos']]
+            self.__setupSSHdebug(sshCmd)
+
+        sshCmd.append(command)
+        return sshCmd
+
+    def buildWiresharkCommand(self):
+        """ Builds the local Wireshark command reading the capture from STDIN """
         # Wireshark is run with the same arguments for all OS
         if len(self.cfg.wiresharkFilter) > 0:
-            wireCmd = [cfg.wiresharkPath, '-k', '-i', '-', '-Y', self.cfg.wiresharkFilter]
+            return [self.cfg.wiresharkPath, '-k', '-i', '-', '-Y', self.cfg.wiresharkFilter]
+        return [self.cfg.wiresharkPath, '-k', '-i', '-']
+
+    def __startConsumer(self, stream):
+        """ Starts the local consumer of the capture stream: Wireshark or the output files,
+        along with the consumers of --tee """
+
+        if self.cfg.outputFile != None:
+            self.__sink = RingFileSink(self.cfg.outputFile, self.cfg.rotateSize, self.cfg.rotateTime, self.cfg.maxFiles, self.cfg.fsyncInterval, self.cfg.debug,
+                self.cfg.flowIndex, self.__sinkFailed)
+            out = self.__startTee(self.__sink)
+            if stream != None:
+                StreamRelay.resizePipe(stream, CAPTURE_PROFILES[self.cfg.profile]['pipeSize'])
+                self.__relay = StreamRelay(stream, out, debug=self.cfg.debug)
+                self.__addCounter()
+            return out
+
+        wireCmd = self.buildWiresharkCommand()
+        if self.cfg.debug >= 3:
+            printf('Running Wireshark process "%s"\n', wireCmd)
+
+        # Wireshark reads the SSH output directly unless the stream goes through remoteShark
+        stdin = subprocess.PIPE if self.cfg.relay or stream == None else stream
+        if stream != None:
+            StreamRelay.resizePipe(stream, CAPTURE_PROFILES[self.cfg.profile]['pipeSize'])
+        if self.platform == 'Windows':
+            self.__wireProcess = subprocess.Popen(wireCmd, bufsize=0,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=stdin,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            self.__wireProcess = subprocess.Popen(wireCmd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                stdin=stdin, start_new_session=True)
+
+        if self.cfg.relay:
+            StreamRelay.resizePipe(self.__wireProcess.stdin, CAPTURE_PROFILES[self.cfg.profile]['pipeSize'])
+        out = self.__startTee(self.__wireProcess.stdin)
+        if self.cfg.relay and stream != None:
+            self.__relay = StreamRelay(stream, out, debug=self.cfg.debug)
+            self.__addCounter()
+        return out
+
+    def __startTee(self, primary):
+        """ Puts the consumers of --tee next to the primary one (Wireshark or the output files).
+        Returns primary when there are none """
+        if len(self.cfg.tee) == 0:
+            return primary
+
+        tee = StreamTee(self.cfg.debug)
+        # Wireshark may lag behind while the output files are expected to be complete
+        if self.cfg.outputFile != None:
+            tee.add('output', primary, 'spill', self.cfg.teeQueue)
         else:
-            wireCmd = [cfg.wiresharkPath, '-k', '-i', '-']
+            tee.add('wireshark', primary, 'drop', self.cfg.teeQueue)
+        for kind, target, policy in self.cfg.tee:
+            if kind == 'file':
+                out = RingFileSink(target, self.cfg.rotateSize, self.cfg.rotateTime, self.cfg.maxFiles, self.cfg.fsyncInterval, self.cfg.debug,
+                    self.cfg.flowIndex, self.__sinkFailed)
+            else:
+                if self.cfg.debug >= 3:
+                    printf('Running tee command "%s"\n', target)
+                if self.platform == 'Windows':
+                    process = subprocess.Popen(target, shell=True, bufsize=0, stdin=subprocess.PIPE,
+                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+                else:
+                    process = subprocess.Popen(target, shell=True, bufsize=0, stdin=subprocess.PIPE, start_new_session=True)
+                self.__teeProcesses.append(process)
+                StreamRelay.resizePipe(process.stdin, CAPTURE_PROFILES[self.cfg.profile]['pipeSize'])
+                out = process.stdin
+            tee.add(kind + ':' + target, out, policy, self.cfg.teeQueue)
+        self.__tee = tee
+        return tee
+
+    def __sinkFailed(self, sink, error):
+        """ Reports output files which cannot be written (e.g. a full disk). The capture ends when they
+        are the -o|--output files, the other consumers of --tee go on without them """
+        printf("Cannot write the capture to %s: %s\n", sink.files[-1] if len(sink.files) > 0 else sink.prefix, error)
+        if sink is not self.__sink:
+            return
+        self.__sinkError = error
+        self.__stopping.set()
+        for p in [ self.__sshProcess, self.__plinkProcess ] + self.__hostProcesses:
+            if p != None and p.poll() == None:
+                p.terminate()
+
+    def __addCounter(self):
+        """ Counts the packets of the relayed stream for the statistics and the saving of a reduced snaplen """
+        if (self.cfg.snaplen > 0 and self.cfg.debug > 0) or self.cfg.stats != None:
+            self.__counter = PcapCounter()
+            self.__relay.addTap(self.__counter)
+
+    def __followRemoteStats(self, host, process, label = None):
+        """ Reads the counters of the remote tcpdump from the stderr of its SSH process,
+        reported under label (by default the host) """
+        if label == None:
+            label = host
+        stats = TcpdumpStats(process.stderr, self.cfg.debug)
+        self.__remoteStats[label] = (host, stats)
+        if self.__telemetry != None:
+            self.__telemetry.setRemote(label, stats)
+        return stats
+
+    def __startTelemetry(self, packets = None, streamBytes = None, pipes = []):
+        """ Starts the periodic statistics (--stats), by default of the relayed stream """
+        if self.cfg.stats == None:
+            return
+        telemetry = CaptureTelemetry(self.cfg.stats, self.cfg.statsJson, self.cfg.statsProm, self.cfg.debug)
+        if packets == None and self.__counter != None:
+            packets = lambda: self.__counter.packets
+        if streamBytes == None and self.__relay != None:
+            streamBytes = lambda: self.__relay.bytes
+        telemetry.packets = packets
+        telemetry.streamBytes = streamBytes
+        # Without a codec the SSH link carries the stream itself (SSH compression is not visible)
+        telemetry.linkBytes = lambda: sum([ x.bytes for x in self.__linkRelays ]) if len(self.__linkRelays) > 0 else None
+        for name, getter in pipes:
+            telemetry.addPipe(name, getter)
+        if self.__wireProcess != None:
+            telemetry.addPipe('wireshark', lambda: self.__wireProcess.stdin)
+        for i, process in enumerate(self.__teeProcesses):
+            telemetry.addPipe(sprintf('tee%d', i + 1), lambda p=process: p.stdin)
+        for label, (host, stats) in self.__remoteStats.items():
+            telemetry.setRemote(label, stats)
+        self.__telemetry = telemetry
+        telemetry.start()
+
+    def runWireshark(self):
+        """ Connect to the remote host and start local Wireshark for live capturing of traffic """
+
+        if self.describeReduction() != None:
+            printf("The capture is reduced on the remote host to %s, it is partial\n", self.describeReduction())
+
+        if len(self.cfg.extraHosts) > 0 or (self.cfg.remotePcapFile == None and self.perInterface()):
+            return self.runMultiHost()
+
+        if self.cfg.summary != None:
+            return self.runSummary()
+
+        self.__startTime = time.time()
+
+        if self.cfg.remotePcapFile != None and not self.validateRemotePcapFile():
+            printf("Invalid file or file format of remote pcap file\n")
+            self.__exit(1)
+
+        if self.cfg.remotePcapFile != None and self.cfg.cacheDir != None and self.__cacheUsable():
+            self.setupSignals()
+            cached = self.fetchCachedFile(self.cfg.sshHost, self.cfg.remotePcapFile)
+            if cached != None:
+                return self.runCached(cached)
+
+        if self.cfg.reconnect:
+            return self.runResilient()
+
+        codec = self.selectCodec(self.cfg.sshHost)
+        stats = self.cfg.stats != None and self.cfg.remotePcapFile == None
+        # The stderr also carries the counters of the remote helper reducing the capture
+        follow = stats or len(self.reductionArgs(self.cfg.remotePcapFile)) > 0
+        tcpdumpCMD = self.buildCaptureCommand(self.cfg.remotePcapFile, codec, self.__windowRange(self.cfg.sshHost, self.cfg.remotePcapFile),
+            stats=stats, host=self.cfg.sshHost)
+
+        if self.cfg.debug >= 3:
+            printf('Running command remote "%s"\n', tcpdumpCMD)
 
         self.setupSignals()
 
         if self.platform == 'Windows':
-            DETACHED_PROCESS = 0x00000008
-            plinkCmd = [cfg.plinkPath, '-batch', '-ssh', login, '-P', cfg.sshPort]
-            self.__setupSSHdebug(plinkCmd)
-            if cfg.compression == True:
-                plinkCmd.append('-C')
-            plinkCmd.append(tcpdumpCMD)
-            
-            self.testConnection()
+            plinkCmd = self.buildSshCommand(self.cfg.sshHost, tcpdumpCMD, self.sshCompression(codec))
 
             if self.cfg.debug >= 3:
                 printf('Running connection process "%s"\n', plinkCmd)
-                printf('Running Wireshark process "%s"\n', wireCmd)
             
-            self.__plinkProcess = subprocess.Popen(plinkCmd,
+            self.__plinkProcess = subprocess.Popen(plinkCmd, bufsize=0,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
-            self.__wireProcess = subprocess.Popen(wireCmd,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=self.__plinkProcess.stdout,
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            if follow:
+                self.__followRemoteStats(self.cfg.sshHost, self.__plinkProcess)
+            self.__startConsumer(self.__applyWindow(self.__decode(self.__plinkProcess.stdout, codec), self.__plinkProcess,
+                self.cfg.sshHost))
         else: # Linux or Mac (Darwin)
-            sshCmd = [cfg.plinkPath, login, '-p', cfg.sshPort]
-            if cfg.compression == True:
-                sshCmd.append('-C')
-            self.__setupSSHdebug(sshCmd)
-            sshCmd.append(tcpdumpCMD)
+            sshCmd = self.buildSshCommand(self.cfg.sshHost, tcpdumpCMD, self.sshCompression(codec))
 
             if self.cfg.debug >= 3:
                 printf('Running connection process "%s"\n', sshCmd)
-                printf('Running Wireshark process "%s"\n', wireCmd)
 
-            self.__sshProcess = subprocess.Popen(sshCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ.copy())
-            self.__wireProcess = subprocess.Popen(wireCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=self.__sshProcess.stdout, start_new_session=True)
+            self.__sshProcess = subprocess.Popen(sshCmd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ.copy())
+            if follow:
+                self.__followRemoteStats(self.cfg.sshHost, self.__sshProcess)
+            self.__startConsumer(self.__applyWindow(self.__decode(self.__sshProcess.stdout, codec), self.__sshProcess,
+                self.cfg.sshHost))
+
+        if self.__relay != None:
+            self.__relay.start()
+        process = self.__sshProcess or self.__plinkProcess
+        self.__startTelemetry(pipes=[ ('ssh', lambda: process.stdout) ])
 
         # Run processes
-        if cfg.runTimeout != None and cfg.runTimeout > 0:
+        supervisor = ProcessSupervisor(self.cfg.debug)
+        supervisor.watch(self.__sshProcess or self.__plinkProcess, 'ssh')
+        if self.__wireProcess != None:
+            supervisor.watch(self.__wireProcess, 'wireshark')
+
+        timeout = None
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0:
+            timeout = self.cfg.runTimeout
+        else:
+            printf("Press Ctrl+C to terminate capture and exit\n")
+
+        finished = supervisor.wait(timeout)
+        if finished == None:
+            # Leave wireshark process running
+            if self.cfg.debug >= 1:
+                printf("Reached timeout\n")
+        elif finished == 'ssh':
+            if self.cfg.debug > 3:
+                printf("Detected exit from SSH, exiting\n")
+            # Hand over whatever is still in flight before leaving
+            self.__drainDecoders(supervisor)
+            if self.__relay != None:
+                self.__relay.join(5)
+        else:
+            if self.cfg.debug > 3:
+                printf("Detected exit from Wireshark, exiting\n")
+        self.__exit(0)
+
+    def runResilient(self):
+        """ Live capture which reconnects after the SSH session is lost, feeding the
+        same Wireshark (or output files) with one continuous stream """
+
+        self.setupSignals()
+
+        codec = self.selectCodec(self.cfg.sshHost)
+        joiner = SessionJoiner(self.__startConsumer(None), self.cfg.debug)
+        result = [ 0 ]
+        current = [ None ]
+        self.__startTelemetry(lambda: joiner.packets, lambda: joiner.bytes,
+            [ ('ssh', lambda: current[0].stdout if current[0] != None else None) ])
+
+        def capture():
+            delay = 1
+            while not self.__stopping.is_set():
+                packetCount = None
+                if self.cfg.packetCount != None and self.cfg.packetCount > 0:
+                    packetCount = self.cfg.packetCount - joiner.packets
+                    if packetCount <= 0:
+                        return
+                tcpdumpCMD = self.buildCaptureCommand(None, codec, None, packetCount, self.cfg.stats != None, self.cfg.sshHost)
+                sshCmd = self.buildSshCommand(self.cfg.sshHost, tcpdumpCMD, self.sshCompression(codec))
+                if self.cfg.debug >= 3:
+                    printf('Running connection process "%s"\n', sshCmd)
+                if self.platform == 'Windows':
+                    process = subprocess.Popen(sshCmd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        stdin=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+                    self.__plinkProcess = process
+                else:
+                    process = subprocess.Popen(sshCmd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        stdin=subprocess.DEVNULL, env=os.environ.copy())
+                    self.__sshProcess = process
+                current[0] = process
+                stats = None
+                if self.cfg.stats != None or len(self.reductionArgs()) > 0:
+                    stats = self.__followRemoteStats(self.cfg.sshHost, process)
+
+                try:
+                    joiner.relay(self.__decode(process.stdout, codec), self.__closeGap)
+                except ValueError as e:
+                    printf("%s\n", e)
+                    result[0] = 1
+                    return
+                except OSError:
+                    # The consumer went away
+                    return
+                process.wait()
+                if self.__stopping.is_set():
+                    return
+
+                # tcpdump finished on its own (count or timeout), nothing to reconnect
+                if process.returncode in (0, 124):
+                    return
+                if stats != None:
+                    stats.join(1)
+                    reason = stats.lastLine
+                else:
+                    reason = process.stderr.read().decode(errors='replace').strip().split('\n')[-1]
+                if joiner.header == None:
+                    printf("Cannot start the capture on %s: %s\n", self.cfg.sshHost, reason if len(reason) > 0 else sprintf("exit code %d", process.returncode))
+                    result[0] = 1
+                    return
+
+                gap = self.__openGap
+                if gap == None:
+                    delay = 1
+                    gap = { 'host': self.cfg.sshHost, 'interface': self.cfg.interface,
+                        'lastPacket': joiner.lastTimestamp, 'disconnected': time.time(),
+                        'reason': reason if len(reason) > 0 else sprintf("exit code %d", process.returncode),
+                        'attempts': 0 }
+                    self.__openGap = gap
+                    printf("Lost the capture session to %s (%s), reconnecting\n", self.cfg.sshHost, gap['reason'])
+                if self.cfg.reconnectMax > 0 and gap['attempts'] >= self.cfg.reconnectMax:
+                    printf("Giving up after %d reconnection attempts\n", gap['attempts'])
+                    self.__closeGap(False)
+                    result[0] = 1
+                    return
+                gap['attempts'] = gap['attempts'] + 1
+                if self.cfg.debug > 0:
+                    printf("Reconnecting to %s in %d seconds (attempt %d)\n", self.cfg.sshHost, delay, gap['attempts'])
+                self.__stopping.wait(delay)
+                delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+
+        captureThread = threading.Thread(target=capture, daemon=True)
+        captureThread.start()
+
+        supervisor = ProcessSupervisor(self.cfg.debug)
+        supervisor.watchThread(captureThread, 'capture')
+        if self.__wireProcess != None:
+            supervisor.watch(self.__wireProcess, 'wireshark')
+
+        timeout = None
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0:
+            timeout = self.cfg.runTimeout
+        else:
+            printf("Press Ctrl+C to terminate capture and exit\n")
+
+        finished = supervisor.wait(timeout)
+        if finished == None:
+            if self.cfg.debug >= 1:
+                printf("Reached timeout\n")
+        elif finished == 'wireshark':
+            if self.cfg.debug > 3:
+                printf("Detected exit from Wireshark, exiting\n")
+        else:
+            if self.cfg.debug > 3:
+                printf("Capture finished after %d packets\n", joiner.packets)
             try:
-                self.__wireProcess.wait(cfg.runTimeout)
-            except subprocess.TimeoutExpired:
-                # Leave wireshark process running
+                joiner.out.close()
+            except OSError:
+                pass
+        self.__exit(result[0])
+
+    def __closeGap(self, resumed = True):
+        """ Records the open gap of a resilient capture in the gap log """
+        gap = self.__openGap
+        if gap == None:
+            return
+        self.__openGap = None
+        gap['resumed'] = time.time() if resumed else None
+        if resumed:
+            printf("Capture resumed after %.1f seconds\n", gap['resumed'] - gap['disconnected'])
+        if self.cfg.gapLog == None:
+            self.cfg.gapLog = sprintf('remoteShark-%s-%s.gaps', self.cfg.sshHost,
+                datetime.fromtimestamp(self.__startTime).strftime('%Y%m%d%H%M%S'))
+        try:
+            with open(self.cfg.gapLog, 'a') as f:
+                f.write(json.dumps(gap) + '\n')
+        except OSError as e:
+            printf("Cannot write the gap log %s: %s\n", self.cfg.gapLog, e)
+
+    def __drainDecoders(self, supervisor):
+        """ Waits until the local decoders passed the rest of the stream on (or Wireshark went away) """
+        pending = 0
+        for p in self.__decoderProcesses:
+            supervisor.watch(p, 'decoder')
+            pending = pending + 1
+        while pending > 0:
+            if supervisor.wait() == 'wireshark':
+                return
+            pending = pending - 1
+
+    def runSummary(self):
+        """ Aggregates the capture (or the remote file) on the remote host into flow reports of
+        --summary seconds and shows them as a live table, or appends them to --summary-json """
+        self.__startTime = time.time()
+        if self.cfg.remotePcapFile != None and not self.validateRemotePcapFile():
+            printf("Invalid file or file format of remote pcap file\n")
+            self.__exit(1)
+        tcpdumpCMD = self.buildCaptureCommand(self.cfg.remotePcapFile, None, self.__windowRange(self.cfg.sshHost, self.cfg.remotePcapFile),
+            host=self.cfg.sshHost)
+        if self.cfg.debug >= 3:
+            printf('Running command remote "%s"\n', tcpdumpCMD)
+        self.setupSignals()
+
+        # The reports are small, they are not worth compressing
+        sshCmd = self.buildSshCommand(self.cfg.sshHost, tcpdumpCMD, False)
+        if self.platform == 'Windows':
+            self.__plinkProcess = subprocess.Popen(sshCmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.PIPE,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            self.__sshProcess = subprocess.Popen(sshCmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=os.environ.copy())
+        process = self.__sshProcess or self.__plinkProcess
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0:
+            # After the remote timeout, which lets the helper send its last report
+            timer = threading.Timer(self.cfg.runTimeout + 2, process.terminate)
+            timer.daemon = True
+            timer.start()
+
+        out = None
+        if self.cfg.summaryJson == '-':
+            out = sys.stdout
+        elif self.cfg.summaryJson != None:
+            try:
+                out = open(self.cfg.summaryJson, 'a')
+            except OSError as e:
+                printf("Cannot open %s: %s\n", self.cfg.summaryJson, e)
+                self.__exit(1)
+        received = 0
+        for line in process.stdout:
+            received = received + len(line)
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if out != None:
+                out.write(line.decode())
+                out.flush()
+            else:
+                self.printSummary(report)
+        if out != None and out != sys.stdout:
+            out.close()
+        if self.cfg.debug > 0:
+            printf("Received %d bytes of flow reports\n", received)
+        self.__exit(0)
+
+    def printSummary(self, report):
+        """ Shows one report of --summary as tables, redrawn in place on a terminal """
+        size = CaptureTelemetry.formatSize
+        total = max(1, report['bytes'])
+        lines = [ sprintf('%s  %g s  %d packets  %s  %s/s  %d flows',
+            datetime.fromtimestamp(report['start']).strftime('%Y-%m-%d %H:%M:%S'), report['interval'], report['packets'],
+            size(report['bytes']), size(report['bytes'] / report['interval']), report['flows']), '' ]
+        lines.append(sprintf('%-12s %12s %12s %7s', 'Protocol', 'Packets', 'Bytes', 'Share'))
+        for name, counters in sorted(report['protocols'].items(), key=lambda x: -x[1]['bytes']):
+            lines.append(sprintf('%-12s %12d %12s %6.1f%%', name, counters['packets'], size(counters['bytes']),
+                100.0 * counters['bytes'] / total))
+        lines = lines + [ '', sprintf('%-58s %12s %12s %7s', 'Top flows', 'Packets', 'Bytes', 'Share') ]
+        for flow in report['top']:
+            lines.append(sprintf('%-58s %12d %12s %6.1f%%', flow['flow'], flow['packets'], size(flow['bytes']),
+                100.0 * flow['bytes'] / total))
+        lines = lines + [ '', sprintf('%-58s %12s %12s %7s', 'Top talkers', '', 'Bytes', 'Share') ]
+        for talker in report['talkers']:
+            lines.append(sprintf('%-58s %12s %12s %6.1f%%', talker['address'], '', size(talker['bytes']),
+                100.0 * talker['bytes'] / total))
+        if sys.stdout.isatty():
+            # Clear the screen, the table replaces the previous one
+            printf('\033[H\033[J')
+        printf('%s\n\n', '\n'.join(lines))
+        sys.stdout.flush()
+
+    def __cacheUsable(self):
+        """ Checks whether a cached file can be filtered locally like tcpdump would do remotely """
+        if self.fileSet(self.cfg.remotePcapFile) != None:
+            if self.cfg.debug > 0:
+                printf("The cache is not used for a set of remote files, they are merged on the remote host\n")
+            return False
+        if len(self.reductionArgs(self.cfg.remotePcapFile)) > 0:
+            # Caching transfers the whole file, which is what the reduction avoids
+            if self.cfg.debug > 0:
+                printf("The cache is not used when the capture is reduced on the remote host\n")
+            return False
+        if shutil.which('tcpdump') != None:
+            return True
+        if (self.cfg.since != None or self.cfg.until != None) and self.remoteFileFormat(self.cfg.sshHost, self.cfg.remotePcapFile)[1] != 'pcap':
+            # The time window is applied to pcap only, the remote tcpdump converts the pcapng file
+            if self.cfg.debug > 0:
+                printf("Local tcpdump is required to apply the time window to a cached pcapng file, not using the cache\n")
+            return False
+        if self.cfg.packetCount == None and self.cfg.dumpFilter in ('', sprintf('not port %s', self.cfg.sshPort)):
+            # The default filter makes no difference for a capture file
+            return True
+        if self.cfg.debug > 0:
+            printf("Local tcpdump is required to apply the pcap filter to a cached file, not using the cache\n")
+        return False
+
+    def fetchCachedFile(self, host, remotePcapFile):
+        """ Returns the local cache path of a remote file, transferring (or resuming) it when needed """
+        if self.remoteFileFormat(host, remotePcapFile)[0] == 'zst' and not StreamDecoder.available('zstd'):
+            if self.cfg.debug > 0:
+                printf("zstd is needed to load %s from the cache, streaming it instead\n", remotePcapFile)
+            return None
+
+        # Size, mtime and a hash of the beginning and the end of the file in one round trip
+        command = sprintf("stat -c '%%s %%Y' %s 2>/dev/null || stat -f '%%z %%m' %s; "
+            "{ head -c %d %s; tail -c %d %s; } | { sha256sum 2>/dev/null || shasum -a 256 2>/dev/null || cksum; }",
+            remotePcapFile, remotePcapFile, CACHE_HASH_SAMPLE, remotePcapFile, CACHE_HASH_SAMPLE, remotePcapFile)
+        process = subprocess.Popen(self.buildSshCommand(host, command, False), stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        out, err = process.communicate()
+        lines = out.decode(errors='replace').split('\n')
+        try:
+            size, mtime = [ int(x) for x in lines[0].split() ]
+            remoteHash = lines[1].split()[0]
+        except (ValueError, IndexError):
+            if self.cfg.debug > 0:
+                printf("Cannot identify %s on %s, not using the cache\n", remotePcapFile, host)
+            return None
+
+        cache = CaptureCache(self.cfg.cacheDir if len(self.cfg.cacheDir) > 0 else os.path.join(self.stateDirectory(), 'files'),
+            self.cfg.cacheSize, self.cfg.debug)
+        key = CaptureCache.key(sprintf('%s@%s', self.cfg.sshUser, host), self.cfg.sshPort, remotePcapFile, size, mtime, remoteHash)
+        cached = cache.lookup(key, remotePcapFile)
+        if cached != None:
+            if self.cfg.debug > 1:
+                printf("Serving %s from the cache %s\n", remotePcapFile, cached)
+            return cached
+
+        offset = cache.resumeOffset(key, remotePcapFile)
+        if not cache.reserve(size - offset, key):
+            if self.cfg.debug > 0:
+                printf("%s does not fit in the cache, streaming it instead\n", remotePcapFile)
+            return None
+        if self.cfg.debug > 0:
+            printf("Transferring %s (%d bytes) into the cache%s\n", remotePcapFile, size,
+                sprintf(", resuming at %d", offset) if offset > 0 else "")
+
+        # Compressed files do not benefit from another compression
+        compressed = self.remoteFileFormat(host, remotePcapFile)[0] != None
+        codec = None if compressed else self.selectCodec(host)
+        command = sprintf('tail -c +%d %s', offset + 1, remotePcapFile)
+        if codec != None:
+            level = self.cfg.codecLevel if self.cfg.codecLevel != None else STREAM_CODECS[codec]['level']
+            command = command + ' | ' + sprintf(STREAM_CODECS[codec]['encode'], level)
+        sshCmd = self.buildSshCommand(host, command, False if compressed else self.sshCompression(codec))
+        if self.cfg.debug >= 3:
+            printf('Running connection process "%s"\n', sshCmd)
+        self.__sshProcess = subprocess.Popen(sshCmd, bufsize=0, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, env=os.environ.copy())
+        cached = cache.store(key, remotePcapFile, self.__decode(self.__sshProcess.stdout, codec), offset, size)
+        self.__sshProcess.wait()
+        self.__sshProcess = None
+        if cached == None:
+            printf("Transfer of %s was interrupted, run again to resume it\n", remotePcapFile)
+            self.__exit(1)
+        return cached
+
+    def runCached(self, path):
+        """ Loads a cached capture file into Wireshark (or the output files) """
+
+        with open(path, 'rb') as f:
+            fileFormat = self.detectFormat(f.read(8))
+        if fileFormat == 'gz':
+            src = gzip.open(path, 'rb')
+        elif fileFormat == 'bz2':
+            src = bz2.open(path, 'rb')
+        elif fileFormat == 'xz':
+            src = lzma.open(path, 'rb')
+        elif fileFormat == 'zst':
+            decoder = StreamDecoder('zstd', open(path, 'rb'), self.cfg.debug)
+            if decoder.process != None:
+                self.__decoderProcesses.append(decoder.process)
+            src = decoder.stdout
+        else:
+            src = open(path, 'rb')
+
+        stopped = threading.Event()
+        readFd, writeFd = os.pipe()
+        dst = os.fdopen(writeFd, 'wb', buffering=0)
+        stream = os.fdopen(readFd, 'rb', buffering=0)
+
+        # Apply the pcap filter and the count locally, just like the remote tcpdump would
+        tcpdump = None
+        if shutil.which('tcpdump') != None:
+            tcpdumpCmd = ['tcpdump', '-U', '-n', '-r', '-', '-q', '-w', '-']
+            if self.cfg.packetCount != None and self.cfg.packetCount > 0:
+                tcpdumpCmd = tcpdumpCmd + ['-c', str(self.cfg.packetCount)]
+            if len(self.cfg.dumpFilter) > 0:
+                tcpdumpCmd.append(self.cfg.dumpFilter)
+            if self.cfg.debug >= 3:
+                printf('Running local filter "%s"\n', tcpdumpCmd)
+            tcpdump = subprocess.Popen(tcpdumpCmd, bufsize=0, stdin=stream, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            stream.close()
+            stream = tcpdump.stdout
+            self.__decoderProcesses.append(tcpdump)
+
+        def feed():
+            try:
+                while not stopped.is_set():
+                    data = src.read(STREAM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    dst.write(data)
+            except (OSError, ValueError, EOFError):
+                pass
+            src.close()
+            try:
+                dst.close()
+            except OSError:
+                pass
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        if self.cfg.since != None or self.cfg.until != None:
+            stream = PcapWindow(stream, self.cfg.since, self.cfg.until, stopped.set, self.cfg.debug).stdout
+
+        self.__startConsumer(stream)
+        if self.__relay != None:
+            self.__relay.start()
+        self.__startTelemetry()
+
+        # Done once the whole file went through, Wireshark is left running
+        supervisor = ProcessSupervisor(self.cfg.debug)
+        supervisor.watchThread(feeder, 'feeder')
+        if tcpdump != None:
+            supervisor.watch(tcpdump, 'tcpdump')
+        if self.__wireProcess != None:
+            supervisor.watch(self.__wireProcess, 'wireshark')
+        pending = set(['feeder', 'tcpdump']) if tcpdump != None else set(['feeder'])
+        deadline = None
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0:
+            deadline = self.__startTime + self.cfg.runTimeout
+        while len(pending) > 0:
+            finished = supervisor.wait(None if deadline == None else max(0, deadline - time.time()))
+            if finished == None:
+                # Like a transfer, loading the file is limited by -t|--timeout
                 if self.cfg.debug >= 1:
                     printf("Reached timeout\n")
+                stopped.set()
                 self.__exit(0)
-            except:
-                printf("Unknown issue\n")
-                self.__exit(1)
+            if finished == 'wireshark':
+                stopped.set()
+                break
+            pending.discard(finished)
+        if self.__relay != None:
+            self.__relay.join(5)
+        self.__exit(0)
+
+    def __openHost(self, host, remotePcapFile, stats = False, interface = None):
+        """ Starts the capture (or the transfer of remotePcapFile) on one host and returns its pcap stream.
+        interface overrides -i|--interface """
+        codec = self.selectCodec(host)
+        tcpdumpCMD = self.buildCaptureCommand(remotePcapFile, codec, self.__windowRange(host, remotePcapFile),
+            stats=stats, host=host, interface=interface)
+        sshCmd = self.buildSshCommand(host, tcpdumpCMD, self.sshCompression(codec))
+
+        if self.cfg.debug >= 3:
+            printf('Running connection process "%s"\n', sshCmd)
+
+        follow = stats or len(self.reductionArgs(remotePcapFile)) > 0
+        stderr = subprocess.PIPE if follow else subprocess.DEVNULL
+        if self.platform == 'Windows':
+            process = subprocess.Popen(sshCmd, stdout=subprocess.PIPE, stderr=stderr, stdin=subprocess.PIPE,
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            process = subprocess.Popen(sshCmd, stdout=subprocess.PIPE, stderr=stderr, env=os.environ.copy())
+        self.__hostProcesses.append(process)
+        if follow:
+            self.__followRemoteStats(host, process, host if interface == None else sprintf('%s:%s', host, interface))
+        return self.__applyWindow(self.__decode(process.stdout, codec), process, host)
+
+    def __openSources(self, stats = False):
+        """ Starts the capture on every host, or on every interface of every host when -i|--interface
+        lists several, and returns the sources to merge. With stats live captures report their counters """
+        hosts = [ (self.cfg.sshHost, self.cfg.remotePcapFile) ] + self.cfg.extraHosts
+        sources = []
+        for host, remotePcapFile in hosts:
+            if remotePcapFile != None:
+                if not self.validateRemotePcapFile(host, remotePcapFile):
+                    raise ValueError(sprintf("Invalid file or file format of remote pcap file on %s", host))
+                sources.append((sprintf('%s:%s', host, remotePcapFile), self.__openHost(host, remotePcapFile)))
+            elif not self.perInterface():
+                sources.append((host, self.__openHost(host, None, stats)))
+            else:
+                interfaces = self.captureInterfaces(host)
+                if len(interfaces) == 0:
+                    raise ValueError(sprintf("No interface of %s matches %s", host, self.cfg.interface))
+                # The interfaces are named after the NIC and described by their host
+                for interface in interfaces:
+                    sources.append((interface, self.__openHost(host, None, stats, interface), host))
+        return sources
+
+    def openStream(self):
+        """ Starts the capture like runWireshark but returns it as a readable stream instead of
+        passing it on: pcap for one host, pcapng merged by timestamp for several. Used by RemoteCapture """
+        self.__startTime = time.time()
+        sources = self.__openSources()
+        if len(sources) == 1 and len(sources[0]) == 2:
+            return sources[0][1]
+
+        readFd, writeFd = os.pipe()
+        merger = PcapMerger(sources, os.fdopen(writeFd, 'wb', buffering=0), self.cfg.mergeDelay, self.cfg.debug)
+        def merge():
+            merger.run()
+            try:
+                merger.out.close()
+            except OSError:
+                pass
+        threading.Thread(target=merge, daemon=True).start()
+        return os.fdopen(readFd, 'rb', buffering=0)
+
+    def closeStream(self):
+        """ Stops the processes started by openStream """
+        self.__stopping.set()
+        ProcessSupervisor.stop(self.__hostProcesses + self.__decoderProcesses, debug=self.cfg.debug)
+        self.__hostProcesses = []
+        self.__decoderProcesses = []
+
+    def runMultiHost(self):
+        """ Capture from several hosts (or interfaces) in parallel and merge the streams into one Wireshark session """
+
+        self.__startTime = time.time()
+
+        self.setupSignals()
+
+        try:
+            sources = self.__openSources(self.cfg.stats != None)
+        except ValueError as e:
+            printf("%s\n", e)
+            self.__exit(1)
+
+        merger = PcapMerger(sources, self.__startConsumer(None), self.cfg.mergeDelay, self.cfg.debug)
+        mergeThread = threading.Thread(target=merger.run, daemon=True)
+        mergeThread.start()
+        self.__startTelemetry(lambda: merger.packets, lambda: merger.bytes,
+            [ ('ssh:' + (x[0] if len(x) == 2 else sprintf('%s:%s', x[2], x[0])), lambda p=p: p.stdout)
+                for x, p in zip(sources, self.__hostProcesses) ])
+
+        supervisor = ProcessSupervisor(self.cfg.debug)
+        supervisor.watchThread(mergeThread, 'merge')
+        if self.__wireProcess != None:
+            supervisor.watch(self.__wireProcess, 'wireshark')
+        for p in self.__hostProcesses:
+            supervisor.watch(p, 'ssh')
+
+        deadline = None
+        if self.cfg.runTimeout != None and self.cfg.runTimeout > 0:
+            deadline = self.__startTime + self.cfg.runTimeout
         else:
             printf("Press Ctrl+C to terminate capture and exit\n")
-            while True:
-                for p in (self.__sshProcess, self.__plinkProcess):
-                    if p != None and p.poll() != None:
-                        if self.cfg.debug > 3:
-                            printf("Detected exit from SSH, exiting\n")
-                        self.__exit(0)
-                
-                if self.__wireProcess.poll() != None:
-                    if self.cfg.debug > 3:
-                        printf("Detected exit from Wireshark, exiting\n")
-                    self.__exit(0)
-                
-                time.sleep(1)
+
+        # The merge finishes when every host has stopped sending or Wireshark went away
+        while True:
+            finished = supervisor.wait(None if deadline == None else max(0, deadline - time.time()))
+            if finished == 'ssh':
+                if self.cfg.debug > 3:
+                    printf("Detected exit from SSH to one of the hosts\n")
+                continue
+            if finished == 'wireshark':
+                if self.cfg.debug > 3:
+                    printf("Detected exit from Wireshark, exiting\n")
+                self.__exit(0)
+            if finished == None:
+                if self.cfg.debug >= 1:
+                    printf("Reached timeout\n")
+                self.__exit(0)
+            break
+
+        if self.cfg.debug > 3:
+            printf("All hosts finished sending, merged %d packets\n", merger.packets)
+        # Leave Wireshark running with the merged capture
+        if self.__tee != None:
+            self.__tee.close()
+        elif self.__wireProcess != None:
+            try:
+                self.__wireProcess.stdin.close()
+            except OSError:
+                pass
+        self.__exit(0)
 
     def __exit(self, exitCode = 0):
+        self.__stopping.set()
+        if self.__sinkError != None:
+            exitCode = 1
+        self.__closeGap(False)
+        if self.__telemetry != None:
+            self.__telemetry.stop()
+        if self.__tee != None:
+            # The consumers get the rest of their queues before the output files are closed
+            self.__tee.close()
+            if not self.__tee.join(TEE_DRAIN_TIMEOUT) and self.cfg.debug > 0:
+                printf("Some consumers did not catch up within %d seconds\n", TEE_DRAIN_TIMEOUT)
+            for consumer in self.__tee.consumers:
+                if consumer.droppedPackets > 0 or (consumer.spilledBytes > 0 and self.cfg.debug > 0) or self.cfg.debug > 1:
+                    printf("Consumer %s received %d bytes, dropped %d packets (%d bytes), spilled %d bytes\n", consumer.name,
+                        consumer.bytes, consumer.droppedPackets, consumer.droppedBytes, consumer.spilledBytes)
         if self.cfg.debug > 1 and self.__startTime != None:
             printf("Utility was running for %.6f seconds\n", time.time()-self.__startTime)
+        if self.__sink != None:
+            self.__sink.close()
+            if self.cfg.debug > 1:
+                printf("Wrote %d bytes into %d file(s)\n", self.__sink.bytes, len(self.__sink.files))
+        if self.__counter != None and self.cfg.snaplen > 0 and self.cfg.debug > 0 and self.__counter.originalBytes > 0:
+            printf("Transferred %d bytes of packet data for %d bytes of original packets (%.1f%%) in %d packets\n",
+                self.__counter.capturedBytes, self.__counter.originalBytes,
+                100.0 * self.__counter.capturedBytes / self.__counter.originalBytes, self.__counter.packets)
+        if self.cfg.debug > 1 and self.__relay != None:
+            printf("Relayed %d bytes (%s)\n", self.__relay.bytes, "zero-copy" if self.__relay.zeroCopy else "buffered")
+        # Every child except Wireshark goes down with remoteShark
+        ProcessSupervisor.stop([ self.__sshProcess, self.__plinkProcess ] + self.__hostProcesses + self.__decoderProcesses,
+            debug=self.cfg.debug)
+        if self.describeReduction() != None:
+            # The final counters arrive once the helper has seen the end of the stream
+            for host, stats in list(self.__remoteStats.values()):
+                stats.join(1)
+            self.reportReduction()
         sys.exit(exitCode)
 
     def signalHandler(self, sig, frame):
         printf("Cleaning the child with sig %d\n", sig)
         if self.__plinkProcess != None:
             printf("Stopping plink\n")
-            if self.__plinkProcess.poll() == None:
-                os.kill(self.__plinkProcess.pid, signal.SIGTERM)
         if self.__sshProcess != None:
             printf("Stopping SSH\n")
-            if self.__sshProcess.poll() == None:
-                os.kill(self.__sshProcess.pid, signal.SIGTERM)
+        if len(self.__hostProcesses) > 0:
+            printf("Stopping SSH to all hosts\n")
         self.__exit(0)
 
     def setupSignals(self):
@@ -643,9 +5451,70 @@ xargs printf "%10s | %24s\\n"
                 printf("Setting the hook %s\n", signal.strsignal(sig))
             signal.signal(sig, self.signalHandler)
 
+class RemoteCapture:
+    """ Importable access to a remote capture, yielding its packets instead of launching Wireshark
+
+    args are the command line arguments of remoteShark: the hosts (or host:/path/file.pcap)
+    and the options, e.g. -f, -i, -c, -t, --codec, --sample or --since:
+
+        import remoteShark
+        with remoteShark.RemoteCapture(['10.20.30.40', '-f', 'tcp port 443', '-c', '100000']) as capture:
+            for packet in capture:
+                handle(packet.timestamp, packet.origlen, packet.data)
+
+    Packets are PacketReader Packets, their data is only valid until the next one is
+    read. The packets of several hosts are merged by timestamp and packet.interface
+    is the index of the host. Options meant for Wireshark or local files are ignored.
+    Invalid arguments raise ConfigError, a ValueError, and open() raises OSError when
+    a host cannot be reached.
+    """
+    def __init__(self, args):
+        if len(args) == 0:
+            raise ValueError("No host was specified")
+        self.config = AppConfig([ 'remoteShark' ] + list(args))
+        if self.config.sshHost == None or len(self.config.sshHost) == 0:
+            raise ValueError("No host was specified")
+        self.app = RemoteShark(self.config)
+        self.reader = None
+
+    def open(self):
+        """ Connects to the hosts and starts the capture """
+        if self.reader != None:
+            return self
+        if not self.app.startup(False):
+            raise OSError(sprintf("Cannot detect %s", "plink" if self.app.platform == 'Windows' else "ssh"))
+        self.reader = PacketReader(self.app.openStream())
+        return self
+
+    def __iter__(self):
+        return self.open().reader.packets()
+
+    def close(self):
+        """ Stops the capture on the remote hosts """
+        if self.reader != None:
+            self.app.closeStream()
+            self.reader.stream.close()
+            self.reader = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
 if __name__ == '__main__':
     # Initialize configuration
-    cfg = AppConfig(sys.argv)
+    try:
+        cfg = AppConfig(sys.argv)
+    except ConfigError as e:
+        printf("%s\n", e)
+        sys.exit(e.status)
+
+    if cfg.extractFile != None:
+        # Works on a local file, no host is involved
+        app = RemoteShark()
+        sys.exit(app.extract())
 
     if cfg.sshHost == None or len(cfg.sshHost) == 0:
         printf("No host was specified\n\n")
@@ -656,8 +5525,16 @@ if __name__ == '__main__':
     # Initialize the application
     app = RemoteShark()
 
-    if not app.detectRequirement():
-        if app.platform == 'Windows':
+    try:
+        started = app.startup()
+    except OSError as e:
+        printf("%s\n", e)
+        sys.exit(1)
+
+    if not started:
+        if cfg.outputFile != None:
+            printf("Cannot detect %s\n", "plink" if app.platform == 'Windows' else "ssh")
+        elif app.platform == 'Windows':
             printf("Cannot detect Wireshark or plink\n")
         else:
             printf("Cannot detect wireshark or ssh\n")
@@ -0,0 +1,809 @@
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+
+import pytest
+
+import remoteShark
+from remoteShark import FlowIndex, PacketReader, Pcapng, WindowLocator
+
+BASE = 1700000000
+
+def tcpPacket(src, dst, sport, dport, payload = b''):
+    """ Ethernet, IPv4 and TCP headers followed by payload """
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64, 6, 0, bytes(src), bytes(dst))
+    tcp = struct.pack('>HHIIBBHHH', sport, dport, 0, 0, 0x50, 0x10, 65535, 0, 0)
+    return b'\x00' * 12 + b'\x08\x00' + ip + tcp + payload
+
+def pcapHeader(nano = False, linktype = 1):
+    return struct.pack('<IHHiIII', remoteShark.PCAP_MAGIC_NSEC if nano else remoteShark.PCAP_MAGIC_USEC, 2, 4, 0, 0,
+        65535, linktype)
+
+def pcapRecord(timestampNs, data, nano = False):
+    fraction = timestampNs % 1000000000 if nano else timestampNs % 1000000000 // 1000
+    return struct.pack('<IIII', timestampNs // 1000000000, fraction, len(data), len(data)) + data
+
+def pcapFile(packets, nano = False):
+    """ Returns a pcap file of the (timestamp in ns, data) packets and the offsets after every record """
+    records = bytearray()
+    ends = []
+    for timestamp, data in packets:
+        records += pcapRecord(timestamp, data, nano)
+        ends.append(len(records))
+    return pcapHeader(nano), records, ends
+
+def interfaceBlock(linktype, resolution):
+    options = struct.pack('<HHB3x', 9, 1, resolution) + struct.pack('<HH', 0, 0)
+    body = struct.pack('<HHI', linktype, 0, 65535) + options
+    return struct.pack('<II', remoteShark.PCAPNG_IDB, 12 + len(body)) + body + struct.pack('<I', 12 + len(body))
+
+def packets(stream):
+    return [ (x.timestamp, x.interface, bytes(x.data)) for x in PacketReader(stream) ]
+
+@pytest.fixture
+def helper(tmp_path):
+    """ The remote helper as a script """
+    path = tmp_path / 'helper.py'
+    path.write_text(remoteShark.REMOTE_HELPER)
+    return str(path)
+
+def runHelper(helper, args, stdin = b''):
+    """ Runs the remote helper, returns its output and the counters it reported """
+    out = subprocess.run([ sys.executable, helper ] + args, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        check=True)
+    counters = {}
+    for line in out.stderr.decode().splitlines():
+        if line.startswith('remoteShark::reduce '):
+            counters = dict([ (x.split('=')[0], int(x.split('=')[1])) for x in line.split()[1:] ])
+    return out.stdout, counters
+
+# Two TCP flows and the reverse direction of the first one, spread over four index buckets
+FLOWS = [ ((10, 0, 0, 1), (10, 0, 0, 2), 1000, 80), ((10, 0, 0, 3), (10, 0, 0, 2), 2000, 443) ]
+TRAFFIC = []
+for i in range(40):
+    src, dst, sport, dport = FLOWS[i % 2]
+    if i % 4 == 2:
+        src, dst, sport, dport = dst, src, dport, sport
+    TRAFFIC.append(((BASE + i) * 1000000000 + i * 1000, tcpPacket(src, dst, sport, dport, bytes([ i ]) * i)))
+
+def test_pcap_packets():
+    header, records, ends = pcapFile(TRAFFIC[:3])
+    # A tiny buffer makes the records cross its end and grow it
+    reader = PacketReader(io.BytesIO(header + records), bufferSize = 32)
+    assert [ (x.timestamp, x.caplen, x.origlen, bytes(x.data)) for x in reader ] == \
+        [ (t, len(d), len(d), d) for t, d in TRAFFIC[:3] ]
+    assert reader.format == 'pcap'
+    assert reader.interfaces == [ (1, 65535) ]
+    assert reader.count == 3
+
+def test_pcap_nanoseconds():
+    header, records, ends = pcapFile(TRAFFIC[:2], nano = True)
+    assert [ x[0] for x in packets(io.BytesIO(header + records)) ] == [ t for t, d in TRAFFIC[:2] ]
+
+def test_pcapng_tsresol():
+    data = tcpPacket(*FLOWS[0])
+    stream = Pcapng.sectionHeader()
+    # Microseconds, 2^-10 seconds and nanoseconds (the builder of the merged streams)
+    stream = stream + interfaceBlock(1, 6) + interfaceBlock(1, 0x8a) + Pcapng.interfaceDescription(101, 65535, 'ns')
+    stream = stream + Pcapng.enhancedPacket(0, BASE * 1000000 + 5, len(data), len(data), data)
+    stream = stream + Pcapng.enhancedPacket(1, BASE * 1024 + 512, len(data), 100, data)
+    stream = stream + Pcapng.enhancedPacket(2, BASE * 1000000000 + 7, 20, len(data), data[:20])
+    reader = PacketReader(io.BytesIO(stream))
+    assert [ (x.timestamp, x.interface, x.caplen, x.origlen) for x in reader ] == [
+        (BASE * 1000000000 + 5000, 0, len(data), len(data)),
+        (BASE * 1000000000 + 500000000, 1, len(data), 100),
+        (BASE * 1000000000 + 7, 2, 20, len(data)) ]
+    assert reader.format == 'pcapng'
+    assert reader.interfaces == [ (1, 65535), (1, 65535), (101, 65535) ]
+
+def block(blockType, body):
+    return struct.pack('<II', blockType, 12 + len(body)) + body + struct.pack('<I', 12 + len(body))
+
+def test_pcapng_malformed():
+    data = tcpPacket(*FLOWS[0])
+    section = Pcapng.sectionHeader() + Pcapng.interfaceDescription(1, 65535, 'a')
+    padded = data + b'\x00' * (-len(data) % 4)
+    for stream in (section + Pcapng.enhancedPacket(1, BASE, len(data), len(data), data),
+            # Obsolete packet block of interface 3
+            section + block(2, struct.pack('<HHIIII', 3, 0, 0, BASE, len(data), len(data)) + padded),
+            # Simple packet block of a section without interfaces
+            Pcapng.sectionHeader() + block(3, struct.pack('<I', len(data)) + padded),
+            # Captured length beyond the end of the block
+            section + block(remoteShark.PCAPNG_EPB, struct.pack('<IIIII', 0, 0, BASE, 200, 200) + padded)):
+        with pytest.raises(ValueError):
+            packets(io.BytesIO(stream))
+
+def test_file_format():
+    assert PacketReader.fileFormat(pcapHeader()) == ('pcap', '<', 1000)
+    assert PacketReader.fileFormat(pcapHeader(nano = True)) == ('pcap', '<', 1)
+    assert PacketReader.fileFormat(struct.pack('>I', remoteShark.PCAP_MAGIC_USEC)) == ('pcap', '>', 1000)
+    assert PacketReader.fileFormat(b'xx' + Pcapng.sectionHeader(), 2) == ('pcapng', None, None)
+    for header in (b'\x1f\x8b\x08\x00', b'\xd4\xc3'):
+        with pytest.raises(ValueError):
+            PacketReader.fileFormat(header)
+
+def test_packet_record():
+    header, records, ends = pcapFile(TRAFFIC[:3])
+    reader = PacketReader(io.BytesIO(header + records), bufferSize = 32)
+    assert [ bytes(reader.record()) for x in reader ] == [ bytes(records[x:y]) for x, y in zip([ 0 ] + ends, ends) ]
+    assert reader.header == header
+
+def merged(stream):
+    """ The (timestamp, linktype, data) of the packets of a merged stream """
+    reader = PacketReader(stream)
+    return [ (x.timestamp, reader.interfaces[x.interface][0], bytes(x.data)) for x in reader ]
+
+def test_merge_sources():
+    a = pcapFile(TRAFFIC[0::3])
+    b = pcapFile(TRAFFIC[1::3], nano = True)
+    # A pcapng source with two interfaces
+    c = Pcapng.sectionHeader() + Pcapng.interfaceDescription(1, 65535, 'c0') + Pcapng.interfaceDescription(101, 65535, 'c1')
+    for i, (t, d) in enumerate(TRAFFIC[2::3]):
+        c = c + Pcapng.enhancedPacket(i % 2, t, len(d), len(d), d)
+    out = io.BytesIO()
+    merger = remoteShark.PcapMerger([ ('a', io.BytesIO(a[0] + a[1])), ('b', io.BytesIO(b[0] + b[1]), 'host b'), ('c', io.BytesIO(c)) ],
+        out, mergeDelay = 5)
+    assert merger.run()
+    expected = []
+    for i, (t, d) in enumerate(TRAFFIC):
+        expected.append((t, 101 if i % 3 == 2 and i // 3 % 2 == 1 else 1, d))
+    assert merged(io.BytesIO(out.getvalue())) == expected
+    assert merger.packets == len(TRAFFIC)
+    assert merger.bytes == len(out.getvalue())
+    for name in (b'a', b'b', b'host b', b'c', b'c#1'):
+        assert struct.pack('<H', len(name)) + name in out.getvalue()
+
+class MergedOutput:
+    """ Output of a merger, signalling every write """
+    def __init__(self):
+        self.data = b''
+        self.written = threading.Event()
+
+    def write(self, data):
+        self.data = self.data + data
+        self.written.set()
+
+    def flush(self):
+        pass
+
+def test_merge_delay():
+    a = pcapFile(TRAFFIC[1:3])
+    readFd, writeFd = os.pipe()
+    out = MergedOutput()
+    merger = remoteShark.PcapMerger([ ('a', io.BytesIO(a[0] + a[1])), ('b', os.fdopen(readFd, 'rb')) ], out, mergeDelay = 0.2)
+    thread = threading.Thread(target=merger.run)
+    thread.start()
+    # The silent source holds back the other one for the merge delay only
+    while merger.packets < 2:
+        assert out.written.wait(2)
+        out.written.clear()
+    b = pcapFile(TRAFFIC[:1] + TRAFFIC[3:4])
+    with os.fdopen(writeFd, 'wb') as f:
+        f.write(b[0] + b[1])
+    thread.join(2)
+    assert not thread.is_alive()
+    # A packet older than those already written comes late
+    assert [ x[0] for x in merged(io.BytesIO(out.data)) ] == [ TRAFFIC[i][0] for i in (1, 2, 0, 3) ]
+
+def writeIndexed(path, traffic, chunk = 7):
+    """ Writes traffic as a pcap file to path and indexes it the way RingFileSink does, in chunks """
+    header, records, ends = pcapFile(traffic)
+    index = FlowIndex(header)
+    start = 0
+    for i in range(chunk, len(ends) + chunk, chunk):
+        stop = ends[min(i, len(ends)) - 1]
+        index.add(records, ends, start, stop, len(header) + start)
+        start = stop
+    with open(path, 'wb') as f:
+        f.write(header + records)
+    return index
+
+def test_flow_index_round_trip(tmp_path):
+    path = str(tmp_path / 'capture.pcap')
+    index = writeIndexed(path, TRAFFIC)
+    index.save(path + '.idx')
+    loaded = FlowIndex.load(path + '.idx')
+    assert loaded.flows == index.flows
+    assert len(loaded.flows) == 2
+    assert loaded.headerLength == 24
+    # Every packet is found once, in file order
+    assert [ x[0] for x in loaded.select() ] == [ 24 ] + [ 24 + x for x in pcapFile(TRAFFIC)[2][:-1] ]
+    # The entries are sorted by flow and bucket and cover every packet once
+    entries = [ tuple(loaded.entries[i:i + 4]) for i in range(0, len(loaded.entries), 4) ]
+    assert entries == sorted(entries)
+    assert sum(x[3] for x in entries) == len(TRAFFIC)
+
+def test_flow_index_extract(tmp_path):
+    path = str(tmp_path / 'capture.pcap')
+    writeIndexed(path, TRAFFIC).save(path + '.idx')
+    index = FlowIndex.load(path + '.idx')
+    out = io.BytesIO()
+    key = FlowIndex.flowKey('tcp 10.0.0.2:80 10.0.0.1:1000')
+    assert index.extract(path, out, key) == 20
+    assert [ (x[0], x[2]) for x in packets(io.BytesIO(out.getvalue())) ] == TRAFFIC[0::2]
+    out = io.BytesIO()
+    assert index.extract(path, out, None, BASE + 5, BASE + 12) == 7
+    assert [ x[0] for x in packets(io.BytesIO(out.getvalue())) ] == [ t for t, d in TRAFFIC[5:12] ]
+    out = io.BytesIO()
+    assert index.extract(path, out, FlowIndex.flowKey('tcp 10.0.0.9:1 10.0.0.2:80')) == 0
+    assert out.getvalue() == pcapHeader()
+
+def test_flow_index_load_invalid(tmp_path):
+    path = tmp_path / 'capture.pcap.idx'
+    path.write_bytes(b'not an index')
+    try:
+        FlowIndex.load(str(path))
+    except ValueError:
+        return
+    assert False, 'no ValueError'
+
+def test_helper_merge(tmp_path, helper):
+    # Interleaved files, a file which starts later, a tie between files and a nanosecond file
+    files = {
+        'a.pcap': pcapFile([ (BASE * 1000000000 + x * 3000, b'a%d' % x) for x in range(30) ]),
+        'b.pcap': pcapFile([ (BASE * 1000000000 + x * 5000, b'b%d' % x) for x in range(20) ]),
+        'c.pcap': pcapFile([ (BASE * 1000000000 + 90000 + x * 1000, b'c%d' % x) for x in range(10) ]),
+        'd.pcap': pcapFile([ (BASE * 1000000000 + x * 7001, b'd%d' % x) for x in range(10) ], nano = True),
+        'empty.pcap': (pcapHeader(), b'', []),
+    }
+    expected = []
+    for index, name in enumerate(sorted(files)):
+        header, records, ends = files[name]
+        (tmp_path / name).write_bytes(header + records)
+        expected = expected + [ (x.timestamp, index, bytes(x.data)) for x in PacketReader(io.BytesIO(header + records)) ]
+    expected.sort()
+    out = subprocess.run([ sys.executable, helper, '--merge', '--', str(tmp_path / '*.pcap') ],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    merged = packets(io.BytesIO(out.stdout))
+    # Ordered by timestamp, ties in the order of the files
+    assert [ (x[0], x[2]) for x in merged ] == [ (x[0], x[2]) for x in expected ]
+    assert out.stdout[:4] == struct.pack('<I', remoteShark.PCAP_MAGIC_NSEC)
+    assert b'empty.pcap' in out.stderr
+
+def test_helper_merge_window(tmp_path, helper):
+    header, records, ends = pcapFile([ ((BASE + x) * 1000000000, b'a%d' % x) for x in range(10) ])
+    (tmp_path / 'a.pcap').write_bytes(header + records)
+    header, records, ends = pcapFile([ ((BASE + x) * 1000000000 + 500000000, b'b%d' % x) for x in range(10) ])
+    (tmp_path / 'b.pcap').write_bytes(header + records)
+    out, counters = runHelper(helper, [ '--merge', '--since', str((BASE + 3) * 1000000000),
+        '--until', str((BASE + 5) * 1000000000), '--', str(tmp_path / 'a.pcap'), str(tmp_path / 'b.pcap') ])
+    assert [ x[2] for x in packets(io.BytesIO(out)) ] == [ b'a3', b'b3', b'a4', b'b4', b'a5' ]
+
+class BlockedConsumer:
+    """ Consumer of a StreamTee which takes nothing until it is released """
+    def __init__(self):
+        self.data = bytearray()
+        self.released = threading.Event()
+
+    def write(self, data):
+        self.released.wait()
+        self.data += data
+        return len(data)
+
+    def close(self):
+        pass
+
+def feedTee(tee, stream, chunk):
+    for i in range(0, len(stream), chunk):
+        tee.write(stream[i:i + chunk])
+
+def test_tee_drop_keeps_records():
+    header, records, ends = pcapFile(TRAFFIC)
+    tee = remoteShark.StreamTee()
+    slow = BlockedConsumer()
+    fast = BlockedConsumer()
+    fast.released.set()
+    dropping = tee.add('slow', slow, 'drop', limit = 200)
+    tee.add('fast', fast, 'drop')
+    # Chunks which end within records
+    feedTee(tee, header + records, 150)
+    slow.released.set()
+    tee.close()
+    assert tee.join(10)
+    assert bytes(fast.data) == header + records
+    kept = packets(io.BytesIO(bytes(slow.data)))
+    assert dropping.droppedPackets > 0
+    assert len(kept) + dropping.droppedPackets == len(TRAFFIC)
+    # Whole records in their order, nothing cut in between
+    traffic = [ (t, 0, d) for t, d in TRAFFIC ]
+    assert kept == [ x for x in traffic if x in kept ]
+    assert len(slow.data) + dropping.droppedBytes == len(header + records)
+
+def test_tee_drop_keeps_interfaces():
+    data = tcpPacket(*FLOWS[0])
+    stream = Pcapng.sectionHeader() + Pcapng.interfaceDescription(1, 65535, 'a')
+    for i in range(20):
+        stream = stream + Pcapng.enhancedPacket(0, BASE * 1000000000 + i, len(data), len(data), data)
+    # An interface showing up within the stream, while the consumer is behind
+    stream = stream + Pcapng.interfaceDescription(101, 65535, 'b')
+    for i in range(20):
+        stream = stream + Pcapng.enhancedPacket(1, BASE * 1000000000 + 100 + i, 20, len(data), data[:20])
+    tee = remoteShark.StreamTee()
+    slow = BlockedConsumer()
+    dropping = tee.add('slow', slow, 'drop', limit = 300)
+    feedTee(tee, stream, 250)
+    slow.released.set()
+    tee.close()
+    assert tee.join(10)
+    reader = PacketReader(io.BytesIO(bytes(slow.data)))
+    kept = [ (x.timestamp, x.interface, bytes(x.data)) for x in reader ]
+    assert dropping.droppedPackets > 0
+    assert len(kept) + dropping.droppedPackets == 40
+    assert reader.interfaces == [ (1, 65535), (101, 65535) ]
+    assert [ x[0] for x in kept ] == sorted(x[0] for x in kept)
+    assert all(x[2] == (data if x[1] == 0 else data[:20]) for x in kept)
+
+def test_tee_spill_replays_in_order():
+    header, records, ends = pcapFile(TRAFFIC)
+    tee = remoteShark.StreamTee()
+    slow = BlockedConsumer()
+    spilling = tee.add('slow', slow, 'spill', limit = 200)
+    feedTee(tee, header + records, 150)
+    assert spilling.spilledBytes > 0
+    slow.released.set()
+    # More of the stream while the spilled part is read back
+    more = [ ((BASE + 100 + x) * 1000000000, b'late%d' % x) for x in range(5) ]
+    tee.write(b''.join(pcapRecord(t, d) for t, d in more))
+    tee.close()
+    assert tee.join(10)
+    assert spilling.droppedPackets == 0
+    assert bytes(slow.data) == header + records + b''.join(pcapRecord(t, d) for t, d in more)
+
+def filePackets(path):
+    with open(path, 'rb') as f:
+        return packets(f)
+
+def test_ring_rotate_size(tmp_path):
+    header, records, ends = pcapFile(TRAFFIC)
+    sink = remoteShark.RingFileSink(str(tmp_path / 'ring.pcap'), rotateSize = 600)
+    feedTee(sink, header + records, 97)
+    sink.close()
+    assert len(sink.files) > 3
+    assert all(x.startswith(str(tmp_path / 'ring_')) and x.endswith('.pcap') for x in sink.files)
+    found = []
+    for name in sink.files:
+        with open(name, 'rb') as f:
+            content = f.read()
+        # Every file is a capture of its own, cut between records
+        assert content[:24] == header
+        assert len(content) <= 600
+        found = found + packets(io.BytesIO(content))
+    assert found == [ (t, 0, d) for t, d in TRAFFIC ]
+    assert sink.bytes == len(header + records)
+
+def test_ring_rotate_size_large_record(tmp_path):
+    traffic = [ (BASE * 1000000000, b'x' * 1000), (BASE * 1000000000 + 1000, b'y' * 10) ]
+    header, records, ends = pcapFile(traffic)
+    sink = remoteShark.RingFileSink(str(tmp_path / 'ring'), rotateSize = 500)
+    sink.write(header + records)
+    sink.close()
+    # A record larger than a file still gets one of its own
+    assert [ filePackets(x) for x in sink.files ] == [ [ (t, 0, d) ] for t, d in traffic ]
+
+def test_ring_rotate_time_and_max_files(tmp_path, monkeypatch):
+    now = [ 1000.0 ]
+    monkeypatch.setattr(remoteShark.time, 'monotonic', lambda: now[0])
+    header, records, ends = pcapFile(TRAFFIC)
+    sink = remoteShark.RingFileSink(str(tmp_path / 'ring.pcap'), rotateTime = 10, maxFiles = 2)
+    sink.write(header)
+    start = 0
+    for i, end in enumerate(ends):
+        # A new file every 5 records
+        now[0] = 1000.0 + i // 5 * 10
+        sink.write(records[start:end])
+        start = end
+    sink.close()
+    assert len(sink.files) == 2
+    assert sorted(x.name for x in tmp_path.iterdir()) == sorted(x[len(str(tmp_path)) + 1:] for x in sink.files)
+    assert [ x[-1] for x in filePackets(sink.files[0]) ] == [ d for t, d in TRAFFIC[30:35] ]
+    assert [ x[-1] for x in filePackets(sink.files[1]) ] == [ d for t, d in TRAFFIC[35:] ]
+    assert sink.files[1].startswith(str(tmp_path / 'ring_00008_'))
+
+def test_ring_pcapng_headers(tmp_path):
+    data = tcpPacket(*FLOWS[0])
+    stream = Pcapng.sectionHeader() + Pcapng.interfaceDescription(1, 65535, 'a')
+    for i in range(10):
+        stream = stream + Pcapng.enhancedPacket(0, BASE * 1000000000 + i, len(data), len(data), data)
+    stream = stream + Pcapng.interfaceDescription(101, 65535, 'b')
+    for i in range(10):
+        stream = stream + Pcapng.enhancedPacket(1, BASE * 1000000000 + 10 + i, 20, len(data), data[:20])
+    sink = remoteShark.RingFileSink(str(tmp_path / 'ring.pcapng'), rotateSize = 400)
+    feedTee(sink, stream, 111)
+    sink.close()
+    assert all(x.endswith('.pcapng') for x in sink.files)
+    found = []
+    for name in sink.files:
+        with open(name, 'rb') as f:
+            reader = PacketReader(f)
+            found = found + [ (x.timestamp, x.interface) for x in reader ]
+        # Every file starts with the section header and the interfaces seen before it
+        assert open(name, 'rb').read(len(Pcapng.sectionHeader())) == Pcapng.sectionHeader()
+        assert len(reader.interfaces) == (1 if found[-1][1] == 0 else 2)
+    assert found == [ (BASE * 1000000000 + i, 0 if i < 10 else 1) for i in range(20) ]
+
+def test_ring_write_error(tmp_path):
+    header, records, ends = pcapFile(TRAFFIC)
+    directory = tmp_path / 'gone'
+    directory.mkdir()
+    errors = []
+    sink = remoteShark.RingFileSink(str(directory / 'ring'), rotateSize = 600,
+        onError = lambda sink, error: errors.append(error))
+    sink.write(header + records[:ends[3]])
+    for x in directory.iterdir():
+        x.unlink()
+    directory.rmdir()
+    # The next file cannot be created
+    try:
+        feedTee(sink, records[ends[3]:], 200)
+    except OSError as e:
+        assert e is errors[0]
+    else:
+        assert False, 'no OSError'
+    assert len(errors) == 1
+    assert sink.error is errors[0]
+    try:
+        sink.write(b'\0' * 16)
+    except OSError as e:
+        assert e is errors[0]
+    else:
+        assert False, 'no OSError after the error'
+    sink.close()
+    assert len(errors) == 1
+
+ARP = b'\xff' * 6 + b'\x00' * 6 + b'\x08\x06' + b'\x00' * 28
+
+def flowTraffic(host, count = 200):
+    """ Packets of 50 TCP flows between host and its peers in both directions, with ARP in between """
+    traffic = []
+    for i in range(count):
+        peer = (10, 1, i % 50 // 10, i % 10)
+        if i % 25 == 24:
+            data = ARP
+        elif i // 50 % 2 == 0:
+            data = tcpPacket(host, peer, 40000 + i % 50, 443)
+        else:
+            data = tcpPacket(peer, host, 443, 40000 + i % 50)
+        traffic.append(((BASE + i) * 1000000000, data))
+    return traffic
+
+def flowOf(data):
+    ip = remoteShark.packetNetwork(1, data)
+    return remoteShark.packetFlow(data, ip[0], ip[1]) if ip != None else None
+
+def test_reduce_sample(helper):
+    header, records, ends = pcapFile(TRAFFIC)
+    out, counters = runHelper(helper, [ '--sample', '3' ], header + records)
+    assert out[:24] == header
+    assert [ x[2] for x in packets(io.BytesIO(out)) ] == [ d for t, d in TRAFFIC[0::3] ]
+    assert counters['seen'] == 40
+    assert counters['seenBytes'] == len(records)
+    assert counters['kept'] == 14
+    assert counters['sampled'] == 26
+
+def test_reduce_flow_sample(helper):
+    traffic = flowTraffic((192, 168, 0, 1))
+    # The same flows seen on another host, in another order
+    other = list(reversed(traffic))
+    kept = []
+    for capture in (traffic, other):
+        header, records, ends = pcapFile(capture)
+        out, counters = runHelper(helper, [ '--flow-sample', '4' ], header + records)
+        expected = [ d for t, d in capture if flowOf(d) == None or zlib.crc32(flowOf(d)) % 4 == 0 ]
+        assert [ x[2] for x in packets(io.BytesIO(out)) ] == expected
+        assert counters['kept'] == len(expected)
+        assert counters['flows'] == len(capture) - len(expected)
+        flows = set(flowOf(d) for d in expected) - set([ None ])
+        # Both directions of a flow share its key, so a flow is kept or dropped as a whole
+        assert set(d for t, d in capture if flowOf(d) in flows) == set(d for d in expected if d != ARP)
+        assert ARP in expected
+        kept.append(flows)
+    assert 0 < len(kept[0]) < 50
+    assert kept[0] == kept[1]
+
+def test_reduce_rate_limit(helper):
+    traffic = [ (BASE * 1000000000 + i * 1000, b'\x00' * 1000) for i in range(100) ]
+    header, records, ends = pcapFile(traffic)
+    out, counters = runHelper(helper, [ '--rate-limit', '100' ], header + records)
+    # The bucket starts with 64 KiB, the packet which takes it below zero still passes
+    assert counters['kept'] == 65
+    assert counters['limited'] == 35
+    assert counters['limitedBytes'] == 35 * 1016
+    assert [ x[0] for x in packets(io.BytesIO(out)) ] == [ t for t, d in traffic[:65] ]
+
+def test_summary_intervals(helper):
+    # Three intervals of 10 s with packets and two without any in between
+    traffic = TRAFFIC[:25] + [ ((BASE + 26) * 1000000000, ARP), ((BASE + 57) * 1000000000, TRAFFIC[1][1]) ]
+    header, records, ends = pcapFile(traffic)
+    out, counters = runHelper(helper, [ '--summary', '10', '--top', '1' ], header + records)
+    lines = [ json.loads(x) for x in out.decode().splitlines() ]
+    assert [ (x['start'], x['interval'], x['packets']) for x in lines ] == [ (BASE, 10, 10), (BASE + 10, 10, 10),
+        (BASE + 20, 10, 6), (BASE + 50, 10, 1) ]
+    for line, first in zip(lines, (0, 10, 20)):
+        sizes = [ len(d) for t, d in traffic[first:first + 10] if BASE + first <= t // 1000000000 < BASE + first + 10 ]
+        assert line['bytes'] == sum(sizes)
+    # The flows of the first interval: odd packets are a little larger
+    first = lines[0]
+    assert first['flows'] == 2
+    assert first['protocols'] == { 'tcp': { 'packets': 10, 'bytes': 10 * 54 + 45 } }
+    assert first['top'] == [ { 'flow': 'tcp 10.0.0.2:443 10.0.0.3:2000', 'packets': 5, 'bytes': 5 * 54 + 25 } ]
+    # 10.0.0.2 takes part in both flows
+    assert first['talkers'] == [ { 'address': '10.0.0.2', 'bytes': 10 * 54 + 45 } ]
+    third = lines[2]
+    assert third['protocols']['other'] == { 'packets': 1, 'bytes': len(ARP) }
+    assert third['flows'] == 3
+    assert lines[3]['top'][0]['flow'] == 'tcp 10.0.0.2:443 10.0.0.3:2000'
+
+def test_summary_top(helper):
+    # Flow n sends n packets
+    traffic = []
+    for n in range(1, 6):
+        for i in range(n):
+            traffic.append(((BASE + len(traffic) % 10) * 1000000000, tcpPacket((10, 0, 0, n), (10, 0, 1, 1), 1000, 80)))
+    traffic.sort(key=lambda x: x[0])
+    header, records, ends = pcapFile(traffic)
+    out, counters = runHelper(helper, [ '--summary', '60', '--top', '3' ], header + records)
+    lines = [ json.loads(x) for x in out.decode().splitlines() ]
+    assert len(lines) == 1
+    assert [ (x['flow'], x['packets']) for x in lines[0]['top'] ] == [ ('tcp 10.0.0.5:1000 10.0.1.1:80', 5),
+        ('tcp 10.0.0.4:1000 10.0.1.1:80', 4), ('tcp 10.0.0.3:1000 10.0.1.1:80', 3) ]
+    assert [ x['address'] for x in lines[0]['talkers'] ] == [ '10.0.1.1', '10.0.0.5', '10.0.0.4' ]
+    assert lines[0]['packets'] == 15
+
+# Large records, read by the helper in several chunks which end within records
+WINDOW = [ (BASE * 1000000000 + i * 10000000, bytes([ i % 256 ]) * 1500) for i in range(400) ]
+
+def windowed(helper, args):
+    header, records, ends = pcapFile(WINDOW)
+    out, counters = runHelper(helper, args, header + records)
+    kept = packets(io.BytesIO(out))
+    # Nothing but whole records
+    assert len(out) == 24 + sum(16 + len(x[2]) for x in kept)
+    return [ (x[0], x[2]) for x in kept ]
+
+def test_window_since_until(helper):
+    since = WINDOW[100][0]
+    until = WINDOW[250][0]
+    # Both ends are part of the window
+    assert windowed(helper, [ '--since', str(since), '--until', str(until) ]) == WINDOW[100:251]
+    assert windowed(helper, [ '--since', str(since + 1), '--until', str(until - 1) ]) == WINDOW[101:250]
+
+def test_window_duration(helper):
+    # The duration counts from the first packet within the window
+    assert windowed(helper, [ '--duration', '500000000' ]) == WINDOW[:51]
+    assert windowed(helper, [ '--since', str(WINDOW[300][0] - 5), '--duration', '1000000000' ]) == WINDOW[300:]
+    assert windowed(helper, [ '--since', str(WINDOW[10][0]), '--until', str(WINDOW[20][0]),
+        '--duration', '1000000000' ]) == WINDOW[10:21]
+
+def test_window_edges(helper):
+    # The last record is kept whole when the window ends after it
+    assert windowed(helper, [ '--until', str(WINDOW[-1][0]) ]) == WINDOW
+    assert windowed(helper, [ '--since', str(WINDOW[-1][0]) ]) == WINDOW[-1:]
+    assert windowed(helper, [ '--since', str(WINDOW[-1][0] + 1) ]) == []
+    assert windowed(helper, [ '--until', str(WINDOW[0][0] - 1) ]) == []
+
+def decoyTraffic(count):
+    """ Packets 1 ms apart whose data starts like a record header, which only a chain of headers tells apart """
+    traffic = []
+    for i in range(count):
+        decoy = struct.pack('<IIII', BASE + i // 1000, 5, 37, 37)
+        traffic.append(((BASE * 1000 + i) * 1000000, decoy + bytes([ 0xff, i % 256 ]) * (20 + i % 150)))
+    return traffic
+
+@pytest.fixture(scope='module')
+def windowFile(tmp_path_factory):
+    """ A pcap file of about 4.4 MB, the offsets of its records and their timestamps in seconds """
+    traffic = decoyTraffic(20000)
+    header, records, ends = pcapFile(traffic)
+    path = tmp_path_factory.mktemp('window') / 'capture.pcap'
+    path.write_bytes(header + records)
+    offsets = [ 24 ] + [ 24 + x for x in ends[:-1] ]
+    # Seconds and microseconds as in the records
+    return str(path), offsets, [ t // 1000000000 + t % 1000000000 // 1000 / 1e6 for t, d in traffic ]
+
+def test_sync_record(windowFile):
+    path, offsets, times = windowFile
+    with open(path, 'rb') as f:
+        content = f.read()
+    locator = WindowLocator.forFile(path)
+    for i in (0, 1, 777, 19997):
+        # From within a record, its decoy header included, to the start of the next one
+        for start in (offsets[i] + 1, offsets[i] + 16, offsets[i] + 20):
+            found = WindowLocator.syncRecord(content[start:start + 65536], '<', 1000000, 65535, BASE)
+            assert (start + found[0], found[1]) == (offsets[i + 1], times[i + 1])
+    assert WindowLocator.syncRecord(b'\xff' * 1000, '<', 1000000, 65535, BASE) == None
+    assert locator.size == len(content)
+
+def expectedWindow(offsets, times, since, until):
+    start = next((o for o, t in zip(offsets, times) if since == None or t >= since), offsets[-1])
+    if since != None and since > times[-1]:
+        start = None
+    end = next((o for o, t in zip(offsets, times) if until != None and t > until), None)
+    return start, end
+
+def test_window_locate(windowFile):
+    path, offsets, times = windowFile
+    locator = WindowLocator.forFile(path)
+    size = locator.size
+    cases = [
+        (None, times[10]), (times[0], times[0]), (BASE - 1, times[3]),
+        (times[2500], times[2600]), (times[2500] - 0.0005, times[2600] + 0.0005), (times[1234], None),
+        (times[19990], None), (times[19999], times[19999]), (times[14000], BASE + 100), (times[9999], times[10000]) ]
+    for since, until in cases:
+        start, end = expectedWindow(offsets, times, since, until)
+        assert locator.locate(since, until) == (start if start != None else size, end), (since, until)
+    # Windows between two records or after the file are empty
+    start, end = locator.locate(times[100] + 0.0002, times[100] + 0.0008)
+    assert start == end == offsets[101]
+    assert locator.locate(times[-1] + 1, None) == (size, None)
+    assert locator.locate(None, BASE - 1) == (24, 24)
+
+def test_window_locate_reads_little(windowFile):
+    path, offsets, times = windowFile
+    reads = []
+    locator = WindowLocator.forFile(path)
+    read = locator.read
+    def counting(offsets, length):
+        reads.append(len(offsets) * length)
+        return read(offsets, length)
+    locator.read = counting
+    assert locator.locate(times[13000], None) == (offsets[13000], None)
+    # The probes and the final scan of a probe's length, not the whole file
+    assert sum(reads) < locator.size / 2
+    assert reads[-1] <= remoteShark.WINDOW_PROBE_SIZE + 16
+
+def test_window_locate_not_pcap(tmp_path):
+    path = tmp_path / 'capture.pcapng'
+    path.write_bytes(Pcapng.sectionHeader() + Pcapng.interfaceDescription(1, 65535, 'a'))
+    assert WindowLocator.forFile(str(path)).locate(BASE, None) == None
+
+def test_pcap_window_stream():
+    traffic = decoyTraffic(300)
+    header, records, ends = pcapFile(traffic)
+    done = threading.Event()
+    window = remoteShark.PcapWindow(io.BytesIO(header + records), traffic[50][0] / 1e9, traffic[120][0] / 1e9, done.set)
+    assert [ (x[0], x[2]) for x in packets(window.stdout) ] == traffic[50:121]
+    assert done.wait(5)
+    assert window.packets == 71
+    # The duration counts from the first packet within the window
+    window = remoteShark.PcapWindow(io.BytesIO(header + records), traffic[200][0] / 1e9 - 0.0005, duration = 0.0105)
+    assert [ (x[0], x[2]) for x in packets(window.stdout) ] == traffic[200:211]
+    # Up to the end of the stream, which is no reason to stop the producer
+    done = threading.Event()
+    window = remoteShark.PcapWindow(io.BytesIO(header + records), traffic[290][0] / 1e9, onDone = done.set)
+    assert [ (x[0], x[2]) for x in packets(window.stdout) ] == traffic[290:]
+    assert not done.wait(0.2)
+
+def test_detect_format():
+    detectFormat = remoteShark.RemoteShark.detectFormat
+    header = pcapHeader()
+    for nano in (False, True):
+        assert detectFormat(pcapHeader(nano)) == 'pcap'
+        # Big-endian files
+        assert detectFormat(struct.pack('>I', remoteShark.PCAP_MAGIC_NSEC if nano else remoteShark.PCAP_MAGIC_USEC)) == 'pcap'
+    assert detectFormat(Pcapng.sectionHeader()) == 'pcapng'
+    assert detectFormat(gzip.compress(header)) == 'gz'
+    assert detectFormat(bz2.compress(header)) == 'bz2'
+    assert detectFormat(lzma.compress(header)) == 'xz'
+    # A zstd frame, its magic followed by the frame header
+    assert detectFormat(b'\x28\xb5\x2f\xfd\x24\x18') == 'zst'
+    for data in (b'', b'\x1f', b'BZ', b'GIF89a', b'\x00' * 8, lzma.compress(header, format=lzma.FORMAT_ALONE)):
+        assert detectFormat(data) == None
+
+def test_cache_key():
+    key = remoteShark.CaptureCache.key('root@host', '22', '/var/tmp/a.pcap', 1000, 1700000000, 'abc')
+    assert key == remoteShark.CaptureCache.key('root@host', '22', '/var/tmp/a.pcap', 1000, 1700000000, 'abc')
+    # A file which changed in any way, or another file, gets another entry
+    for changed in (('root@other', '22', '/var/tmp/a.pcap', 1000, 1700000000, 'abc'),
+            ('root@host', '2222', '/var/tmp/a.pcap', 1000, 1700000000, 'abc'),
+            ('root@host', '22', '/var/tmp/b.pcap', 1000, 1700000000, 'abc'),
+            ('root@host', '22', '/var/tmp/a.pcap', 1001, 1700000000, 'abc'),
+            ('root@host', '22', '/var/tmp/a.pcap', 1000, 1700000001, 'abc'),
+            ('root@host', '22', '/var/tmp/a.pcap', 1000, 1700000000, 'abd')):
+        assert remoteShark.CaptureCache.key(*changed) != key
+
+def test_cache_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(remoteShark, 'CACHE_CHUNK_SIZE', 1000)
+    cache = remoteShark.CaptureCache(str(tmp_path / 'cache'), 100000)
+    content = bytes(range(256)) * 20
+    # An interrupted transfer, half way into its third chunk
+    first = cache.store('k', '/a.pcap.gz', io.BytesIO(content[:2500]), 0, len(content))
+    assert first == None
+    part = tmp_path / 'cache' / 'k.gz.part'
+    assert part.read_bytes() == content[:2500]
+    assert cache.lookup('k', '/a.pcap.gz') == None
+    # Resumed from the last complete chunk
+    offset = cache.resumeOffset('k', '/a.pcap.gz')
+    assert offset == 2000
+    assert part.stat().st_size == 2000
+    path = cache.store('k', '/a.pcap.gz', io.BytesIO(content[offset:]), offset, len(content))
+    assert path == str(tmp_path / 'cache' / 'k.gz')
+    assert not part.exists()
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert cache.lookup('k', '/a.pcap.gz') == path
+    assert cache.resumeOffset('other', '/a.pcap') == 0
+
+def test_cache_lru(tmp_path):
+    cache = remoteShark.CaptureCache(str(tmp_path), 3000)
+    for i, name in enumerate(('a', 'b', 'c')):
+        path = tmp_path / (name + '.pcap')
+        path.write_bytes(b'\0' * 1000)
+        os.utime(str(path), (1000 + i, 1000 + i))
+    # a was used last, b is the least recently used now
+    cache.lookup('a', '/x.pcap')
+    assert cache.reserve(1000)
+    assert sorted(x.name for x in tmp_path.iterdir()) == [ 'a.pcap', 'c.pcap' ]
+    # The partial transfer being resumed is kept, the others go
+    (tmp_path / 'd.pcap.part').write_bytes(b'\0' * 500)
+    assert cache.reserve(2000, 'd')
+    assert sorted(x.name for x in tmp_path.iterdir()) == [ 'd.pcap.part' ]
+    assert not cache.reserve(3001)
+    assert not cache.reserve(2600, 'd')
+    assert (tmp_path / 'd.pcap.part').exists()
+
+TCPDUMP_USAGE = '''tcpdump version 4.99.1
+libpcap version 1.10.1 (with TPACKET_V3)
+OpenSSL 3.0.2 15 Mar 2022
+Usage: tcpdump [-AbdDefhHIJKlLnNOpqStuUvxX#] [ -B size ] [ -c count ] [--count]
+\t\t[ -C file_size ] [ -E algo:secret ] [ -F file ] [ -G seconds ]
+\t\t[ -i interface ] [ --immediate-mode ] [ -j tstamptype ]
+\t\t[ -M secret ] [ --number ] [ --print ] [ -Q in|out|inout ]
+\t\t[ -r file ] [ -s snaplen ] [ -T type ] [ --version ]
+\t\t[ -V file ] [ -w file ] [ -W filecount ] [ -y datalinktype ]
+\t\t[ --time-stamp-precision precision ] [ --micro ] [ --nano ]
+\t\t[ -z postrotate-command ] [ -Z user ] [ expression ]
+'''
+
+def probeOutput(usage):
+    return ''.join([ 'version tcpdump version 4.99.1\nversion libpcap version 1.10.1 (with TPACKET_V3)\n',
+        'usage ' + ' '.join(usage.split()) + '\n',
+        'interface 1.eth0 [Up, Running, Connected]\ninterface 2.any (Pseudo-device that captures on all interfaces) [Up, Running]\n',
+        'command timeout\ncommand gzip\ncommand python3\n' ])
+
+def test_parse_capabilities():
+    capabilities = remoteShark.RemoteShark.parseCapabilities(probeOutput(TCPDUMP_USAGE))
+    assert capabilities['tcpdump'] == 'tcpdump version 4.99.1'
+    assert capabilities['flags'] == [ '--immediate-mode', '-B', '--time-stamp-precision', '-j' ]
+    assert capabilities['interfaces'] == [ '1.eth0 [Up, Running, Connected]',
+        '2.any (Pseudo-device that captures on all interfaces) [Up, Running]' ]
+    assert capabilities['commands'] == [ 'timeout', 'gzip', 'python3' ]
+    assert capabilities['probed'] == remoteShark.CAPABILITY_COMMANDS
+    # An old tcpdump with none of the options, and no interface list
+    old = remoteShark.RemoteShark.parseCapabilities('version libpcap version 0.9.4\nversion tcpdump version 3.9.4\n' +
+        'usage tcpdump version 3.9.4 libpcap version 0.9.4 Usage: tcpdump [-aAdDeflLnNOpqRStuUvxX] [-c count] [ -i interface ]\n')
+    assert old['tcpdump'] == 'tcpdump version 3.9.4'
+    assert old['interfaces'] == []
+    assert old['flags'] == []
+    # The usage line is missing when the probe did not run at all
+    assert remoteShark.RemoteShark.parseCapabilities('') == None
+    assert remoteShark.RemoteShark.parseCapabilities('bash: tcpdump: command not found\n') == None
+
+def test_host_capabilities(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    calls = tmp_path / 'calls'
+    ssh = tmp_path / 'ssh'
+    ssh.write_text('#!/bin/sh\necho "$1" >> ' + str(calls) + '\ncase "$1" in\n  root@good) cat ' + str(tmp_path / 'probe') + ';;\n  *) exit 255;;\nesac\n')
+    ssh.chmod(0o755)
+    (tmp_path / 'probe').write_text(probeOutput(TCPDUMP_USAGE))
+    config = remoteShark.AppConfig([ 'remoteShark.py', '--ssh-path', str(ssh), '--no-multiplex', '-u', 'root', 'good' ])
+    shark = remoteShark.RemoteShark(config)
+    # A failed probe is remembered for the run as well
+    assert shark.hostCapabilities('bad') == None
+    assert shark.hostCapabilities('bad') == None
+    good = shark.hostCapabilities('good')
+    assert good['commands'] == [ 'timeout', 'gzip', 'python3' ]
+    assert shark.hostCapabilities('good') is good
+    assert calls.read_text().split() == [ 'root@bad', 'root@good' ]
+    # Another run finds the capabilities in hosts.json, failures are not saved
+    saved = json.loads((tmp_path / 'cache' / 'remoteShark' / 'hosts.json').read_text())
+    assert list(saved) == [ 'root@good:22' ]
+    assert remoteShark.RemoteShark(config).hostCapabilities('good') == good
+    assert calls.read_text().split() == [ 'root@bad', 'root@good' ]